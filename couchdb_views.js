@@ -20,6 +20,19 @@ function(doc) {
 	emit(doc._id, doc);
 }
 
+/*
+View url: _design/flows/_view/dp
+Purpose: Getting flow ids of a switch (key [dp_id, table_id]), with
+         the revision, match and output ports of each flow
+Database: flows
+*/
+function(doc) {
+	if(doc.dp_id){
+		emit([doc.dp_id, doc.table_id],
+		     {rev: doc._rev, match: doc.match, out_ports: doc.out_ports});
+	}
+}
+
 /*
 View_url: _design/tags/_view/tags
 Purpose: Getting Flows according to tags
@@ -27,7 +40,22 @@ Database: tags
 */
 function(doc) {
 	if(doc.tags){
-		for(tag in doc.tags){
-  		emit(doc.tags[tag], doc);
+		for(var tag in doc.tags){
+			emit(doc.tags[tag], doc);
+		}
+	}
+}
+
+/*
+View_url: _design/tags/_view/ids
+Purpose: Getting flow ids according to tags (query with keys, a key
+         range, or include_docs=true to get the flows of one page)
+Database: flows
+*/
+function(doc) {
+	if(doc.tags){
+		for(var tag in doc.tags){
+			emit(doc.tags[tag], null);
+		}
 	}
 }
@@ -9,3 +9,14 @@ time python -m unittest -v faucet_mininet_test
 
 echo "========== Running faucet config tests =========="
 python test_config.py
+
+echo "========== Running faucet_db unit tests =========="
+python test_nsodbc.py
+python test_flowdb.py
+
+echo "========== Running valve unit tests =========="
+python test_valve.py
+python test_ofbatch.py
+python test_hostcache.py
+python test_routetable.py
+python test_neighbor.py
@@ -0,0 +1,87 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ryu.lib import ofctl_v1_3 as ofctl
+from ryu.ofproto import ofproto_v1_3 as ofp
+from ryu.ofproto import ofproto_v1_3_parser as parser
+
+
+class NullDP(object):
+    """to_match() needs to access parser via dp."""
+
+    ofproto_parser = parser
+
+
+NULL_DP = NullDP()
+
+# In shared ACL mode, the VLAN table writes the number of the ACL
+# applied to the input port in these bits of the metadata.
+ACL_METADATA_MASK = 0xffffffff
+
+
+def acl_metadata(acl_num):
+    """Return the (metadata, mask) identifying a shared ACL."""
+    return (acl_num, ACL_METADATA_MASK)
+
+
+class ACLRule(object):
+    """An ACL rule compiled to OpenFlow.
+
+    The match fields and instructions are built once, when the ACL is
+    configured; a flow for a port only binds the fields that depend on
+    the port (in_port, or the ACL's metadata when the ACL is shared).
+    """
+
+    def __init__(self, priority, match_fields, instructions):
+        self.priority = priority
+        self.match_fields = match_fields
+        self.instructions = instructions
+
+    def match(self, **bind_fields):
+        """Return the rule's OFPMatch, with bind_fields added."""
+        match_fields = self.match_fields.copy()
+        match_fields.update(bind_fields)
+        return parser.OFPMatch(**match_fields)
+
+
+def compile_acl(rules, priority, allow_table):
+    """Return the ACLRules for an ACL's rule configs.
+
+    Rules are given decreasing priorities from priority. Packets
+    allowed by a rule go to allow_table.
+    """
+    acl_rules = []
+    allow_inst = parser.OFPInstructionGotoTable(allow_table)
+    for rule_conf in rules:
+        acl_inst = []
+        match_dict = {}
+        for attrib, attrib_value in rule_conf.iteritems():
+            if attrib == 'actions':
+                if 'mirror' in attrib_value:
+                    port_no = attrib_value['mirror']
+                    acl_inst.append(parser.OFPInstructionActions(
+                        ofp.OFPIT_APPLY_ACTIONS,
+                        [parser.OFPActionOutput(port_no)]))
+                if attrib_value['allow'] == 1:
+                    acl_inst.append(allow_inst)
+                continue
+            # in_port is always bound to the port the ACL is applied to.
+            if attrib == 'in_port':
+                continue
+            match_dict[attrib] = attrib_value
+        # this uses the old API, which is oh so convenient
+        # (transparently handling masks for example).
+        acl_match = ofctl.to_match(NULL_DP, match_dict)
+        acl_rules.append(
+            ACLRule(priority, dict(acl_match.items()), acl_inst))
+        priority -= 1
+    return acl_rules
@@ -17,15 +17,24 @@ import copy
 import logging
 import yaml
 
+from collections import namedtuple
+
+from acl import compile_acl
 from vlan import VLAN
 from port import Port
 
+# Port numbers and VIDs whose config differs between two DPs.
+ConfigChanges = namedtuple('ConfigChanges', (
+    'deleted_ports', 'changed_ports', 'added_ports',
+    'deleted_vlans', 'changed_vlans', 'added_vlans'))
+
 
 class DP(object):
     """Object to hold the configuration for a faucet controlled datapath."""
 
     dp_id = None
     acls = None
+    acl_rules = None
     vlans = None
     ports = None
     running = False
@@ -34,8 +43,12 @@ class DP(object):
     def __init__(self, dp_id, logname):
         self.dp_id = dp_id
         self.acls = {}
+        self.acl_rules = {}
         self.vlans = {}
         self.ports = {}
+        # port number -> native VLAN, and port number -> tagged VLANs.
+        self.port_native_vlan = {}
+        self.port_tagged_vlans = {}
         self.mirror_from_port = {}
         self.acl_in = {}
         self.logger = logging.getLogger(logname)
@@ -142,6 +155,13 @@ class DP(object):
         self.__dict__.setdefault('hardware', 'Open_vSwitch')
         # Whether to use influxdb for stats
         self.__dict__.setdefault('influxdb_stats', False)
+        # Seconds during which packet-ins from a host just learned on a
+        # port are not learned again
+        self.__dict__.setdefault('learn_holddown', 2)
+        # Packet-ins handled per port per second (0 for no limit), and
+        # at once
+        self.__dict__.setdefault('packet_in_rate', 100)
+        self.__dict__.setdefault('packet_in_burst', 200)
         # ARP and neighbor timeout (seconds)
         self.__dict__.setdefault('arp_neighbor_timeout', 500)
         # OF channel log
@@ -150,6 +170,9 @@ class DP(object):
     def add_acl(self, acl_num, acl_conf=None):
         if acl_conf is not None:
             self.acls[acl_num] = [x['rule'] for x in acl_conf]
+            self.acl_rules[acl_num] = compile_acl(
+                self.acls[acl_num], self.highest_priority,
+                self.eth_src_table)
 
     def add_port(self, port_num, port_conf=None):
         # add port specific vlans or fall back to defaults
@@ -170,14 +193,20 @@ class DP(object):
             vid = port_conf['native_vlan']
             if vid not in self.vlans:
                 self.vlans[vid] = VLAN(vid)
-            self.vlans[vid].untagged.append(self.ports[port_num])
+            vlan = self.vlans[vid]
+            vlan.add_untagged(port)
+            self.port_native_vlan[port_num] = vlan
 
         # add vlans
         port_conf.setdefault('tagged_vlans', [])
         for vid in port_conf['tagged_vlans']:
             if vid not in self.vlans:
                 self.vlans[vid] = VLAN(vid)
-            self.vlans[vid].tagged.append(port)
+            vlan = self.vlans[vid]
+            vlan.add_tagged(port)
+            tagged_vlans = self.port_tagged_vlans.setdefault(port_num, [])
+            if vlan not in tagged_vlans:
+                tagged_vlans.append(vlan)
 
         # add ACL
         port_conf.setdefault('acl_in', None)
@@ -189,17 +218,95 @@ class DP(object):
 
         self.vlans.setdefault(vid, VLAN(vid, vlan_conf))
 
+    def delete_port(self, port_num):
+        """Remove a port and its VLAN memberships."""
+        del self.ports[port_num]
+        for vlan in self.port_vlans(port_num):
+            vlan.remove_port(port_num)
+        self.port_native_vlan.pop(port_num, None)
+        self.port_tagged_vlans.pop(port_num, None)
+
     def get_native_vlan(self, port_num):
-        if port_num not in self.ports:
-            return None
+        return self.port_native_vlan.get(port_num)
+
+    def get_tagged_vlans(self, port_num):
+        return self.port_tagged_vlans.get(port_num, [])
 
+    def port_vlans(self, port_num):
+        """Return the VLANs a port is in, tagged or not."""
+        native_vlan = self.get_native_vlan(port_num)
+        vlans = list(self.get_tagged_vlans(port_num))
+        if native_vlan is not None:
+            vlans.append(native_vlan)
+        return vlans
+
+    def acl_mirror_ports(self):
+        """Return the ports ACL rules mirror packets to."""
+        mirror_ports = set()
+        for acl in self.acls.itervalues():
+            for rule_conf in acl:
+                actions = rule_conf.get('actions', {})
+                if 'mirror' in actions:
+                    mirror_ports.add(actions['mirror'])
+        return mirror_ports
+
+    def port_config(self, port_num):
+        """Return the config that a port's flows depend on."""
         port = self.ports[port_num]
+        native_vlan = self.get_native_vlan(port_num)
+        acl_num = self.acl_in.get(port_num)
+        return (
+            port.enabled,
+            port.permanent_learn,
+            port.unicast_flood,
+            native_vlan.vid if native_vlan is not None else None,
+            sorted(vlan.vid for vlan in self.get_tagged_vlans(port_num)),
+            acl_num,
+            self.acls.get(acl_num) if acl_num is not None else None,
+            self.mirror_from_port.get(port_num),
+            port_num in self.mirror_from_port.values(),
+            port_num in self.acl_mirror_ports())
 
-        for vlan in self.vlans.values():
-            if port in vlan.untagged:
-                return vlan
+    def vlan_config(self, vid):
+        """Return the config that a VLAN's flows and learned hosts
+        depend on."""
+        vlan = self.vlans[vid]
+        return (
+            vlan.controller_ips,
+            vlan.unicast_flood,
+            vlan.ipv4_routes,
+            vlan.ipv6_routes,
+            vlan.max_hosts,
+            sorted(port.number for port in vlan.tagged),
+            sorted(port.number for port in vlan.untagged))
 
-        return None
+    def dp_config(self):
+        """Return the DP wide config (tables, priorities, timeouts...)."""
+        return dict(
+            (attr, value) for attr, value in self.__dict__.iteritems()
+            if attr not in (
+                'acls', 'acl_rules', 'vlans', 'ports', 'port_native_vlan',
+                'port_tagged_vlans', 'mirror_from_port', 'acl_in',
+                'logger', 'running'))
+
+    def config_changes(self, new_dp):
+        """Return the ports and VLANs whose config is different in
+        new_dp, as ConfigChanges, or None if DP wide config changed."""
+        if self.dp_config() != new_dp.dp_config():
+            return None
+        changes = []
+        for old_items, new_items, item_config in (
+                (self.ports, new_dp.ports, 'port_config'),
+                (self.vlans, new_dp.vlans, 'vlan_config')):
+            old_keys = set(old_items)
+            new_keys = set(new_items)
+            changed = set(
+                key for key in old_keys & new_keys
+                if (getattr(self, item_config)(key) !=
+                    getattr(new_dp, item_config)(key)))
+            changes.extend(
+                (old_keys - new_keys, changed, new_keys - old_keys))
+        return ConfigChanges(*changes)
 
     def __str__(self):
         return self.name
@@ -15,10 +15,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import itertools
 import os, signal, logging
+import time
 
 from logging.handlers import TimedRotatingFileHandler
 
+from ofbatch import send_msgs
+from packet_fields import parse_packet_in
 from valve import valve_factory
 from util import kill_on_exception
 from dp import DP
@@ -30,13 +34,11 @@ from ryu.controller.handler import CONFIG_DISPATCHER
 from ryu.controller.handler import MAIN_DISPATCHER
 from ryu.controller.handler import set_ev_cls
 from ryu.controller import event
-from ryu.ofproto import ofproto_v1_3, ether
-from ryu.lib.packet import packet
-from ryu.lib.packet import ethernet
-from ryu.lib.packet import vlan
+from ryu.ofproto import ofproto_v1_3
 from ryu.lib import hub
 
-from nsodbc import nsodbc_factory
+from nsodbc import nsodbc_factory, CachedDatabase
+from flowdb import FlowDBWriter
 
 
 class EventFaucetReconfigure(event.EventBase):
@@ -112,33 +114,47 @@ class Faucet(app_manager.RyuApp):
             self.logger.error("Hardware type not supported")
 	
         self.nsodbc = nsodbc_factory()
-        self.conn = self.nsodbc.connect('driver=couchdb;server=localhost;' + \
-                        'uid=root;pwd=admin')
-        try:
-            self.switch_database = self.conn.create('switches_bak')
-        except Exception, e:
-            self.switch_database = self.conn['switches_bak']
-            if not self.switch_database:
-                raise 
-        
-        self.conn1 = self.nsodbc.connect('driver=couchdb;server=localhost;' + \
-                        'uid=root;pwd=admin')
-        try:
-            self.flow_database = self.conn1.create('flows_bak')
-        except Exception, e:
-            self.flow_database = self.conn1['flows_bak']
-            if not self.flow_database:
-                raise 
-
-        self.gateway_resolve_request_thread = hub.spawn(
-            self.gateway_resolve_request)
+        # One connection (and connection pool) for both databases.
+        self.db_connection = os.getenv(
+            'FAUCET_DB_CONNECTION',
+            'driver=couchdb;server=localhost;uid=root;pwd=admin')
+        self.conn = self.nsodbc.connect(self.db_connection)
+        self.switch_database = self.conn.create('switches_bak')
+        # Flow queries are cached, and the cache kept coherent by
+        # following the flow database's changes feed.
+        self.flow_database = CachedDatabase(
+            self.conn.create('flows_bak'),
+            size=int(os.getenv('FAUCET_DB_CACHE_SIZE', 1024)))
+        self.flow_cache_thread = hub.spawn(self.flow_database.follow_changes)
+
+        # Flows are written to the database behind the OpenFlow send path.
+        self.flow_writer = FlowDBWriter(
+            self.switch_database, self.flow_database, self.logname,
+            batch_size=int(os.getenv('FAUCET_DB_BATCH_SIZE', 100)),
+            flush_interval=float(os.getenv('FAUCET_DB_FLUSH_INTERVAL', 1)),
+            queue_size=int(os.getenv('FAUCET_DB_QUEUE_SIZE', 10000)),
+            put_timeout=float(os.getenv('FAUCET_DB_PUT_TIMEOUT', 0.01)))
+        self.flow_writer.create_views()
+        self.flow_writer.set_dp(dp)
+        self.flow_writer_thread = hub.spawn(self.flow_writer.run)
+
+        self.bundle_ids = itertools.count(1)
+
+        # gateways are resolved when they are due, by a timer.
+        self.gateway_resolve_timer = None
         self.host_expire_request_thread = hub.spawn(
             self.host_expire_request)
 
-    def gateway_resolve_request(self):
-        while True:
-            self.send_event('Faucet', EventFaucetResolveGateways())
-            hub.sleep(2)
+    def schedule_resolve_gateways(self):
+        """Resolve gateways again when the next gateway is due."""
+        if self.gateway_resolve_timer is not None:
+            hub.kill(self.gateway_resolve_timer)
+            self.gateway_resolve_timer = None
+        next_resolve_time = self.valve.next_resolve_time()
+        if next_resolve_time is not None:
+            self.gateway_resolve_timer = hub.spawn_after(
+                max(next_resolve_time - time.time(), 0),
+                self.send_event, 'Faucet', EventFaucetResolveGateways())
 
     def host_expire_request(self):
         while True:
@@ -155,23 +171,15 @@ class Faucet(app_manager.RyuApp):
                 self.logger.exception("Error in config file:")
         return None
 
-    def send_flow_msgs(self, dp, flow_msgs):        
+    def send_flow_msgs(self, dp, flow_msgs, atomic=False):
+        """Send flow_msgs to dp in one write, in a bundle if atomic and
+        the hardware supports bundles."""
         self.valve.ofchannel_log(flow_msgs)
-        switch = None
-        try:
-            rows = self.switch_database.get_docs('_design/switches/_view/switch', key=str(hex(dp.id)))
-            switch = rows[0]
-        except:
-            # switch event not triggered yet
-            switch = None
-        for flow_msg in flow_msgs:
-            flow_msg.datapath = dp
-            dp.send_msg(flow_msg)
-            flow_object = {'data':flow_msg.to_jsondict(), 'tags': []}
-            flow_id = self.flow_database.insert_update_doc(flow_object, '')
-            if switch:
-                switch.value['data']['flows'].append(flow_id)
-                self.switch_database.insert_update_doc(switch.value, 'data')
+        bundle_id = None
+        if atomic and self.valve.use_bundles:
+            bundle_id = next(self.bundle_ids)
+        send_msgs(dp, flow_msgs, bundle_id)
+        self.flow_writer.add_flows(dp.id, flow_msgs)
 
     def signal_handler(self, sigid, frame):
         if sigid == signal.SIGHUP:
@@ -183,8 +191,10 @@ class Faucet(app_manager.RyuApp):
         new_dp = self.parse_config(new_config_file, self.logname)
         if new_dp:
             flowmods = self.valve.reload_config(new_dp)
+            self.flow_writer.set_dp(self.valve.dp)
             ryudp = self.dpset.get(new_dp.dp_id)
             self.send_flow_msgs(ryudp, flowmods)
+            self.schedule_resolve_gateways()
 
     @set_ev_cls(EventFaucetResolveGateways, MAIN_DISPATCHER)
     def resolve_gateways(self, ev):
@@ -193,11 +203,15 @@ class Faucet(app_manager.RyuApp):
             if flowmods:
                 ryudp = self.dpset.get(self.valve.dp.dp_id)
                 self.send_flow_msgs(ryudp, flowmods)
+            self.schedule_resolve_gateways()
 
     @set_ev_cls(EventFaucetHostExpire, MAIN_DISPATCHER)
     def host_expire(self, ev):
         if self.valve is not None:
-            self.valve.host_expire()
+            flowmods = self.valve.host_expire()
+            if flowmods:
+                ryudp = self.dpset.get(self.valve.dp.dp_id)
+                self.send_flow_msgs(ryudp, flowmods)
 
     @set_ev_cls(ofp_event.EventOFPPacketIn, MAIN_DISPATCHER)
     @kill_on_exception(exc_logname)
@@ -206,19 +220,13 @@ class Faucet(app_manager.RyuApp):
         dp = msg.datapath
         self.valve.ofchannel_log([msg])
 
-        pkt = packet.Packet(msg.data)
-        eth_pkt = pkt.get_protocols(ethernet.ethernet)[0]
-        eth_type = eth_pkt.ethertype
-
-        if eth_type == ether.ETH_TYPE_8021Q:
-            # tagged packet
-            vlan_proto = pkt.get_protocols(vlan.vlan)[0]
-            vlan_vid = vlan_proto.vid
-        else:
+        # only tagged packets are handled.
+        pkt = parse_packet_in(msg.data)
+        if pkt is None:
             return
 
         in_port = msg.match['in_port']
-        flowmods = self.valve.rcv_packet(dp.id, in_port, vlan_vid, pkt)
+        flowmods = self.valve.rcv_packet(dp.id, in_port, pkt.vid, pkt)
         self.send_flow_msgs(dp, flowmods)
 
     @set_ev_cls(ofp_event.EventOFPErrorMsg, MAIN_DISPATCHER)
@@ -240,24 +248,19 @@ class Faucet(app_manager.RyuApp):
     def handler_connect_or_disconnect(self, ev):
         dp = ev.dp
 
-        switch_object = {'_id': str(hex(dp.id)), 'data':{'flows':[]}}
-        self.switch_database.insert_update_doc(switch_object, 'data')
-
         if not ev.enter:
             # Datapath down message
             self.logger.debug('DP %s disconnected' % str(dp.id))
             self.valve.datapath_disconnect(dp.id)
-
-            rows = self.switch_database.get_docs('_design/switches/_view/switch', key=str(hex(dp.id)))
-            switch = rows[0].value
-            for flow_id in switch['data']['flows']:
-                 self.flow_database.delete_doc(str(flow_id))
+            self.flow_writer.flush()
+            self.flow_writer.delete_flows(dp.id)
 
             # Delete switch from database
-            self.switch_database.delete_doc(str(hex(dp.id)))
+            self.flow_writer.switch_disconnect(dp.id)
             return
 
         self.logger.debug('DP %s connected' % str(dp.id))
+        self.flow_writer.switch_connect(dp.id)
         self.handler_datapath(dp)
 
     @set_ev_cls(dpset.EventDPReconnected, dpset.DPSET_EV_DISPATCHER)
@@ -271,7 +274,8 @@ class Faucet(app_manager.RyuApp):
         discovered_ports = [
             p.port_no for p in dp.ports.values() if p.state == 0]
         flowmods = self.valve.datapath_connect(dp.id, discovered_ports)
-        self.send_flow_msgs(dp, flowmods)
+        self.send_flow_msgs(dp, flowmods, atomic=True)
+        self.schedule_resolve_gateways()
 
     @set_ev_cls(ofp_event.EventOFPPortStatus, MAIN_DISPATCHER)
     @kill_on_exception(exc_logname)
@@ -0,0 +1,564 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import logging
+import time
+from Queue import Full
+
+from ryu.lib import hub
+from ryu.ofproto import ofproto_v1_3 as ofp
+from ryu.ofproto import ofproto_v1_3_parser as parser
+
+# Flow documents indexed by datapath and table, see couchdb_views.js.
+FLOWS_BY_DP_MAP = """function(doc) {
+	if(doc.dp_id){
+		emit([doc.dp_id, doc.table_id],
+		     {rev: doc._rev, match: doc.match, out_ports: doc.out_ports});
+	}
+}"""
+
+# Flow document ids by tag, see couchdb_views.js.
+TAG_IDS_MAP = """function(doc) {
+	if(doc.tags){
+		for(var tag in doc.tags){
+			emit(doc.tags[tag], null);
+		}
+	}
+}"""
+
+# Names used in table tags, by DP table attribute.
+TABLE_NAMES = (
+    ('vlan_table', 'vlan'),
+    ('acl_table', 'acl'),
+    ('eth_src_table', 'eth_src'),
+    ('eth_dst_table', 'eth_dst'),
+    ('flood_table', 'flood'),
+)
+
+FLOW_UPSERT_COMMANDS = (
+    ofp.OFPFC_ADD, ofp.OFPFC_MODIFY, ofp.OFPFC_MODIFY_STRICT)
+
+
+def dp_key(dp_id):
+    return str(hex(dp_id))
+
+
+def flow_match(match):
+    """Return an OFPMatch as a plain dict, masked fields as [value, mask]."""
+    match_dict = {}
+    for field, value in match.items():
+        if isinstance(value, tuple):
+            value = list(value)
+        match_dict[field] = value
+    return match_dict
+
+
+def flow_out_ports(flow_msg):
+    """Return the ports a flowmod outputs to."""
+    out_ports = []
+    for inst in flow_msg.instructions:
+        for action in getattr(inst, 'actions', []):
+            if isinstance(action, parser.OFPActionOutput):
+                out_ports.append(action.port)
+    return out_ports
+
+
+def flow_tags(table_id, match_dict, out_ports, dp=None):
+    """Return the tags of a flow.
+
+    Flows are tagged with their table ('table:eth_dst', or 'table:3'
+    without the DP config), VLAN ('vlan:100'), input and output ports
+    ('in_port:1', 'out_port:2'), exact source and destination MACs
+    ('eth_src:0e:00:00:00:00:01') and the ACL applied on the input
+    port, or the shared ACL the flow belongs to ('acl:1').
+    """
+    table_name = table_id
+    if dp is not None:
+        for table_attr, name in TABLE_NAMES:
+            if getattr(dp, table_attr, None) == table_id:
+                table_name = name
+                break
+    tags = ['table:%s' % table_name]
+    vid = match_dict.get('vlan_vid')
+    if isinstance(vid, int) and vid & ofp.OFPVID_PRESENT:
+        tags.append('vlan:%u' % (vid & ~ofp.OFPVID_PRESENT))
+    in_port = match_dict.get('in_port')
+    if in_port is not None:
+        tags.append('in_port:%u' % in_port)
+    for out_port in out_ports:
+        if out_port <= ofp.OFPP_MAX:
+            tags.append('out_port:%u' % out_port)
+    for field in ('eth_src', 'eth_dst'):
+        eth_addr = match_dict.get(field)
+        if isinstance(eth_addr, basestring):
+            tags.append('%s:%s' % (field, eth_addr))
+    if dp is not None and table_id == dp.acl_table:
+        metadata = match_dict.get('metadata')
+        if in_port in dp.acl_in:
+            tags.append('acl:%s' % dp.acl_in[in_port])
+        elif isinstance(metadata, (list, tuple)):
+            # a shared ACL, matching (acl_num, mask).
+            tags.append('acl:%s' % metadata[0])
+    return tags
+
+
+# Flowmod fields stored only when they differ from OFPFlowMod's
+# defaults.
+FLOW_MOD_DEFAULTS = (
+    ('command', ofp.OFPFC_ADD),
+    ('cookie_mask', 0),
+    ('buffer_id', ofp.OFP_NO_BUFFER),
+    ('out_port', 0),
+    ('out_group', 0),
+    ('flags', 0),
+)
+
+
+def from_jsondict(jsondict, **kwargs):
+    """Return the Ryu object of a to_jsondict() dict (messages also
+    need datapath passed in kwargs)."""
+    (cls_name, body), = jsondict.items()
+    return getattr(parser, cls_name).from_jsondict(body, **kwargs)
+
+
+def encode_action(action):
+    """Return an action as a short list: [code, args...]."""
+    if isinstance(action, parser.OFPActionOutput):
+        if action.max_len != ofp.OFPCML_MAX:
+            return ['out', action.port, action.max_len]
+        return ['out', action.port]
+    if isinstance(action, parser.OFPActionSetField):
+        value = action.value
+        if isinstance(value, tuple):
+            value = list(value)
+        return ['set', action.key, value]
+    if isinstance(action, parser.OFPActionPushVlan):
+        return ['push_vlan', action.ethertype]
+    if isinstance(action, parser.OFPActionPopVlan):
+        return ['pop_vlan']
+    if isinstance(action, parser.OFPActionDecNwTtl):
+        return ['dec_ttl']
+    if isinstance(action, parser.OFPActionGroup):
+        return ['group', action.group_id]
+    if isinstance(action, parser.OFPActionSetQueue):
+        return ['queue', action.queue_id]
+    # anything else is kept in Ryu's JSON form.
+    return ['json', action.to_jsondict()]
+
+
+def decode_action(code):
+    name, args = code[0], code[1:]
+    if name == 'out':
+        return parser.OFPActionOutput(*args)
+    if name == 'set':
+        field, value = args
+        if isinstance(value, list):
+            value = tuple(value)
+        return parser.OFPActionSetField(**{field: value})
+    if name == 'push_vlan':
+        return parser.OFPActionPushVlan(*args)
+    if name == 'pop_vlan':
+        return parser.OFPActionPopVlan()
+    if name == 'dec_ttl':
+        return parser.OFPActionDecNwTtl()
+    if name == 'group':
+        return parser.OFPActionGroup(*args)
+    if name == 'queue':
+        return parser.OFPActionSetQueue(*args)
+    return from_jsondict(args[0])
+
+
+def encode_instruction(inst):
+    """Return an instruction as a short list: [code, args...]."""
+    if isinstance(inst, parser.OFPInstructionGotoTable):
+        return ['goto', inst.table_id]
+    if isinstance(inst, parser.OFPInstructionActions):
+        code = {
+            ofp.OFPIT_APPLY_ACTIONS: 'apply',
+            ofp.OFPIT_WRITE_ACTIONS: 'write',
+            ofp.OFPIT_CLEAR_ACTIONS: 'clear',
+        }[inst.type]
+        return [code] + [encode_action(action) for action in inst.actions]
+    if isinstance(inst, parser.OFPInstructionWriteMetadata):
+        return ['meta', inst.metadata, inst.metadata_mask]
+    if isinstance(inst, parser.OFPInstructionMeter):
+        return ['meter', inst.meter_id]
+    return ['json', inst.to_jsondict()]
+
+
+def decode_instruction(code):
+    name, args = code[0], code[1:]
+    if name == 'goto':
+        return parser.OFPInstructionGotoTable(*args)
+    if name in ('apply', 'write', 'clear'):
+        inst_type = {
+            'apply': ofp.OFPIT_APPLY_ACTIONS,
+            'write': ofp.OFPIT_WRITE_ACTIONS,
+            'clear': ofp.OFPIT_CLEAR_ACTIONS,
+        }[name]
+        return parser.OFPInstructionActions(
+            inst_type, [decode_action(action) for action in args])
+    if name == 'meta':
+        return parser.OFPInstructionWriteMetadata(*args)
+    if name == 'meter':
+        return parser.OFPInstructionMeter(*args)
+    return from_jsondict(args[0])
+
+
+def flow_encode(flow_msg):
+    """Return a flowmod in the compact flow document schema.
+
+    Table, priority, cookie and timeouts are top level fields, the
+    match is flat (see flow_match), and instructions and actions are
+    short lists such as ['apply', ['set', 'vlan_vid', 4196], ['out', 1]].
+    Other flowmod fields are only present when not the default.
+    flow_decode reverses this.
+    """
+    flow = {
+        'table_id': flow_msg.table_id,
+        'priority': flow_msg.priority,
+        'cookie': flow_msg.cookie,
+        'idle_timeout': flow_msg.idle_timeout,
+        'hard_timeout': flow_msg.hard_timeout,
+        'match': flow_match(flow_msg.match),
+        'inst': [encode_instruction(inst)
+                 for inst in flow_msg.instructions],
+    }
+    for field, default in FLOW_MOD_DEFAULTS:
+        value = getattr(flow_msg, field)
+        if value != default:
+            flow[field] = value
+    return flow
+
+
+def flow_decode(flow, datapath=None):
+    """Return the OFPFlowMod of a compact flow document."""
+    match = {}
+    for field, value in flow['match'].iteritems():
+        if isinstance(value, list):
+            value = tuple(value)
+        match[str(field)] = value
+    kwargs = dict(
+        (field, flow.get(field, default))
+        for field, default in FLOW_MOD_DEFAULTS)
+    return parser.OFPFlowMod(
+        datapath=datapath,
+        table_id=flow['table_id'],
+        priority=flow['priority'],
+        cookie=flow['cookie'],
+        idle_timeout=flow['idle_timeout'],
+        hard_timeout=flow['hard_timeout'],
+        match=parser.OFPMatch(**match),
+        instructions=[decode_instruction(inst) for inst in flow['inst']],
+        **kwargs)
+
+
+def flow_doc_id(dp_id, table_id, priority, match_dict):
+    """Return the document id of a flow.
+
+    A flow is identified in a switch by table, priority and match, so
+    the same flow always maps to the same document.
+    """
+    match_key = json.dumps(sorted(match_dict.items()))
+    return '%s-%u-%u-%s' % (
+        dp_key(dp_id), table_id, priority,
+        hashlib.sha1(match_key).hexdigest())
+
+
+def flow_del_matches(flow_del, table_id, match_dict, out_ports):
+    """Return True if a stored flow would be removed by a non-strict
+    delete, whose (table_id, match, out_port) are given by flow_del."""
+    del_table_id, del_match_dict, del_out_port = flow_del
+    if del_table_id not in (ofp.OFPTT_ALL, table_id):
+        return False
+    for field, value in del_match_dict.iteritems():
+        if match_dict.get(field) != value:
+            return False
+    if del_out_port != ofp.OFPP_ANY and del_out_port not in out_ports:
+        return False
+    return True
+
+
+class FlowDBWriter(object):
+    """Write-behind persistence of flowmods to the flow/switch databases.
+
+    Flowmods are queued by the OpenFlow send path and written to the
+    database in batches by a separate green thread, so a slow or
+    unavailable database never delays messages to the switch.
+    """
+
+    def __init__(self, switch_database, flow_database, logname='faucet',
+                 batch_size=100, flush_interval=1.0, queue_size=10000,
+                 put_timeout=0.01):
+        """
+        Arguments:
+        batch_size -- maximum flowmods written per bulk request.
+        flush_interval -- maximum seconds a queued flowmod waits to be
+            written.
+        queue_size -- maximum number of flowmods waiting to be written.
+        put_timeout -- seconds the send path will wait for queue space
+            (back-pressure) before dropping a flowmod.
+        """
+        self.switch_database = switch_database
+        self.flow_database = flow_database
+        self.logger = logging.getLogger(logname)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.flows_by_dp_view = None
+        self.tag_ids_view = None
+        # DP config, used to name tables and ACLs in flow tags.
+        self.dp = None
+        # switch documents (with their current revision) of connected
+        # datapaths, by dp_id.
+        self.switches = {}
+        self.queue = hub.Queue(queue_size)
+        # flowmods taken from the queue and not yet written: the batch
+        # being gathered or written, or one kept to retry. The list is
+        # only ever changed in place, so flush sees the writer thread's
+        # batch.
+        self.pending = []
+        # held while writing, so flush waits for a write in progress.
+        self.write_lock = hub.Semaphore()
+        self.stats = {
+            'queued': 0,
+            'written': 0,
+            'batches': 0,
+            'overflows': 0,
+            'dropped': 0,
+            'write_errors': 0,
+        }
+        self._reported_drops = 0
+
+    def add_flows(self, dp_id, flow_msgs):
+        """Queue flowmods sent to datapath dp_id for writing.
+
+        The send path waits for queue space at most put_timeout per
+        call: once a wait times out, the rest of flow_msgs that do not
+        fit are dropped without waiting."""
+        timed_out = False
+        for flow_msg in flow_msgs:
+            item = (dp_id, flow_msg)
+            try:
+                self.queue.put(item, block=False)
+            except Full:
+                self.stats['overflows'] += 1
+                if timed_out:
+                    self.stats['dropped'] += 1
+                    continue
+                try:
+                    self.queue.put(item, timeout=self.put_timeout)
+                except Full:
+                    timed_out = True
+                    self.stats['dropped'] += 1
+                    continue
+            self.stats['queued'] += 1
+
+    def _get_batch(self):
+        """Block until a batch is ready: either batch_size flowmods are
+        queued, or flush_interval has passed since the first one."""
+        batch = self.pending
+        if not batch:
+            try:
+                batch.append(self.queue.get(timeout=self.flush_interval))
+            except hub.QueueEmpty:
+                return batch
+        deadline = time.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            if self.queue.qsize():
+                batch.append(self.queue.get(block=False))
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except hub.QueueEmpty:
+                break
+        return batch
+
+    def create_views(self):
+        """Make sure the views used to index flows exist."""
+        self.flows_by_dp_view = self.flow_database.create_view(
+            'flows', 'dp', FLOWS_BY_DP_MAP)
+        self.tag_ids_view = self.flow_database.create_view(
+            'tags', 'ids', TAG_IDS_MAP)
+
+    def set_dp(self, dp):
+        """Use the config of a (re)loaded DP to tag flows written from
+        now on."""
+        self.dp = dp
+
+    def get_flow_ids(self, tags):
+        """Return the ids of the stored flows that have all of tags."""
+        return self.flow_database.get_doc_ids_all(self.tag_ids_view, tags)
+
+    def switch_connect(self, dp_id):
+        """Write the switch document of a newly connected datapath.
+
+        The document is kept here with its revision, so later updates
+        are written directly, without looking the document up first.
+        """
+        switch = self.switches.get(dp_id)
+        if switch is None:
+            switch = {'_id': dp_key(dp_id), 'data': {}}
+            # left over from a previous run.
+            rev = self.switch_database.get_revs([switch['_id']]).get(
+                switch['_id'])
+            if rev is not None:
+                switch['_rev'] = rev
+        self.switch_database.insert_update_docs([switch])
+        self.switches[dp_id] = switch
+
+    def switch_disconnect(self, dp_id):
+        """Delete the switch document of a disconnected datapath."""
+        switch = self.switches.pop(dp_id, None)
+        if switch is None:
+            switch = {'_id': dp_key(dp_id)}
+        self.switch_database.delete_docs([switch])
+
+    def flow_doc(self, dp_id, flow_msg):
+        """Return the document of a flow, in the compact schema of
+        flow_encode."""
+        doc = flow_encode(flow_msg)
+        doc['out_ports'] = flow_out_ports(flow_msg)
+        doc['_id'] = flow_doc_id(
+            dp_id, doc['table_id'], doc['priority'], doc['match'])
+        doc['dp_id'] = dp_key(dp_id)
+        doc['tags'] = flow_tags(
+            doc['table_id'], doc['match'], doc['out_ports'], self.dp)
+        return doc
+
+    def _write_batch(self, batch):
+        """Apply a batch of flowmods to the flow database.
+
+        Flow documents have deterministic ids, so adds and modifies are
+        upserts and deletes remove the documents of the deleted flows.
+        Flowmods are coalesced in order, so a flow deleted and re-added
+        within the batch is written once. The batch costs one bulk
+        write, one bulk delete, and one view query per datapath with
+        non-strict deletes.
+        """
+        # doc id -> flow document to write, or None to delete.
+        flow_ops = {}
+        flow_dels = {}
+        for dp_id, flow_msg in batch:
+            if not isinstance(flow_msg, parser.OFPFlowMod):
+                continue
+            if flow_msg.command in FLOW_UPSERT_COMMANDS:
+                doc = self.flow_doc(dp_id, flow_msg)
+                flow_ops[doc['_id']] = doc
+            elif flow_msg.command == ofp.OFPFC_DELETE_STRICT:
+                match_dict = flow_match(flow_msg.match)
+                flow_ops[flow_doc_id(
+                    dp_id, flow_msg.table_id, flow_msg.priority,
+                    match_dict)] = None
+            elif flow_msg.command == ofp.OFPFC_DELETE:
+                flow_del = (
+                    flow_msg.table_id,
+                    flow_match(flow_msg.match),
+                    flow_msg.out_port)
+                flow_dels.setdefault(dp_id, []).append(flow_del)
+                for doc_id, doc in flow_ops.iteritems():
+                    if (doc is not None and doc['dp_id'] == dp_key(dp_id) and
+                            flow_del_matches(flow_del, doc['table_id'],
+                                             doc['match'], doc['out_ports'])):
+                        flow_ops[doc_id] = None
+
+        # stored flows removed by non-strict deletes, unless they were
+        # added again after the delete.
+        del_docs = {}
+        for dp_id, dp_flow_dels in flow_dels.iteritems():
+            rows = self.flow_database.get_docs(
+                self.flows_by_dp_view,
+                startkey=[dp_key(dp_id)], endkey=[dp_key(dp_id), {}])
+            for row in rows:
+                if flow_ops.get(row.id) is not None:
+                    continue
+                for flow_del in dp_flow_dels:
+                    if flow_del_matches(flow_del, row.key[1],
+                                        row.value['match'],
+                                        row.value['out_ports']):
+                        del_docs[row.id] = {
+                            '_id': row.id, '_rev': row.value['rev']}
+                        break
+        for doc_id, doc in flow_ops.iteritems():
+            if doc is None and doc_id not in del_docs:
+                del_docs[doc_id] = {'_id': doc_id}
+
+        self.flow_database.insert_update_docs(
+            [doc for doc in flow_ops.itervalues() if doc is not None])
+        self.flow_database.delete_docs(del_docs.values())
+        self.stats['written'] += len(batch)
+        self.stats['batches'] += 1
+
+    def delete_flows(self, dp_id):
+        """Delete all stored flows of a datapath, with one view query and
+        one bulk delete."""
+        rows = self.flow_database.get_docs(
+            self.flows_by_dp_view,
+            startkey=[dp_key(dp_id)], endkey=[dp_key(dp_id), {}])
+        self.flow_database.delete_docs(
+            [{'_id': row.id, '_rev': row.value['rev']} for row in rows])
+
+    def _write_pending(self):
+        """Write the pending flowmods, and return True if they were
+        written. Flowmods that could not be written stay pending, to be
+        retried."""
+        batch = self.pending[:self.batch_size]
+        try:
+            self._write_batch(batch)
+        except Exception:
+            self.stats['write_errors'] += 1
+            self.logger.exception('Could not write flows to database')
+            return False
+        del self.pending[:len(batch)]
+        return True
+
+    def flush(self):
+        """Write the batch the writer thread has taken, and all queued
+        flowmods, now, in the calling thread.
+
+        Stops at the first batch that cannot be written, leaving it for
+        the writer thread to retry."""
+        with self.write_lock:
+            while True:
+                while (len(self.pending) < self.batch_size and
+                       self.queue.qsize()):
+                    self.pending.append(self.queue.get(block=False))
+                if not self.pending or not self._write_pending():
+                    return
+
+    def _report_drops(self):
+        dropped = self.stats['dropped'] - self._reported_drops
+        if dropped:
+            self.logger.warning(
+                'flow database queue full, dropped %u flowmods (%u total)',
+                dropped, self.stats['dropped'])
+            self._reported_drops = self.stats['dropped']
+
+    def run(self):
+        """Writer thread main loop."""
+        while True:
+            batch = self._get_batch()
+            self._report_drops()
+            if not batch:
+                continue
+            with self.write_lock:
+                # flush may have written the batch already.
+                written = not self.pending or self._write_pending()
+            if not written:
+                # the batch is retried, so that a database outage only
+                # costs queue space (and then drops), never blocks.
+                hub.sleep(self.flush_interval)
@@ -0,0 +1,196 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from ryu.ofproto import ofproto_v1_3 as ofp
+from ryu.ofproto import ofproto_v1_3_parser as parser
+
+from flowdb import encode_instruction, flow_del_matches, flow_match
+from flowdb import flow_out_ports
+
+
+def match_key(match):
+    """Return a hashable key for an OFPMatch."""
+    return tuple(sorted(
+        (field, tuple(value) if isinstance(value, list) else value)
+        for field, value in flow_match(match).iteritems()))
+
+
+def flow_key(flow_msg):
+    """Return the key identifying a flow in a switch: table, priority
+    and match."""
+    return (flow_msg.table_id, flow_msg.priority, match_key(flow_msg.match))
+
+
+def flow_instructions(flow_msg):
+    return [encode_instruction(inst) for inst in flow_msg.instructions]
+
+
+def copy_flowmod(flow_msg, command, instructions=None):
+    """Return a new flowmod for the flow of flow_msg.
+
+    A new message is always made, as messages that were already sent
+    cannot be sent again.
+    """
+    if instructions is None:
+        instructions = flow_msg.instructions
+    out_port = 0
+    out_group = 0
+    if command in (ofp.OFPFC_DELETE, ofp.OFPFC_DELETE_STRICT):
+        out_port = ofp.OFPP_ANY
+        out_group = ofp.OFPG_ANY
+    return parser.OFPFlowMod(
+        datapath=None,
+        cookie=flow_msg.cookie,
+        command=command,
+        table_id=flow_msg.table_id,
+        priority=flow_msg.priority,
+        out_port=out_port,
+        out_group=out_group,
+        match=flow_msg.match,
+        instructions=instructions,
+        hard_timeout=flow_msg.hard_timeout,
+        idle_timeout=flow_msg.idle_timeout)
+
+
+class FlowTable(object):
+    """Model of the flows programmed in a datapath.
+
+    Flows are indexed by (table, priority, match), as they are in the
+    switch, and are updated by applying flowmods with the same
+    semantics as the switch. diff() returns the flowmods that turn one
+    model into another.
+    """
+
+    def __init__(self, ofmsgs=None):
+        # flow key -> flowmod (always an add) of the flow.
+        self.flows = {}
+        # flow key -> (match dict, output ports), for non-strict
+        # modifies and deletes.
+        self.flow_matches = {}
+        # (field, value) -> keys of flows matching the field exactly.
+        self.field_index = {}
+        if ofmsgs is not None:
+            self.apply(ofmsgs)
+
+    def __len__(self):
+        return len(self.flows)
+
+    def __contains__(self, flow_msg):
+        return flow_key(flow_msg) in self.flows
+
+    def _add(self, key, flow_msg):
+        self._delete(key)
+        self.flows[key] = flow_msg
+        self.flow_matches[key] = (
+            flow_match(flow_msg.match), flow_out_ports(flow_msg))
+        for field_value in key[2]:
+            self.field_index.setdefault(field_value, set()).add(key)
+
+    def _delete(self, key):
+        if key in self.flows:
+            del self.flows[key]
+            del self.flow_matches[key]
+            for field_value in key[2]:
+                keys = self.field_index[field_value]
+                keys.discard(key)
+                if not keys:
+                    del self.field_index[field_value]
+
+    def keys_matching(self, field, value):
+        """Return the keys of flows that match field exactly to value."""
+        return set(self.field_index.get((field, value), ()))
+
+    def _matching_keys(self, flow_msg, out_port=ofp.OFPP_ANY):
+        """Return the keys of flows a non-strict modify or delete
+        applies to."""
+        match_dict = flow_match(flow_msg.match)
+        flow_del = (flow_msg.table_id, match_dict, out_port)
+        candidates = self.flow_matches
+        for field_value in match_key(flow_msg.match):
+            # only flows with every field of the match can match it.
+            candidates = self.field_index.get(field_value, ())
+            break
+        keys = []
+        for key in candidates:
+            flow_match_dict, out_ports = self.flow_matches[key]
+            if flow_del_matches(flow_del, key[0], flow_match_dict, out_ports):
+                keys.append(key)
+        return keys
+
+    def apply(self, ofmsgs):
+        """Update the model with the flowmods in ofmsgs, in order."""
+        for flow_msg in ofmsgs:
+            if not isinstance(flow_msg, parser.OFPFlowMod):
+                continue
+            command = flow_msg.command
+            if command == ofp.OFPFC_ADD:
+                self._add(flow_key(flow_msg), flow_msg)
+            elif command == ofp.OFPFC_DELETE_STRICT:
+                self._delete(flow_key(flow_msg))
+            elif command == ofp.OFPFC_DELETE:
+                for key in self._matching_keys(flow_msg, flow_msg.out_port):
+                    self._delete(key)
+            elif command in (ofp.OFPFC_MODIFY, ofp.OFPFC_MODIFY_STRICT):
+                if command == ofp.OFPFC_MODIFY_STRICT:
+                    keys = [flow_key(flow_msg)]
+                else:
+                    keys = self._matching_keys(flow_msg)
+                # modifies only change the instructions of existing flows.
+                for key in keys:
+                    if key in self.flows:
+                        self._add(key, copy_flowmod(
+                            self.flows[key], ofp.OFPFC_ADD,
+                            flow_msg.instructions))
+
+    def merge(self, keys, other):
+        """Replace the flows with keys by the flows of other."""
+        for key in keys:
+            self._delete(key)
+        for key, flow_msg in other.flows.iteritems():
+            self._add(key, flow_msg)
+
+    def diff(self, intended, readd=False, keys=None):
+        """Return the flowmods that change the flows of this model into
+        those of intended.
+
+        New flows are added and changed flows modified (strict), before
+        flows no longer intended are deleted (strict), so traffic is not
+        dropped while the switch is updated. Flows are added in reverse
+        table order, so a flow is only added once the tables it sends
+        packets to are ready. If readd is True, unchanged flows are
+        added again too (for switches that may have lost their flows).
+        If keys is given, only flows with those keys are compared.
+        """
+        ofmsgs = []
+        deletes = []
+        intended_keys = intended.flows.keys()
+        current_keys = self.flows.keys()
+        if keys is not None:
+            intended_keys = [key for key in keys if key in intended.flows]
+            current_keys = [key for key in keys if key in self.flows]
+        for key in sorted(intended_keys, reverse=True):
+            flow = intended.flows[key]
+            current = self.flows.get(key)
+            if current is None or readd:
+                ofmsgs.append(copy_flowmod(flow, ofp.OFPFC_ADD))
+            elif ((current.cookie, current.idle_timeout,
+                   current.hard_timeout) !=
+                  (flow.cookie, flow.idle_timeout, flow.hard_timeout)):
+                # a modify cannot change these.
+                ofmsgs.append(copy_flowmod(flow, ofp.OFPFC_ADD))
+            elif flow_instructions(current) != flow_instructions(flow):
+                ofmsgs.append(copy_flowmod(flow, ofp.OFPFC_MODIFY_STRICT))
+        for key in sorted(current_keys):
+            if key not in intended.flows:
+                deletes.append(copy_flowmod(
+                    self.flows[key], ofp.OFPFC_DELETE_STRICT))
+        return ofmsgs + deletes
@@ -0,0 +1,147 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact caches of the hosts and neighbors learned on a VLAN.
+
+A VLAN can learn many thousands of hosts, so cache entries have no
+instance __dict__, and MAC and IP addresses are stored as ints rather
+than as strings or ipaddr objects. The caches have the dict API of the
+plain dicts they replace, keyed by MAC strings or IP addresses.
+"""
+
+import abc
+import ipaddr
+
+from collections import MutableMapping
+
+
+def mac_to_int(mac):
+    """Return a MAC address string as a 48 bit int."""
+    return int(mac.replace(':', ''), 16)
+
+
+def int_to_mac(mac_int):
+    """Return the string of a MAC address stored as an int."""
+    mac_hex = '%012x' % mac_int
+    return ':'.join((
+        mac_hex[0:2], mac_hex[2:4], mac_hex[4:6],
+        mac_hex[6:8], mac_hex[8:10], mac_hex[10:12]))
+
+
+class LinkNeighbor(object):
+
+    __slots__ = ('mac', 'cache_time')
+
+    def __init__(self, eth_src, now):
+        self.mac = mac_to_int(eth_src)
+        self.cache_time = now
+
+    @property
+    def eth_src(self):
+        return int_to_mac(self.mac)
+
+
+class HostCacheEntry(object):
+
+    __slots__ = ('mac', 'permanent', 'cache_time')
+
+    def __init__(self, eth_src, permanent, now):
+        self.mac = mac_to_int(eth_src)
+        self.permanent = permanent
+        self.cache_time = now
+
+    @property
+    def eth_src(self):
+        return int_to_mac(self.mac)
+
+
+class IntKeyedCache(MutableMapping):
+    """A mapping whose keys are stored as ints. Subclasses define how
+    keys are encoded."""
+
+    def __init__(self):
+        self.entries = {}
+
+    @abc.abstractmethod
+    def encode_key(self, key):
+        """Return the int a key is stored as."""
+
+    @abc.abstractmethod
+    def decode_key(self, key_int):
+        """Return the key stored as key_int."""
+
+    def __getitem__(self, key):
+        return self.entries[self.encode_key(key)]
+
+    def __setitem__(self, key, value):
+        self.entries[self.encode_key(key)] = value
+
+    def __delitem__(self, key):
+        del self.entries[self.encode_key(key)]
+
+    def __contains__(self, key):
+        return self.encode_key(key) in self.entries
+
+    def __iter__(self):
+        for key_int in self.entries:
+            yield self.decode_key(key_int)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def get(self, key, default=None):
+        return self.entries.get(self.encode_key(key), default)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class HostCache(IntKeyedCache):
+    """HostCacheEntries keyed by MAC address strings."""
+
+    def encode_key(self, key):
+        return mac_to_int(key)
+
+    def decode_key(self, key_int):
+        return int_to_mac(key_int)
+
+
+class NeighborCache(IntKeyedCache):
+    """LinkNeighbors keyed by IP addresses of one version."""
+
+    def __init__(self, address_class):
+        super(NeighborCache, self).__init__()
+        self.address_class = address_class
+        self.version = address_class(0).version
+
+    def encode_key(self, key):
+        if isinstance(key, basestring):
+            key = self.address_class(key)
+        # an IPv4 and an IPv6 address can be the same int.
+        if key.version != self.version:
+            raise ValueError(
+                '%s is not an IPv%u address' % (key, self.version))
+        return int(key)
+
+    def decode_key(self, key_int):
+        return self.address_class(key_int)
+
+
+def arp_cache():
+    return NeighborCache(ipaddr.IPv4Address)
+
+
+def nd_cache():
+    return NeighborCache(ipaddr.IPv6Address)
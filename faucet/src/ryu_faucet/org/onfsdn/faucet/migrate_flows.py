@@ -0,0 +1,171 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Migrate a flows database from Ryu JSON flow documents to the compact
+flow schema (see flowdb.flow_encode).
+
+    python migrate_flows.py [--dry-run] \
+        'driver=couchdb;server=localhost;uid=root;pwd=admin' flows_bak \
+        [--switches switches_bak]
+
+Each flowmod document is replaced by a document with the id the flow
+writer gives the flow (see flowdb.flow_doc_id), and the dp_id of the
+switch document that lists it. Flowmods other than adds, and flows no
+switch lists, are left as they are. The document size before and
+after, and the time to write both versions of the documents to a
+scratch in-memory sqlite database, are reported.
+"""
+
+import argparse
+import json
+import time
+
+from ryu.ofproto import ofproto_v1_3 as ofp
+
+from flowdb import (
+    dp_key, flow_doc_id, flow_encode, flow_out_ports, flow_tags,
+    from_jsondict)
+from nsodbc import ConnectionSqlite, nsodbc_factory
+
+FLOWS_VIEW = '_design/flows/_view/flow'
+SWITCHES_VIEW = '_design/switches/_view/switch'
+
+
+def flow_dp_ids(switch_database):
+    """Return the dp_id of each flow document id the switch documents
+    list."""
+    dp_ids = {}
+    for row in switch_database.get_docs(SWITCHES_VIEW):
+        flow_ids = row.value.get('data', {}).get('flows', [])
+        dp_id = int(row.id.rstrip('L'), 16)
+        for flow_id in flow_ids:
+            dp_ids[flow_id] = dp_id
+    return dp_ids
+
+
+def migrate_doc(doc, dp_id):
+    """Return the compact schema document of a flow added to datapath
+    dp_id, or None if doc is already compact or is not a flow add."""
+    data = doc.get('data')
+    if not isinstance(data, dict) or data.keys() != ['OFPFlowMod']:
+        return None
+    if data['OFPFlowMod']['command'] != ofp.OFPFC_ADD:
+        return None
+    flow_msg = from_jsondict(data, datapath=None)
+    new_doc = flow_encode(flow_msg)
+    new_doc['out_ports'] = flow_out_ports(flow_msg)
+    new_doc['_id'] = flow_doc_id(
+        dp_id, new_doc['table_id'], new_doc['priority'], new_doc['match'])
+    new_doc['dp_id'] = dp_key(dp_id)
+    new_doc['tags'] = doc.get('tags') or flow_tags(
+        new_doc['table_id'], new_doc['match'], new_doc['out_ports'])
+    return new_doc
+
+
+def measure_writes(docs):
+    """Return the seconds taken to bulk write docs to a scratch
+    database."""
+    database = ConnectionSqlite(':memory:').create('flows')
+    docs = [dict((k, v) for k, v in doc.iteritems() if k != '_rev')
+            for doc in docs]
+    start = time.time()
+    database.insert_update_docs(docs)
+    return time.time() - start
+
+
+def migrate(database, switch_database, batch_size=500, dry_run=False):
+    """Migrate all flow documents of database, batch_size at a time, to
+    the datapaths of the switch documents of switch_database.
+
+    Each batch of new documents, and the deletes of the documents they
+    replace, is written with one bulk request.
+    Returns the migration stats.
+    """
+    dp_ids = flow_dp_ids(switch_database)
+    stats = {
+        'docs': 0,
+        'migrated': 0,
+        'skipped': 0,
+        'bytes_before': 0,
+        'bytes_after': 0,
+        'write_before': 0.0,
+        'write_after': 0.0,
+    }
+    page = None
+    while True:
+        rows, page = database.get_docs_page(FLOWS_VIEW, batch_size, page)
+        old_docs = []
+        new_docs = []
+        for row in rows:
+            stats['docs'] += 1
+            if 'data' not in row.value:
+                continue
+            dp_id = dp_ids.get(row.id)
+            new_doc = None
+            if dp_id is not None:
+                new_doc = migrate_doc(row.value, dp_id)
+            if new_doc is None:
+                stats['skipped'] += 1
+                continue
+            # measured with the same tags, so only the encoding differs.
+            old_docs.append(dict(row.value, tags=new_doc['tags']))
+            new_docs.append(new_doc)
+        if new_docs:
+            stats['migrated'] += len(new_docs)
+            stats['bytes_before'] += sum(
+                len(json.dumps(doc)) for doc in old_docs)
+            stats['bytes_after'] += sum(
+                len(json.dumps(doc)) for doc in new_docs)
+            stats['write_before'] += measure_writes(old_docs)
+            stats['write_after'] += measure_writes(new_docs)
+            if not dry_run:
+                # flows added more than once are written once.
+                write_docs = dict((doc['_id'], doc) for doc in new_docs)
+                database.insert_update_docs(
+                    write_docs.values() +
+                    [{'_id': doc['_id'], '_rev': doc['_rev'],
+                      '_deleted': True} for doc in old_docs])
+        if page is None:
+            return stats
+
+
+def main():
+    args_parser = argparse.ArgumentParser(
+        description='Migrate flow documents to the compact flow schema.')
+    args_parser.add_argument('connection', help='nsodbc connection string')
+    args_parser.add_argument('database', nargs='?', default='flows_bak')
+    args_parser.add_argument(
+        '--switches', default='switches_bak',
+        help='database of the switch documents that list the flows')
+    args_parser.add_argument('--batch-size', type=int, default=500)
+    args_parser.add_argument(
+        '--dry-run', action='store_true',
+        help='only measure, do not rewrite documents')
+    args = args_parser.parse_args()
+
+    conn = nsodbc_factory().connect(args.connection)
+    stats = migrate(
+        conn.create(args.database), conn.create(args.switches),
+        args.batch_size, args.dry_run)
+    print('%(migrated)u of %(docs)u documents migrated, '
+          '%(skipped)u skipped' % stats)
+    if stats['migrated']:
+        print('size: %u -> %u bytes (%.1f%%)' % (
+            stats['bytes_before'], stats['bytes_after'],
+            100.0 * stats['bytes_after'] / stats['bytes_before']))
+        print('write time: %.3f -> %.3f s (%.1f%%)' % (
+            stats['write_before'], stats['write_after'],
+            100.0 * stats['write_after'] / max(stats['write_before'], 1e-9)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Scheduling of ARP/ND resolution of the gateways routes use.
+
+Each gateway has a state, and a time it is next due to be resolved:
+
+INCOMPLETE -- never resolved. Resolved with exponential backoff until
+    it replies.
+REACHABLE -- replied less than the reachable time ago.
+PROBE -- its reachable time passed, and it is being resolved again.
+STALE -- it did not reply to max_probes probes. Its routes still use
+    its last known MAC, and it is resolved with exponential backoff.
+
+Only the gateways due are visited, so resolution costs nothing while
+no gateway is due, and the resolution traffic of a gateway that does
+not reply is bounded by the backoff.
+"""
+
+from util import ExpiryQueue
+
+INCOMPLETE = 'incomplete'
+REACHABLE = 'reachable'
+PROBE = 'probe'
+STALE = 'stale'
+
+
+class NeighborState(object):
+
+    __slots__ = ('vid', 'ip_gw', 'state', 'retries', 'due_time')
+
+    def __init__(self, vid, ip_gw, now):
+        self.vid = vid
+        self.ip_gw = ip_gw
+        self.state = INCOMPLETE
+        self.retries = 0
+        self.due_time = now
+
+
+class NeighborScheduler(object):
+    """The resolution states of the gateways of a datapath's routes."""
+
+    def __init__(self, reachable_time, retry_interval=2,
+                 max_retry_interval=64, max_probes=3):
+        self.reachable_time = reachable_time
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.max_probes = max_probes
+        # (vid, ip_gw) -> NeighborState.
+        self.neighbors = {}
+        # NeighborStates by due time. States are not removed when they
+        # are rescheduled or forgotten, but skipped when popped.
+        self.due = ExpiryQueue()
+
+    def schedule(self, neighbor, due_time):
+        neighbor.due_time = due_time
+        self.due.push(due_time, neighbor)
+
+    def retry_time(self, neighbor, now):
+        return now + min(
+            self.retry_interval * 2 ** (neighbor.retries - 1),
+            self.max_retry_interval)
+
+    def set_gateways(self, gateways, now):
+        """Track the gateways (a dict of (vid, ip_gw) to whether the
+        gateway is resolved), forgetting gateways no longer used.
+
+        New gateways, and gateways no longer resolved (their VLAN's
+        neighbor cache was reset), are due now."""
+        for key in self.neighbors.keys():
+            if key not in gateways:
+                del self.neighbors[key]
+        for key, resolved in gateways.iteritems():
+            neighbor = self.neighbors.get(key)
+            if neighbor is None or (
+                    neighbor.state != INCOMPLETE and not resolved):
+                neighbor = NeighborState(key[0], key[1], now)
+                self.neighbors[key] = neighbor
+                self.schedule(neighbor, now)
+
+    def resolved(self, vid, ip_gw, now):
+        """Record a gateway replied, so it is REACHABLE."""
+        neighbor = self.neighbors.get((vid, ip_gw))
+        if neighbor is not None:
+            neighbor.state = REACHABLE
+            neighbor.retries = 0
+            self.schedule(neighbor, now + self.reachable_time)
+
+    def pop_due(self, now):
+        """Return the gateways due to be resolved now, and schedule them
+        again for if they do not reply."""
+        due_neighbors = []
+        for neighbor in self.due.pop_expired(now):
+            key = (neighbor.vid, neighbor.ip_gw)
+            if (self.neighbors.get(key) is not neighbor or
+                    neighbor.due_time > now):
+                continue
+            if neighbor.state == REACHABLE:
+                neighbor.state = PROBE
+            elif (neighbor.state == PROBE and
+                  neighbor.retries >= self.max_probes):
+                neighbor.state = STALE
+            neighbor.retries += 1
+            self.schedule(neighbor, self.retry_time(neighbor, now))
+            due_neighbors.append(neighbor)
+        return due_neighbors
+
+    def next_due_time(self):
+        """Return when a gateway is next due, or None if none are."""
+        return self.due.next_expiry()
@@ -1,20 +1,42 @@
 """
 This module exposes an api to deal with db operations on no-sql databases.
-Currently couchdb support is included.
+Currently couchdb support is included, as well as an embedded sqlite
+store for controllers without a couchdb server.
 """
+import json
+import sqlite3
+import time
+import uuid
+from collections import namedtuple, OrderedDict
+
 COUCHDB = 'couchdb'
+SQLITE = 'sqlite'
 LOCALHOST = 'localhost'
+COUCHDB_PORT = 5984
+
+# Connection pool defaults, overridden by pool_size, timeout and retries
+# in the connection string.
+POOL_SIZE = 10
+POOL_TIMEOUT = 30
+POOL_RETRIES = 3
+
+# Default number of view queries kept by CachedDatabase.
+CACHE_SIZE = 1024
 
 try:
     import couchdb
 except ImportError, error:
     raise error
 
+from ryu.lib import hub
+
 def todict(conn_string, kwargs):
     """Converts the input connection string into a dictionary.
 
     Assumption: Connection string is of the format
     'driver=couchdb;server=localhost;uid=database_uid;pwd=database_pwd'
+    optionally followed by ';port=5984;pool_size=10;timeout=30;retries=3'
+    or 'driver=sqlite;server=/path/to/database/file'
     """
     ret = {}
     conn_dict = {}
@@ -28,6 +50,98 @@ def todict(conn_string, kwargs):
     conn_dict.update(kwargs)
     return conn_dict
 
+class CouchConnectionPool(couchdb.http.ConnectionPool):
+    """A bounded pool of keep-alive HTTP connections.
+
+    At most size requests are in flight at once (others wait for a free
+    slot), and at most size idle connections are kept per host.
+    """
+
+    def __init__(self, timeout, size):
+        super(CouchConnectionPool, self).__init__(timeout)
+        self.size = size
+        self.slots = hub.BoundedSemaphore(size)
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+        }
+
+    def acquire_slot(self):
+        if not self.slots.acquire(blocking=False):
+            start = time.time()
+            self.slots.acquire()
+            self.stats['waits'] += 1
+            self.stats['wait_time'] += time.time() - start
+
+    def release_slot(self):
+        self.slots.release()
+
+    def get(self, url):
+        scheme, host = couchdb.util.urlsplit(url, 'http', False)[:2]
+        with self.lock:
+            idle = bool(self.conns.get((scheme, host)))
+        if idle:
+            self.stats['hits'] += 1
+        else:
+            self.stats['misses'] += 1
+        return super(CouchConnectionPool, self).get(url)
+
+    def release(self, url, conn):
+        scheme, host = couchdb.util.urlsplit(url, 'http', False)[:2]
+        with self.lock:
+            conns = self.conns.setdefault((scheme, host), [])
+            if len(conns) < self.size:
+                conns.append(conn)
+                return
+        conn.close()
+
+
+class CouchSession(couchdb.http.Session):
+    """An HTTP session whose requests go through a CouchConnectionPool."""
+
+    def __init__(self, pool_size=POOL_SIZE, timeout=POOL_TIMEOUT,
+                 retries=POOL_RETRIES):
+        retry_delays = [0.1 * 2 ** retry for retry in range(retries)]
+        super(CouchSession, self).__init__(
+            timeout=timeout, retry_delays=retry_delays)
+        self.connection_pool = CouchConnectionPool(timeout, pool_size)
+
+    def request(self, method, url, body=None, headers=None,
+                credentials=None, num_redirects=0):
+        # redirects are requested again from within the first request,
+        # which already holds a slot.
+        if num_redirects:
+            return super(CouchSession, self).request(
+                method, url, body, headers, credentials, num_redirects)
+        self.connection_pool.acquire_slot()
+        try:
+            return super(CouchSession, self).request(
+                method, url, body, headers, credentials, num_redirects)
+        finally:
+            self.connection_pool.release_slot()
+
+
+# One session (and so one connection pool) per server url.
+_couch_sessions = {}
+
+
+def couch_session(url, pool_size=POOL_SIZE, timeout=POOL_TIMEOUT,
+                  retries=POOL_RETRIES):
+    """Return the session shared by all connections to server url."""
+    if url not in _couch_sessions:
+        _couch_sessions[url] = CouchSession(pool_size, timeout, retries)
+    return _couch_sessions[url]
+
+
+def couch_url(server, port=COUCHDB_PORT):
+    """Return the url of a couchdb server, given its host name or url."""
+    if server.startswith('http://') or server.startswith('https://'):
+        return server
+    return 'http://%s:%s/' % (server, port)
+
+
 class NsOdbc(object):
     """An abstraction layer to make api calls to a non relational database.
 
@@ -36,7 +150,11 @@ class NsOdbc(object):
     create
     get_doc
     insert_update_doc
+    insert_update_docs
     delete_doc
+    delete_docs
+    create_view
+    get_changes
     """
 
     def __init__(self):
@@ -51,16 +169,12 @@ class NsOdbc(object):
         conn_dict = {}
         conn_dict = todict(conn_string, kwargs)
 
-        # couchdb specific block.
-        if conn_dict['driver'] == COUCHDB:
-            if conn_dict['server'] == LOCALHOST:
-                cnxn = ConnectionCouch(couchdb.Server(),
-                                       (conn_dict['uid'], conn_dict['pwd']))
-            else:
-                cnxn = ConnectionCouch(couchdb.Server(),
-                                       (conn_dict['uid'], conn_dict['pwd']))
-            self.conn = cnxn
-            return cnxn
+        driver = conn_dict['driver']
+        if driver not in DRIVERS:
+            raise ValueError('Unknown nsodbc driver: %s' % driver)
+        cnxn = DRIVERS[driver](conn_dict)
+        self.conn = cnxn
+        return cnxn
 
     def get_attributes(self):
         """Returns API version"""
@@ -103,8 +217,68 @@ class ConnectionCouch(object):
         """
         return self.database
 
+    def pool_stats(self):
+        """
+        Return the connection pool statistics of this connection's server
+        (shared with other connections to the same server)
+        """
+        return self.conn.resource.session.connection_pool.stats
+
+
+class DatabaseQueries(object):
+    """View queries built on get_docs.
+
+    Multi-key and range queries are answered by a single view request,
+    and paginated queries page on (key, doc id), so each page costs
+    one request however deep it is.
+    """
+
+    def get_doc_ids(self, view_url, key=None, **options):
+        """Return the ids of the docs a view query selects."""
+        return [row.id for row in self.get_docs(view_url, key, **options)]
+
+    def get_docs_by_keys(self, view_url, keys, **options):
+        """Select docs emitted under any of keys, with one request."""
+        return self.get_docs(view_url, keys=list(keys), **options)
+
+    def get_docs_range(self, view_url, startkey, endkey, **options):
+        """Select docs emitted under keys from startkey to endkey,
+        inclusive."""
+        return self.get_docs(
+            view_url, startkey=startkey, endkey=endkey, **options)
 
-class DatabaseCouch(object):
+    def get_docs_page(self, view_url, limit, page=None, **options):
+        """Select one page of at most limit docs.
+
+        page is the bookmark returned with the previous page, or None
+        for the first page.
+        Returns the rows and the bookmark of the next page (None if
+        this is the last page).
+        """
+        if 'key' in options:
+            options['startkey'] = options['endkey'] = options.pop('key')
+        if page is not None:
+            options['startkey'], options['startkey_docid'] = page
+        rows = self.get_docs(view_url, limit=limit + 1, **options)
+        next_page = None
+        if len(rows) > limit:
+            next_page = (rows[limit].key, rows[limit].id)
+            rows = rows[:limit]
+        return rows, next_page
+
+    def get_doc_ids_all(self, view_url, keys):
+        """Return the ids of docs emitted under every one of keys (e.g.
+        flows with all of a set of tags), with one request."""
+        keys = dict((json.dumps(key), key) for key in keys)
+        doc_keys = {}
+        for row in self.get_docs_by_keys(view_url, keys.values()):
+            doc_keys.setdefault(row.id, set()).add(json.dumps(row.key))
+        return sorted(
+            doc_id for doc_id, found in doc_keys.iteritems()
+            if len(found) == len(keys))
+
+
+class DatabaseCouch(DatabaseQueries):
     """Database specific class exposing the API.
     """
     def __init__(self, database):
@@ -124,12 +298,63 @@ class DatabaseCouch(object):
             doc_id, _ = self.database.save(l_doc)
             return doc_id
 
-    def get_docs(self, view_url, key):
+    def insert_update_docs(self, docs, update_key=''):
+        """Insert or update a batch of documents
+        The whole batch is written with a single _bulk_docs request.
+        Documents that conflict with a stored revision are updated
+        against update_key (as in insert_update_doc), or replaced
+        entirely if no update_key is given, and written back with one
+        more bulk request.
+        Returns the document ids, in the same order as docs.
+        """
+        if not docs:
+            return []
+        doc_ids = []
+        conflicts = {}
+        for success, doc_id, _ in self.database.update(docs):
+            doc_ids.append(doc_id)
+            if not success:
+                conflicts[doc_id] = docs[len(doc_ids) - 1]
+        if conflicts:
+            l_docs = []
+            if update_key:
+                rows = self.database.view(
+                    '_all_docs', keys=conflicts.keys(), include_docs=True)
+                for row in rows:
+                    l_doc = row.doc
+                    if l_doc is None:
+                        continue
+                    l_doc[update_key] = conflicts[row.key][update_key]
+                    l_docs.append(l_doc)
+            else:
+                for doc_id, rev in self.get_revs(conflicts.keys()).items():
+                    l_doc = conflicts[doc_id]
+                    l_doc['_rev'] = rev
+                    l_docs.append(l_doc)
+            self.database.update(l_docs)
+        return doc_ids
+
+    def get_revs(self, doc_ids):
+        """Return the current revision of each existing document in
+        doc_ids, as a dict, with a single request."""
+        revs = {}
+        if doc_ids:
+            rows = self.database.view('_all_docs', keys=list(doc_ids))
+            for row in rows:
+                if row.value is None or row.value.get('deleted'):
+                    continue
+                revs[row.id] = row.value['rev']
+        return revs
+
+    def get_docs(self, view_url, key=None, **options):
         """Select docs
 
         A view url is used as select query with the key as a where condition
+        Other view options (e.g. startkey/endkey) are passed to the view.
         """
-        view_results = self.database.view(view_url, key=key)
+        if key is not None:
+            options['key'] = key
+        view_results = self.database.view(view_url, **options)
         return view_results.rows
 
     def delete_doc(self, doc_id):
@@ -139,6 +364,590 @@ class DatabaseCouch(object):
         doc = self.database.get(doc_id)
         self.database.delete(doc)
 
+    def delete_docs(self, docs):
+        """
+        Delete a batch of documents with a single _bulk_docs request.
+        Each doc only needs its _id and current _rev; revisions that are
+        not given are looked up with one more request, and documents
+        that do not exist are skipped.
+        """
+        docs = list(docs)
+        revs = self.get_revs(
+            [doc['_id'] for doc in docs if '_rev' not in doc])
+        stubs = []
+        for doc in docs:
+            rev = doc.get('_rev', revs.get(doc['_id']))
+            if rev is not None:
+                stubs.append(
+                    {'_id': doc['_id'], '_rev': rev, '_deleted': True})
+        if stubs:
+            self.database.update(stubs)
+
+    def create_view(self, design_name, view_name, map_fun):
+        """Create a view, or replace its map function if it changed.
+
+        The view is kept in the design document design_name, alongside
+        any other views already there.
+        Returns the view url to be used with get_docs.
+        """
+        design_id = '_design/%s' % design_name
+        design = self.database.get(design_id)
+        if design is None:
+            design = {'_id': design_id, 'language': 'javascript'}
+        views = design.setdefault('views', {})
+        if views.get(view_name) != {'map': map_fun}:
+            views[view_name] = {'map': map_fun}
+            self.database.save(design)
+        return '%s/_view/%s' % (design_id, view_name)
+
+    def get_changes(self, since=0, **options):
+        """Return the changes made after update sequence since (or 'now'),
+        and the last update sequence, from the _changes feed."""
+        changes = self.database.changes(since=since, **options)
+        return changes['results'], changes['last_seq']
+
+
+SqliteRow = namedtuple('SqliteRow', 'id key value doc')
+
+
+class SqliteViewResults(list):
+    """View results, iterable directly or through rows as in couchdb."""
+
+    @property
+    def rows(self):
+        return self
+
+
+class SqliteStore(object):
+    """Documents of one database, stored in a sqlite table.
+
+    This implements the part of the couchdb.Database API used by
+    DatabaseCouch (save, update, get, delete and view), with the same
+    revision and conflict semantics. The views in couchdb_views.js are
+    answered from indexed columns rather than map functions: keys, key
+    ranges, pages (startkey_docid) and limits are all SQL conditions.
+    Tags are strings, and are stored as they are, so that tag ranges
+    sort as the tags do.
+    """
+
+    def __init__(self, conn, name):
+        self.conn = conn
+        self.name = name
+        self.views = {
+            '_all_docs': self._view_all_docs,
+            '_design/switches/_view/switch': self._view_by_id,
+            '_design/flows/_view/flow': self._view_by_id,
+            '_design/flows/_view/dp': self._view_flows_by_dp,
+            '_design/tags/_view/tags': self._view_tags,
+            '_design/tags/_view/ids': self._view_tag_ids,
+        }
+
+    def _get(self, doc_id):
+        row = self.conn.execute(
+            'SELECT doc FROM docs WHERE db = ? AND id = ?',
+            (self.name, doc_id)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def _write(self, doc):
+        doc_id = doc.setdefault('_id', uuid.uuid4().hex)
+        stored = self._get(doc_id)
+        stored_rev = stored['_rev'] if stored is not None else None
+        if stored_rev != doc.get('_rev'):
+            return (False, doc_id, couchdb.http.ResourceConflict(
+                ('conflict', 'Document update conflict.')))
+        self.conn.execute(
+            'DELETE FROM tags WHERE db = ? AND id = ?', (self.name, doc_id))
+        self.conn.execute(
+            'DELETE FROM changes WHERE db = ? AND id = ?', (self.name, doc_id))
+        self.conn.execute(
+            'INSERT INTO changes (db, id) VALUES (?, ?)', (self.name, doc_id))
+        if doc.get('_deleted'):
+            self.conn.execute(
+                'DELETE FROM docs WHERE db = ? AND id = ?',
+                (self.name, doc_id))
+            return (True, doc_id, doc['_rev'])
+        rev_num = int(stored_rev.split('-')[0]) + 1 if stored_rev else 1
+        doc['_rev'] = '%u-%s' % (rev_num, uuid.uuid4().hex)
+        self.conn.execute(
+            'INSERT OR REPLACE INTO docs '
+            '(db, id, doc, dp_id, table_id) VALUES (?, ?, ?, ?, ?)',
+            (self.name, doc_id, json.dumps(doc),
+             doc.get('dp_id'), doc.get('table_id')))
+        self.conn.executemany(
+            'INSERT INTO tags (db, tag, id) VALUES (?, ?, ?)',
+            [(self.name, tag, doc_id) for tag in doc.get('tags', [])])
+        return (True, doc_id, doc['_rev'])
+
+    def save(self, doc):
+        with self.conn:
+            success, doc_id, rev = self._write(doc)
+        if not success:
+            raise rev
+        return doc_id, rev
+
+    def update(self, docs):
+        with self.conn:
+            return [self._write(doc) for doc in docs]
+
+    def get(self, doc_id, default=None):
+        doc = self._get(doc_id)
+        if doc is None:
+            return default
+        return doc
+
+    def delete(self, doc):
+        with self.conn:
+            success, _, exc = self._write(
+                {'_id': doc['_id'], '_rev': doc['_rev'], '_deleted': True})
+        if not success:
+            raise exc
+
+    def changes(self, since=0, include_docs=False, **options):
+        """Return changes after since, in the same form as couchdb's
+        (non continuous) _changes feed. Only the latest change of each
+        document is kept."""
+        if since == 'now':
+            since = self.conn.execute(
+                'SELECT MAX(seq) FROM changes').fetchone()[0] or 0
+            return {'results': [], 'last_seq': since}
+        results = []
+        last_seq = since
+        for seq, doc_id in self.conn.execute(
+                'SELECT seq, id FROM changes WHERE db = ? AND seq > ? '
+                'ORDER BY seq', (self.name, since)):
+            doc = self._get(doc_id)
+            result = {'seq': seq, 'id': doc_id}
+            if doc is None:
+                result['deleted'] = True
+            if include_docs:
+                result['doc'] = doc
+            results.append(result)
+            last_seq = seq
+        return {'results': results, 'last_seq': last_seq}
+
+    def view(self, name, **options):
+        if name not in self.views:
+            raise ValueError('View not supported by sqlite driver: %s' % name)
+        return SqliteViewResults(self.views[name](**options))
+
+    def _select(self, query, conditions, order, limit=None):
+        """Execute query with the (condition, params) conditions, sorted
+        by the (ORDER BY terms, params) of order, returning at most limit
+        rows, so that sqlite can use its indexes for all of it."""
+        params = []
+        for condition, condition_params in conditions:
+            params.extend(condition_params)
+        query += ' WHERE ' + ' AND '.join(
+            condition for condition, _ in conditions)
+        query += ' ORDER BY ' + order[0]
+        params.extend(order[1])
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        return self.conn.execute(query, params)
+
+    @staticmethod
+    def _keys_conditions(column, keys):
+        """Return the condition selecting rows with any of keys, and the
+        ORDER BY term sorting them in the order of keys, as couchdb
+        returns multi-key results."""
+        placeholders = ', '.join('?' * len(keys))
+        cases = ' '.join('WHEN ? THEN %u' % i for i in range(len(keys)))
+        return (('%s IN (%s)' % (column, placeholders), list(keys)),
+                ('CASE %s %s END' % (column, cases), list(keys)))
+
+    def _view_all_docs(self, keys, include_docs=False, limit=None):
+        rows = []
+        for key in keys[:limit]:
+            doc = self._get(key)
+            if doc is None:
+                rows.append(SqliteRow(None, key, None, None))
+                continue
+            rows.append(SqliteRow(
+                key, key, {'rev': doc['_rev']},
+                doc if include_docs else None))
+        return rows
+
+    def _view_by_id(self, key=None, keys=None, startkey=None, endkey=None,
+                    startkey_docid=None, limit=None, include_docs=False):
+        if key is not None:
+            keys = [key]
+        if keys is not None and not keys:
+            return []
+        conditions = [
+            ('db = ?', [self.name]),
+            ("substr(id, 1, 8) != '_design/'", [])]
+        order = ('id', [])
+        if keys is not None:
+            keys_condition, order = self._keys_conditions('id', keys)
+            conditions.append(keys_condition)
+        if startkey is not None:
+            conditions.append(('id >= ?', [startkey]))
+            if startkey_docid is not None:
+                conditions.append((
+                    'NOT (id = ? AND id < ?)', [startkey, startkey_docid]))
+        if endkey is not None:
+            conditions.append(('id <= ?', [endkey]))
+        rows = []
+        for doc_id, doc in self._select(
+                'SELECT id, doc FROM docs', conditions, order, limit):
+            doc = json.loads(doc)
+            rows.append(SqliteRow(
+                doc_id, doc_id, doc, doc if include_docs else None))
+        return rows
+
+    @staticmethod
+    def _dp_key_bound(bound, op):
+        """Return the SQL condition for one end (op '>' for startkey,
+        '<' for endkey) of a range of [dp_id, table_id] view keys."""
+        dp_id = bound[0]
+        if len(bound) == 1:
+            # [dp_id] sorts before any [dp_id, table_id]
+            return ('dp_id %s ?' % ('>=' if op == '>' else '<'), [dp_id])
+        table_id = bound[1]
+        if isinstance(table_id, dict):
+            # [dp_id, {}] sorts after any [dp_id, table_id]
+            return ('dp_id %s ?' % ('>' if op == '>' else '<='), [dp_id])
+        return ('(dp_id %s ? OR (dp_id = ? AND table_id %s= ?))' % (op, op),
+                [dp_id, dp_id, table_id])
+
+    def _view_flows_by_dp(self, key=None, startkey=None, endkey=None,
+                          startkey_docid=None, limit=None,
+                          include_docs=False):
+        conditions = [('db = ?', [self.name]), ('dp_id IS NOT NULL', [])]
+        if key is not None:
+            conditions.append(('dp_id = ? AND table_id = ?', list(key)))
+        for bound, op in ((startkey, '>'), (endkey, '<')):
+            if bound is not None:
+                conditions.append(self._dp_key_bound(bound, op))
+        if (startkey_docid is not None and startkey is not None and
+                len(startkey) == 2 and not isinstance(startkey[1], dict)):
+            conditions.append((
+                'NOT (dp_id = ? AND table_id = ? AND id < ?)',
+                list(startkey) + [startkey_docid]))
+        rows = []
+        for doc_id, dp_id, table_id, doc in self._select(
+                'SELECT id, dp_id, table_id, doc FROM docs', conditions,
+                ('dp_id, table_id, id', []), limit):
+            doc = json.loads(doc)
+            rows.append(SqliteRow(
+                doc_id, [dp_id, table_id],
+                {'rev': doc['_rev'], 'match': doc['match'],
+                 'out_ports': doc['out_ports']},
+                doc if include_docs else None))
+        return rows
+
+    def _tag_rows(self, key=None, keys=None, startkey=None, endkey=None,
+                  startkey_docid=None, limit=None):
+        """Return (tag, doc id, doc) of tagged docs, in view order."""
+        if key is not None:
+            keys = [key]
+        if keys is not None and not keys:
+            return []
+        conditions = [('tags.db = ?', [self.name])]
+        order = ('tags.tag', [])
+        if keys is not None:
+            keys_condition, order = self._keys_conditions('tags.tag', keys)
+            conditions.append(keys_condition)
+        if startkey is not None:
+            conditions.append(('tags.tag >= ?', [startkey]))
+            if startkey_docid is not None:
+                conditions.append((
+                    'NOT (tags.tag = ? AND tags.id < ?)',
+                    [startkey, startkey_docid]))
+        if endkey is not None:
+            conditions.append(('tags.tag <= ?', [endkey]))
+        return list(self._select(
+            'SELECT tags.tag, docs.id, docs.doc FROM tags JOIN docs '
+            'ON tags.db = docs.db AND tags.id = docs.id', conditions,
+            (order[0] + ', tags.id', order[1]), limit))
+
+    def _view_tags(self, include_docs=False, **options):
+        return [
+            SqliteRow(doc_id, tag, json.loads(doc), None)
+            for tag, doc_id, doc in self._tag_rows(**options)]
+
+    def _view_tag_ids(self, include_docs=False, **options):
+        return [
+            SqliteRow(doc_id, tag, None,
+                      json.loads(doc) if include_docs else None)
+            for tag, doc_id, doc in self._tag_rows(**options)]
+
+
+class ConnectionSqlite(object):
+    """Connection class.
+
+    This class is specific to the embedded sqlite store, and follows
+    the same standards as ConnectionCouch.
+    """
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS docs ('
+                'db TEXT NOT NULL, id TEXT NOT NULL, doc TEXT NOT NULL, '
+                'dp_id TEXT, table_id INTEGER, PRIMARY KEY (db, id))')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS docs_dp ON '
+                'docs (db, dp_id, table_id, id)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS tags ('
+                'db TEXT NOT NULL, tag TEXT NOT NULL, id TEXT NOT NULL)')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS tags_tag ON tags (db, tag, id)')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS tags_id ON tags (db, id)')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS changes ('
+                'seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                'db TEXT NOT NULL, id TEXT NOT NULL)')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS changes_id ON changes (db, id)')
+        self.database = {}
+
+    def create(self, db_name):
+        """Create a database.
+        If the databse exists, return the same.
+        """
+        if db_name not in self.database:
+            self.database[db_name] = DatabaseSqlite(
+                SqliteStore(self.conn, db_name))
+        return self.database[db_name]
+
+    def connected_databases(self):
+        """
+        Return the connected databases of this connection
+        """
+        return self.database
+
+
+class DatabaseSqlite(DatabaseCouch):
+    """Database specific class exposing the API, for the sqlite store.
+    """
+
+    def create_view(self, design_name, view_name, map_fun):
+        """Views are built into the sqlite store; check that this one
+        is supported and return its url."""
+        view_url = '_design/%s/_view/%s' % (design_name, view_name)
+        if view_url not in self.database.views:
+            raise ValueError(
+                'View not supported by sqlite driver: %s' % view_url)
+        return view_url
+
+
+class CachedDatabase(DatabaseQueries):
+    """Read-through cache of view queries on a database.
+
+    Query results are kept in LRU order, indexed by the datapath, tag or
+    document id they are about and by the ids of the documents they
+    returned. Entries are invalidated by writes made through this
+    object, and by following the database's _changes feed (see
+    follow_changes) for writes made by anyone else.
+
+    Cached rows are shared between callers and must not be modified.
+    """
+
+    # How the results of each view can be narrowed for invalidation:
+    # by document id, by tag, or by datapath ([dp_id, table_id] keys).
+    VIEW_INDEXES = {
+        '_design/switches/_view/switch': 'id',
+        '_design/flows/_view/flow': 'id',
+        '_design/tags/_view/tags': 'tag',
+        '_design/tags/_view/ids': 'tag',
+        '_design/flows/_view/dp': 'dp',
+    }
+
+    def __init__(self, database, size=CACHE_SIZE):
+        self.database = database
+        self.size = size
+        # query -> (rows, index keys)
+        self.entries = OrderedDict()
+        # index key -> queries
+        self.index = {}
+        # counts invalidations, so results fetched while a change was
+        # processed are not cached.
+        self.generation = 0
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+        _, self.last_seq = self.database.get_changes(since='now')
+
+    def _query_index_keys(self, view_url, options):
+        """Return the index keys that a change must match to affect the
+        results of a query, or [('any',)] if any change might."""
+        index = self.VIEW_INDEXES.get(view_url)
+        keys = options.get('keys')
+        if keys is None and 'key' in options:
+            keys = [options['key']]
+        if index == 'dp':
+            dp_ids = set()
+            for bound in (keys or []) + [options.get('startkey'),
+                                         options.get('endkey')]:
+                if bound:
+                    dp_ids.add(bound[0])
+            if len(dp_ids) == 1:
+                return [('dp', dp_ids.pop())]
+        elif index == 'tag' and keys is not None:
+            return [('tag', json.dumps(key)) for key in keys]
+        elif index == 'id' and keys is not None:
+            return [('id', key) for key in keys]
+        return [('any',)]
+
+    @staticmethod
+    def _doc_index_keys(doc_id, doc):
+        """Return the index keys of queries a changed document affects."""
+        index_keys = [('any',), ('id', doc_id)]
+        if doc:
+            if doc.get('dp_id') is not None:
+                index_keys.append(('dp', doc['dp_id']))
+            for tag in doc.get('tags', []):
+                index_keys.append(('tag', json.dumps(tag)))
+        return index_keys
+
+    def _add(self, query, rows, index_keys):
+        if len(self.entries) >= self.size:
+            old_query, (_, old_index_keys) = self.entries.popitem(last=False)
+            self._unindex(old_query, old_index_keys)
+            self.stats['evictions'] += 1
+        self.entries[query] = (rows, index_keys)
+        for index_key in index_keys:
+            self.index.setdefault(index_key, set()).add(query)
+
+    def _unindex(self, query, index_keys):
+        for index_key in index_keys:
+            queries = self.index.get(index_key)
+            if queries is not None:
+                queries.discard(query)
+                if not queries:
+                    del self.index[index_key]
+
+    def invalidate(self, doc_id, doc=None):
+        """Drop cached queries that a change to a document may affect."""
+        self.generation += 1
+        for index_key in self._doc_index_keys(doc_id, doc):
+            for query in list(self.index.get(index_key, ())):
+                _, query_index_keys = self.entries.pop(query)
+                self._unindex(query, query_index_keys)
+                self.stats['invalidations'] += 1
+
+    def clear(self):
+        self.generation += 1
+        self.entries.clear()
+        self.index.clear()
+
+    def get_docs(self, view_url, key=None, **options):
+        """Select docs, as DatabaseCouch.get_docs, from the cache if
+        possible."""
+        if key is not None:
+            options['key'] = key
+        query = (view_url, json.dumps(sorted(options.items())))
+        entry = self.entries.get(query)
+        if entry is not None:
+            self.entries[query] = self.entries.pop(query)
+            self.stats['hits'] += 1
+            return entry[0]
+        self.stats['misses'] += 1
+        generation = self.generation
+        # the fetch yields, and changes may be followed meanwhile.
+        rows = self.database.get_docs(view_url, **options)
+        if self.generation != generation:
+            return rows
+        index_keys = set(self._query_index_keys(view_url, options))
+        for row in rows:
+            index_keys.add(('id', row.id))
+        self._add(query, rows, index_keys)
+        return rows
+
+    def insert_update_doc(self, doc, update_key=''):
+        doc_id = self.database.insert_update_doc(doc, update_key)
+        self.invalidate(doc_id, doc)
+        return doc_id
+
+    def insert_update_docs(self, docs, update_key=''):
+        doc_ids = self.database.insert_update_docs(docs, update_key)
+        for doc_id, doc in zip(doc_ids, docs):
+            self.invalidate(doc_id, doc)
+        return doc_ids
+
+    def delete_doc(self, doc_id):
+        self.database.delete_doc(doc_id)
+        self.invalidate(doc_id)
+
+    def delete_docs(self, docs):
+        docs = list(docs)
+        self.database.delete_docs(docs)
+        for doc in docs:
+            self.invalidate(doc['_id'])
+
+    def get_revs(self, doc_ids):
+        return self.database.get_revs(doc_ids)
+
+    def create_view(self, design_name, view_name, map_fun):
+        return self.database.create_view(design_name, view_name, map_fun)
+
+    def get_changes(self, since=0, **options):
+        return self.database.get_changes(since, **options)
+
+    def poll_changes(self, **options):
+        """Invalidate cached queries affected by changes made since the
+        last poll. Returns the number of changes."""
+        results, self.last_seq = self.database.get_changes(
+            since=self.last_seq, include_docs=True, **options)
+        for result in results:
+            self.invalidate(result['id'], result.get('doc'))
+        return len(results)
+
+    def follow_changes(self, poll_interval=1):
+        """Follow the _changes feed, to be run in its own thread."""
+        while True:
+            try:
+                if self.poll_changes(
+                        feed='longpoll', timeout=int(poll_interval * 1000)):
+                    continue
+            except Exception:
+                # changes may have been missed, so nothing cached can
+                # be trusted.
+                self.clear()
+            hub.sleep(poll_interval)
+
+
+def connect_couchdb(conn_dict):
+    url = couch_url(conn_dict.get('server', LOCALHOST),
+                    conn_dict.get('port', COUCHDB_PORT))
+    session = couch_session(
+        url,
+        pool_size=int(conn_dict.get('pool_size', POOL_SIZE)),
+        timeout=float(conn_dict.get('timeout', POOL_TIMEOUT)),
+        retries=int(conn_dict.get('retries', POOL_RETRIES)))
+    return ConnectionCouch(couchdb.Server(url, session=session),
+                           (conn_dict['uid'], conn_dict['pwd']))
+
+
+def connect_sqlite(conn_dict):
+    return ConnectionSqlite(conn_dict['server'])
+
+
+# Connect functions of each driver, taking the parsed connection string.
+DRIVERS = {}
+
+
+def register_driver(driver, connect_fn):
+    """Register a driver, to be used with driver=<driver> in the
+    connection string."""
+    DRIVERS[driver] = connect_fn
+
+
+register_driver(COUCHDB, connect_couchdb)
+register_driver(SQLITE, connect_sqlite)
+
 
 def nsodbc_factory():
     """factory method to consume the API"""
@@ -0,0 +1,131 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Send OpenFlow messages to a datapath in batches.
+
+A list of messages is serialized into one buffer, written to the
+switch's socket at once, instead of one write per message.
+"""
+
+import struct
+
+from ryu.ofproto import ofproto_v1_3 as ofp
+from ryu.ofproto import ofproto_v1_3_parser as parser
+
+from util import LRUCache
+
+OFP_HEADER = struct.Struct('!BBHI')
+
+# flowmod key -> (match, instructions, serialized flowmod without its
+# header). Flowmods sharing their match and instruction objects (the
+# valve caches them, and the flows it sends again reuse them) with a
+# serialized flowmod are not serialized again.
+SERIALIZED_FLOWMODS = LRUCache(8192)
+
+
+def is_barrier(ofmsg):
+    return isinstance(ofmsg, parser.OFPBarrierRequest)
+
+
+def coalesce_barriers(ofmsgs):
+    """Return ofmsgs without the barriers that order nothing: leading
+    barriers and barriers right after another barrier."""
+    coalesced = []
+    for ofmsg in ofmsgs:
+        if is_barrier(ofmsg) and (not coalesced or is_barrier(coalesced[-1])):
+            continue
+        coalesced.append(ofmsg)
+    return coalesced
+
+
+def bundle_msgs(datapath, ofmsgs, bundle_id):
+    """Return ofmsgs in an atomic, ordered OpenFlow 1.3 bundle (ONF
+    extension 230), so the switch applies all of them or none.
+
+    Barriers are left out, as the bundle's messages are applied in
+    order when it is committed.
+    """
+    flags = ofp.ONF_BF_ATOMIC | ofp.ONF_BF_ORDERED
+    bundle = [parser.ONFBundleCtrlMsg(
+        datapath, bundle_id, ofp.ONF_BCT_OPEN_REQUEST, flags, [])]
+    for ofmsg in ofmsgs:
+        if is_barrier(ofmsg):
+            continue
+        ofmsg.datapath = datapath
+        bundle.append(parser.ONFBundleAddMsg(
+            datapath, bundle_id, flags, ofmsg, []))
+    for bundle_ctrl in (ofp.ONF_BCT_CLOSE_REQUEST, ofp.ONF_BCT_COMMIT_REQUEST):
+        bundle.append(parser.ONFBundleCtrlMsg(
+            datapath, bundle_id, bundle_ctrl, flags, []))
+    return bundle
+
+
+def flowmod_key(flow_msg):
+    """Return a key for the serialized form of a flowmod.
+
+    The match and instructions are keyed by identity; the cache entry
+    keeps them, so their ids are not reused while the entry exists.
+    """
+    return (
+        flow_msg.command, flow_msg.table_id, flow_msg.priority,
+        flow_msg.cookie, flow_msg.cookie_mask, flow_msg.idle_timeout,
+        flow_msg.hard_timeout, flow_msg.buffer_id, flow_msg.out_port,
+        flow_msg.out_group, flow_msg.flags, id(flow_msg.match),
+        tuple(id(inst) for inst in flow_msg.instructions))
+
+
+def serialize_flowmod(flow_msg):
+    key = flowmod_key(flow_msg)
+    cached = SERIALIZED_FLOWMODS.get(key)
+    if cached is None:
+        flow_msg.serialize()
+        SERIALIZED_FLOWMODS.put(key, (
+            flow_msg.match, tuple(flow_msg.instructions),
+            bytes(flow_msg.buf[OFP_HEADER.size:])))
+        return
+    body = cached[2]
+    flow_msg.version = ofp.OFP_VERSION
+    flow_msg.msg_type = ofp.OFPT_FLOW_MOD
+    flow_msg.msg_len = OFP_HEADER.size + len(body)
+    flow_msg.buf = bytearray(OFP_HEADER.pack(
+        flow_msg.version, flow_msg.msg_type, flow_msg.msg_len,
+        flow_msg.xid)) + body
+
+
+def serialize_msgs(datapath, ofmsgs):
+    """Return ofmsgs serialized into one buffer, as datapath.send_msg()
+    would serialize them one by one."""
+    bufs = []
+    for ofmsg in ofmsgs:
+        ofmsg.datapath = datapath
+        if ofmsg.xid is None:
+            datapath.set_xid(ofmsg)
+        if isinstance(ofmsg, parser.OFPFlowMod):
+            serialize_flowmod(ofmsg)
+        else:
+            ofmsg.serialize()
+        bufs.append(ofmsg.buf)
+    return bytearray().join(bufs)
+
+
+def send_msgs(datapath, ofmsgs, bundle_id=None):
+    """Send ofmsgs to datapath in one write, in a bundle if bundle_id is
+    not None.
+
+    Returns the messages sent.
+    """
+    ofmsgs = coalesce_barriers(ofmsgs)
+    if bundle_id is not None:
+        ofmsgs = bundle_msgs(datapath, ofmsgs, bundle_id)
+    if ofmsgs:
+        datapath.send(serialize_msgs(datapath, ofmsgs))
+    return ofmsgs
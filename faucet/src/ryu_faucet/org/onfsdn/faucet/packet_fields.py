@@ -0,0 +1,108 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fast path parsing of packet-ins.
+
+Most packets sent to the controller only need their L2 addresses and
+VLAN to be learned, so these are read directly from the packet data
+with struct, without copying it or decoding the packet with Ryu. Only
+packets for the control plane are decoded with Ryu.
+"""
+
+import ipaddr
+import struct
+
+from binascii import hexlify
+
+from ryu.lib.packet import packet
+from ryu.ofproto import ether
+from ryu.ofproto import inet
+
+ETH_HEADER = struct.Struct('!6s6sH')
+VLAN_HEADER = struct.Struct('!HH')
+VLAN_HEADER_OFFSET = ETH_HEADER.size
+L3_OFFSET = VLAN_HEADER_OFFSET + VLAN_HEADER.size
+# ARP sender and target IP addresses.
+ARP_IPS = struct.Struct('!14xI6xI')
+# IPv4 protocol, source and destination addresses.
+IPV4_HEADER = struct.Struct('!9xB2xII')
+# IPv6 next header, source and destination addresses.
+IPV6_HEADER = struct.Struct('!6xB1x16s16s')
+
+
+def mac_str(mac_bin):
+    """Return the string of a binary MAC address."""
+    mac_hex = hexlify(mac_bin)
+    return ':'.join((
+        mac_hex[0:2], mac_hex[2:4], mac_hex[4:6],
+        mac_hex[6:8], mac_hex[8:10], mac_hex[10:12]))
+
+
+def ipv6_address(ip_bin):
+    high, low = struct.unpack('!QQ', ip_bin)
+    return ipaddr.IPv6Address((high << 64) | low)
+
+
+class PacketFields(object):
+    """The L2 fields of a VLAN tagged packet-in."""
+
+    __slots__ = ('data', 'eth_dst', 'eth_src', 'vid', 'eth_type')
+
+    def __init__(self, data, eth_dst, eth_src, vid, eth_type):
+        self.data = data
+        self.eth_dst = eth_dst
+        self.eth_src = eth_src
+        self.vid = vid
+        # the ethertype after the VLAN header.
+        self.eth_type = eth_type
+
+    def ip_addresses(self):
+        """Return the source and destination IP addresses of an ARP, ICMP
+        or ICMPv6 packet, or None for other packets."""
+        try:
+            if self.eth_type == ether.ETH_TYPE_ARP:
+                src_ip, dst_ip = ARP_IPS.unpack_from(self.data, L3_OFFSET)
+                return (
+                    ipaddr.IPv4Address(src_ip), ipaddr.IPv4Address(dst_ip))
+            elif self.eth_type == ether.ETH_TYPE_IP:
+                proto, src_ip, dst_ip = IPV4_HEADER.unpack_from(
+                    self.data, L3_OFFSET)
+                if proto == inet.IPPROTO_ICMP:
+                    return (
+                        ipaddr.IPv4Address(src_ip),
+                        ipaddr.IPv4Address(dst_ip))
+            elif self.eth_type == ether.ETH_TYPE_IPV6:
+                nxt, src_ip, dst_ip = IPV6_HEADER.unpack_from(
+                    self.data, L3_OFFSET)
+                if nxt == inet.IPPROTO_ICMPV6:
+                    return ipv6_address(src_ip), ipv6_address(dst_ip)
+        except struct.error:
+            pass
+        return None
+
+    def decode(self):
+        """Return the packet decoded by Ryu."""
+        return packet.Packet(self.data)
+
+
+def parse_packet_in(data):
+    """Return the PacketFields of a packet-in's data, or None if the
+    packet is not VLAN tagged."""
+    try:
+        eth_dst, eth_src, eth_type = ETH_HEADER.unpack_from(data)
+        if eth_type != ether.ETH_TYPE_8021Q:
+            return None
+        tci, eth_type = VLAN_HEADER.unpack_from(data, VLAN_HEADER_OFFSET)
+    except struct.error:
+        return None
+    return PacketFields(
+        data, mac_str(eth_dst), mac_str(eth_src), tci & 0xfff, eth_type)
@@ -0,0 +1,164 @@
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Routing tables with longest prefix match lookups.
+
+A RouteTable maps the prefixes (ipaddr.IPNetwork) of one address family
+to their gateways (ipaddr.IPAddress), like the dict it replaces. The
+prefixes are also kept in a Patricia trie, for longest prefix match
+lookups, and indexed by gateway.
+"""
+
+from collections import MutableMapping
+
+
+class TrieNode(object):
+    """A node of a Patricia trie: a prefix, the route for that prefix if
+    there is one, and subtrees for the next bit being 0 and 1."""
+
+    __slots__ = ('prefix', 'prefixlen', 'route', 'children')
+
+    def __init__(self, prefix, prefixlen, route=None):
+        self.prefix = prefix
+        self.prefixlen = prefixlen
+        self.route = route
+        self.children = [None, None]
+
+
+class RouteTable(MutableMapping):
+    """Routes of one address family (IP version 4 or 6)."""
+
+    def __init__(self, version):
+        self.version = version
+        self.bits = 32 if version == 4 else 128
+        self.masks = [
+            ((1 << prefixlen) - 1) << (self.bits - prefixlen)
+            for prefixlen in range(self.bits + 1)]
+        # prefix -> gateway.
+        self.routes = {}
+        # gateway -> prefixes routed via it.
+        self.gateway_prefixes = {}
+        self.root = TrieNode(0, 0)
+
+    def __getitem__(self, ip_dst):
+        return self.routes[ip_dst]
+
+    def __setitem__(self, ip_dst, ip_gw):
+        assert ip_dst.version == self.version
+        if ip_dst in self.routes:
+            self._unindex_gateway(ip_dst, self.routes[ip_dst])
+        self.routes[ip_dst] = ip_gw
+        self.gateway_prefixes.setdefault(ip_gw, set()).add(ip_dst)
+        self._trie_insert(int(ip_dst.network), ip_dst.prefixlen, ip_dst)
+
+    def __delitem__(self, ip_dst):
+        ip_gw = self.routes.pop(ip_dst)
+        self._unindex_gateway(ip_dst, ip_gw)
+        self._trie_delete(int(ip_dst.network), ip_dst.prefixlen)
+
+    def __contains__(self, ip_dst):
+        return ip_dst in self.routes
+
+    def __iter__(self):
+        return iter(self.routes)
+
+    def __len__(self):
+        return len(self.routes)
+
+    def __repr__(self):
+        return repr(self.routes)
+
+    def _unindex_gateway(self, ip_dst, ip_gw):
+        prefixes = self.gateway_prefixes[ip_gw]
+        prefixes.discard(ip_dst)
+        if not prefixes:
+            del self.gateway_prefixes[ip_gw]
+
+    def _bit(self, address, position):
+        """Return the bit of address at position, counting from the most
+        significant bit."""
+        return (address >> (self.bits - 1 - position)) & 1
+
+    def _common_prefixlen(self, address, other, max_prefixlen):
+        """Return the length of the prefix address and other have in
+        common, up to max_prefixlen."""
+        diff = (address ^ other) & self.masks[max_prefixlen]
+        if not diff:
+            return max_prefixlen
+        return self.bits - diff.bit_length()
+
+    def _trie_insert(self, prefix, prefixlen, route):
+        node = self.root
+        while True:
+            if node.prefixlen == prefixlen:
+                node.route = route
+                return
+            bit = self._bit(prefix, node.prefixlen)
+            child = node.children[bit]
+            if child is None:
+                node.children[bit] = TrieNode(prefix, prefixlen, route)
+                return
+            common = self._common_prefixlen(
+                prefix, child.prefix, min(child.prefixlen, prefixlen))
+            if common == child.prefixlen:
+                node = child
+                continue
+            # split the edge to child where the prefixes diverge.
+            if common == prefixlen:
+                new_node = TrieNode(prefix, prefixlen, route)
+            else:
+                new_node = TrieNode(prefix & self.masks[common], common)
+                new_node.children[self._bit(prefix, common)] = TrieNode(
+                    prefix, prefixlen, route)
+            new_node.children[self._bit(child.prefix, common)] = child
+            node.children[bit] = new_node
+            return
+
+    def _trie_delete(self, prefix, prefixlen):
+        parents = []
+        node = self.root
+        while node.prefixlen < prefixlen:
+            parents.append(node)
+            node = node.children[self._bit(prefix, node.prefixlen)]
+        node.route = None
+        # remove nodes left without a route that no longer join subtrees.
+        while parents and node.route is None:
+            children = [child for child in node.children if child is not None]
+            if len(children) > 1:
+                break
+            parent = parents.pop()
+            parent.children[self._bit(node.prefix, parent.prefixlen)] = (
+                children[0] if children else None)
+            node = parent
+
+    def lookup(self, ip_address):
+        """Return the longest prefix routing ip_address, or None."""
+        address = int(ip_address)
+        match = None
+        node = self.root
+        while node is not None:
+            if address & self.masks[node.prefixlen] != node.prefix:
+                break
+            if node.route is not None:
+                match = node.route
+            if node.prefixlen == self.bits:
+                break
+            node = node.children[self._bit(address, node.prefixlen)]
+        return match
+
+    def gateways(self):
+        """Return the gateways that routes use."""
+        return self.gateway_prefixes.keys()
+
+    def prefixes_via(self, ip_gw):
+        """Return the prefixes routed via ip_gw."""
+        return self.gateway_prefixes.get(ip_gw, set())
@@ -13,7 +13,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import heapq
+import itertools
 import os, signal, logging
+from collections import OrderedDict
 from functools import wraps
 
 def dump(obj, level=0):
@@ -43,6 +46,68 @@ def mac_addr_is_unicast(mac_addr):
     msb = mac_addr.split(":")[0]
     return msb[-1] in "02468aAcCeE"
 
+class LRUCache(object):
+    """A mapping of at most size items, evicting the least recently used
+    item when full."""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        """Return the value of key, or None if it is not cached."""
+        value = self.items.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items[key] = value
+        return value
+
+    def put(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+        return value
+
+class ExpiryQueue(object):
+    """Items in order of the time they expire, in a min-heap.
+
+    Items are not removed when they are refreshed or deleted; the caller
+    checks the items popped are still due, and pushes them again if they
+    were refreshed. Expiring items only touches the items due."""
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, expire_time, item):
+        # the counter keeps items with the same expiry time in order,
+        # without comparing them.
+        heapq.heappush(self.heap, (expire_time, next(self.counter), item))
+
+    def pop_expired(self, now):
+        """Remove and return the items that expired by now."""
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            expired.append(heapq.heappop(self.heap)[2])
+        return expired
+
+    def next_expiry(self):
+        """Return when the next item expires, or None if there are none."""
+        if self.heap:
+            return self.heap[0][0]
+        return None
+
 def kill_on_exception(logname):
     """decorator to ensure functions will kill ryu when an unhandled exception
     occurs"""
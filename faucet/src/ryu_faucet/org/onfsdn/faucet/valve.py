@@ -23,9 +23,12 @@ from collections import namedtuple
 
 from logging.handlers import TimedRotatingFileHandler
 
-from util import mac_addr_is_unicast
+from acl import acl_metadata
+from flowtable import FlowTable
+from hostcache import HostCacheEntry, LinkNeighbor
+from neighbor import NeighborScheduler
+from util import ExpiryQueue, LRUCache, mac_addr_is_unicast
 
-from ryu.lib import ofctl_v1_3 as ofctl
 from ryu.lib import mac
 from ryu.lib.packet import arp, ethernet, icmp, icmpv6, ipv4, ipv6, packet
 from ryu.lib.packet import vlan as packet_vlan
@@ -37,19 +40,32 @@ from ryu.ofproto import ofproto_v1_3_parser as parser
 import aruba.aruba_pipeline as aruba
 
 
-class LinkNeighbor(object):
+# Matches and instructions are not changed once built, so identical
+# ones are shared between flows instead of being built again.
+MATCH_CACHE = LRUCache(8192)
+INST_CACHE = LRUCache(256)
 
-    def __init__(self, eth_src, now):
-        self.eth_src = eth_src
-        self.cache_time = now
 
+class TokenBucket(object):
+    """Allows rate events per second on average, and up to burst at once."""
 
-class HostCacheEntry(object):
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_time = now
+        self.dropped = 0
 
-    def __init__(self, eth_src, permanent, now):
-        self.eth_src = eth_src
-        self.permanent = permanent
-        self.cache_time = now
+    def allow(self, now):
+        """Return True if an event at now is allowed, and count it."""
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        self.dropped += 1
+        return False
 
 
 def valve_factory(dp):
@@ -65,9 +81,17 @@ def valve_factory(dp):
         'Open vSwitch': Valve,
         'ZodiacFX': Valve,
     }
+    # Hardware that can write and match metadata, so each ACL is
+    # installed once for all ports that apply it.
+    SHARED_ACL_HARDWARE = ('NoviFlow', 'Open vSwitch')
+    # Hardware supporting OpenFlow 1.3 bundles (ONF extension 230), so
+    # the datapath is programmed atomically when it connects.
+    BUNDLE_HARDWARE = ('Open vSwitch',)
 
     if dp.hardware in SUPPORTED_HARDWARE:
-        return SUPPORTED_HARDWARE[dp.hardware](dp)
+        return SUPPORTED_HARDWARE[dp.hardware](
+            dp, shared_acls=dp.hardware in SHARED_ACL_HARDWARE,
+            use_bundles=dp.hardware in BUNDLE_HARDWARE)
     else:
         return None
 
@@ -82,10 +106,38 @@ class Valve(object):
 
     FAUCET_MAC = '0e:00:00:00:00:01'
 
-    def __init__(self, dp, logname='faucet', *args, **kwargs):
+    def __init__(self, dp, logname='faucet', shared_acls=False,
+                 use_bundles=False, *args, **kwargs):
         self.dp = dp
         self.logger = logging.getLogger(logname)
         self.ofchannel_logger = None
+        # If True, the VLAN table writes the ACL of the input port in
+        # the metadata, and each ACL's flows are installed once, matching
+        # the metadata, instead of once per port.
+        self.shared_acls = shared_acls
+        # If True, the flows sent when the datapath connects are sent in
+        # a bundle.
+        self.use_bundles = use_bundles
+        # (vid, eth_src) -> (in_port, time) the host was last learned on,
+        # to ignore packet-ins from the host on that port until its flows
+        # are installed.
+        self.learn_holddown = {}
+        # (vid, HostCacheEntry) of learned hosts, by when they expire.
+        self.host_expiry = ExpiryQueue()
+        # when to resolve the gateways of routes.
+        self.neighbor_scheduler = NeighborScheduler(
+            self.dp.arp_neighbor_timeout)
+        # port number -> TokenBucket limiting the port's packet-ins.
+        self.packet_in_limiters = {}
+        self.packet_in_stats = {
+            'received': 0,
+            'rate_limited': 0,
+            'learn_suppressed': 0,
+            'learned': 0,
+        }
+        # Model of the config flows programmed in the datapath, or None
+        # before the datapath first connects.
+        self.flow_table = None
 
     def switch_features(self, dp_id, msg):
         """Send configuration flows necessary for the switch implementation.
@@ -128,7 +180,25 @@ class Valve(object):
 
     @staticmethod
     def goto_table(table_id):
-        return parser.OFPInstructionGotoTable(table_id)
+        inst_key = ('goto', table_id)
+        inst = INST_CACHE.get(inst_key)
+        if inst is None:
+            inst = INST_CACHE.put(
+                inst_key, parser.OFPInstructionGotoTable(table_id))
+        return inst
+
+    @staticmethod
+    def output_controller():
+        inst_key = ('controller',)
+        inst = INST_CACHE.get(inst_key)
+        if inst is None:
+            inst = INST_CACHE.put(
+                inst_key,
+                parser.OFPInstructionActions(
+                    ofp.OFPIT_APPLY_ACTIONS,
+                    [parser.OFPActionOutput(
+                        ofp.OFPP_CONTROLLER, max_len=256)]))
+        return inst
 
     @staticmethod
     def set_eth_src(eth_src):
@@ -191,7 +261,10 @@ class Valve(object):
                 match_dict['ipv6_dst'] = nw_dst_masked
         if eth_type is not None:
             match_dict['eth_type'] = eth_type
-        match = parser.OFPMatch(**match_dict)
+        match_key = tuple(sorted(match_dict.iteritems()))
+        match = MATCH_CACHE.get(match_key)
+        if match is None:
+            match = MATCH_CACHE.put(match_key, parser.OFPMatch(**match_dict))
         return match
 
     def ignore_dpid(self, dp_id):
@@ -261,8 +334,7 @@ class Valve(object):
             table_id,
             match=match,
             priority=priority,
-            inst=[self.apply_actions([parser.OFPActionOutput(
-                ofp.OFPP_CONTROLLER, max_len=256)])] + inst)
+            inst=[self.output_controller()] + inst)
 
     def delete_all_valve_flows(self):
         """Delete all flows from all FAUCET tables."""
@@ -326,7 +398,6 @@ class Valve(object):
     def add_default_flows(self):
         """Configure datapath with necessary default tables and rules."""
         ofmsgs = []
-        ofmsgs.extend(self.delete_all_valve_flows())
         ofmsgs.extend(self.add_default_drop_flows())
         ofmsgs.extend(self.add_vlan_flood_flow())
         ofmsgs.extend(self.add_controller_learn_flow())
@@ -339,12 +410,9 @@ class Valve(object):
 
         # add vlan ports
         for vlan in self.dp.vlans.itervalues():
-            self.logger.info('Configuring VLAN %s', vlan)
             vlan_ports = vlan.tagged + vlan.untagged
             for port in vlan_ports:
                 all_port_nums.add(port.number)
-            # install eth_dst_table flood ofmsgs
-            ofmsgs.extend(self.build_flood_rules(vlan))
 
         # add mirror ports.
         for port_num in self.dp.mirror_from_port.itervalues():
@@ -359,10 +427,39 @@ class Valve(object):
 
         # now configure all ports
         for port_num in all_port_nums:
-            ofmsgs.extend(self.port_add(self.dp.dp_id, port_num))
+            if self.ignore_port(port_num):
+                continue
+            self.port_up(port_num)
+            ofmsgs.extend(self.port_add_flows(port_num))
 
+        # and then each VLAN once, with its ports up.
+        for vlan in self.dp.vlans.itervalues():
+            self.logger.info('Configuring VLAN %s', vlan)
+            ofmsgs.extend(self.add_vlan_flows(vlan))
+
+        return ofmsgs
+
+    def add_vlan_flows(self, vlan):
+        """Return the flows of a VLAN, shared by its ports: its flood
+        rules, and its controller IP flows if any of its ports is up."""
+        ofmsgs = self.build_flood_rules(vlan)
+        if [port for port in vlan.get_ports() if port.running()]:
+            ofmsgs.extend(self.add_controller_ips(vlan.controller_ips, vlan))
         return ofmsgs
 
+    def config_flow_table(self, discovered_port_nums):
+        """Return the model of the flows the current config needs."""
+        ofmsgs = []
+        ofmsgs.extend(self.add_default_flows())
+        ofmsgs.extend(self.add_shared_acls())
+        ofmsgs.extend(self.add_ports_and_vlans(discovered_port_nums))
+        return FlowTable(ofmsgs)
+
+    def update_flow_table(self, ofmsgs):
+        """Apply config flowmods about to be sent to the flow table model."""
+        if self.flow_table is not None:
+            self.flow_table.apply(ofmsgs)
+
     @staticmethod
     def build_flood_ports_for_vlan(vlan_ports, eth_dst):
         ports = []
@@ -450,10 +547,20 @@ class Valve(object):
             discovered_port_nums = []
 
         self.logger.info('Configuring datapath')
-        ofmsgs = []
-        ofmsgs.extend(self.add_default_flows())
-        ofmsgs.extend(self.add_ports_and_vlans(discovered_port_nums))
+        self.clear_learn_holddown()
+        flow_table = self.config_flow_table(discovered_port_nums)
+        if self.flow_table is None:
+            # what the datapath has is unknown, so start from scratch.
+            ofmsgs = self.delete_all_valve_flows()
+            ofmsgs.extend(FlowTable().diff(flow_table))
+        else:
+            # the datapath may have kept its flows, or lost them if it
+            # restarted: add them all again (adding an existing flow
+            # does not interrupt traffic), and delete only stale ones.
+            ofmsgs = self.flow_table.diff(flow_table, readd=True)
+        self.flow_table = flow_table
         self.dp.running = True
+        self.schedule_gateways()
         return ofmsgs
 
     def datapath_disconnect(self, dp_id):
@@ -468,45 +575,42 @@ class Valve(object):
             self.logger.warning('Datapath down {0}'.format(dp_id))
         return []
 
+    def add_acl_flows(self, acl_num, **bind_fields):
+        """Return the flows of an ACL, matching bind_fields."""
+        ofmsgs = []
+        for acl_rule in self.dp.acl_rules[acl_num]:
+            ofmsgs.append(self.valve_flowmod(
+                self.dp.acl_table,
+                acl_rule.match(**bind_fields),
+                priority=acl_rule.priority,
+                inst=acl_rule.instructions))
+        return ofmsgs
+
+    def add_shared_acls(self):
+        """In shared ACL mode, add the flows of the ACLs applied to
+        ports."""
+        ofmsgs = []
+        if self.shared_acls:
+            for acl_num in sorted(set(self.dp.acl_in.itervalues())):
+                ofmsgs.extend(self.add_acl_flows(
+                    acl_num, metadata=acl_metadata(acl_num)))
+        return ofmsgs
+
     def port_add_acl(self, port_num):
+        """Return the ACL flows of a port, and the instructions that send
+        its packets from the VLAN table to the ACL (if any)."""
         ofmsgs = []
-        forwarding_table = self.dp.eth_src_table
+        forwarding_inst = [self.goto_table(self.dp.eth_src_table)]
         if port_num in self.dp.acl_in:
             acl_num = self.dp.acl_in[port_num]
-            forwarding_table = self.dp.acl_table
-            acl_rule_priority = self.dp.highest_priority
-            acl_allow_inst = self.goto_table(self.dp.eth_src_table)
-            for rule_conf in self.dp.acls[acl_num]:
-                acl_inst = []
-                match_dict = {}
-                for attrib, attrib_value in rule_conf.iteritems():
-                    if attrib == "actions":
-                        if 'mirror' in attrib_value:
-                            port_no = attrib_value['mirror']
-                            acl_inst.append(
-                                    self.apply_actions([
-                                    parser.OFPActionOutput(port_no)]))
-                        if attrib_value['allow'] == 1:
-                            acl_inst.append(acl_allow_inst)
-                        continue
-                    if attrib == 'in_port':
-                        continue
-                    match_dict[attrib] = attrib_value
-                # override in_port always
-                match_dict['in_port'] = port_num
-                # to_match() needs to access parser via dp
-                # this uses the old API, which is oh so convenient
-                # (transparently handling masks for example).
-                null_dp = namedtuple('null_dp', 'ofproto_parser')
-                null_dp.ofproto_parser = parser
-                acl_match = ofctl.to_match(null_dp, match_dict)
-                ofmsgs.append(self.valve_flowmod(
-                    self.dp.acl_table,
-                    acl_match,
-                    priority=acl_rule_priority,
-                    inst=acl_inst))
-                acl_rule_priority -= 1
-        return ofmsgs, forwarding_table
+            forwarding_inst = [self.goto_table(self.dp.acl_table)]
+            if self.shared_acls:
+                forwarding_inst.insert(
+                    0, parser.OFPInstructionWriteMetadata(
+                        *acl_metadata(acl_num)))
+            else:
+                ofmsgs.extend(self.add_acl_flows(acl_num, in_port=port_num))
+        return ofmsgs, forwarding_inst
 
     def add_controller_ips(self, controller_ips, vlan):
         ofmsgs = []
@@ -562,16 +666,14 @@ class Valve(object):
                     priority=self.dp.highest_priority))
         return ofmsgs
 
-    def port_add_vlan_untagged(self, port, vlan, forwarding_table, mirror_act):
+    def port_add_vlan_untagged(self, port, vlan, forwarding_inst, mirror_act):
         ofmsgs = []
-        ofmsgs.extend(self.add_controller_ips(vlan.controller_ips, vlan))
         push_vlan_act = mirror_act + [
             parser.OFPActionPushVlan(ether.ETH_TYPE_8021Q),
             parser.OFPActionSetField(vlan_vid=vlan.vid|ofp.OFPVID_PRESENT)]
         push_vlan_inst = [
-            self.apply_actions(push_vlan_act),
-            self.goto_table(forwarding_table)
-        ]
+            self.apply_actions(push_vlan_act)
+        ] + forwarding_inst
         null_vlan = namedtuple('null_vlan', 'vid')
         null_vlan.vid = ofp.OFPVID_NONE
         ofmsgs.append(self.valve_flowmod(
@@ -579,15 +681,11 @@ class Valve(object):
             self.valve_in_match(in_port=port.number, vlan=null_vlan),
             priority=self.dp.low_priority,
             inst=push_vlan_inst))
-        ofmsgs.extend(self.build_flood_rules(vlan))
         return ofmsgs
 
-    def port_add_vlan_tagged(self, port, vlan, forwarding_table, mirror_act):
+    def port_add_vlan_tagged(self, port, vlan, forwarding_inst, mirror_act):
         ofmsgs = []
-        ofmsgs.extend(self.add_controller_ips(vlan.controller_ips, vlan))
-        vlan_inst = [
-            self.goto_table(forwarding_table)
-        ]
+        vlan_inst = forwarding_inst
         if mirror_act:
             vlan_inst = [self.apply_actions(mirror_act)] + vlan_inst
         ofmsgs.append(self.valve_flowmod(
@@ -595,22 +693,17 @@ class Valve(object):
             self.valve_in_match(in_port=port.number, vlan=vlan),
             priority=self.dp.low_priority,
             inst=vlan_inst))
-        ofmsgs.extend(self.build_flood_rules(vlan))
         return ofmsgs
 
-    def port_add_vlans(self, port, forwarding_table, mirror_act):
+    def port_add_vlans(self, port, forwarding_inst, mirror_act):
         ofmsgs = []
-        vlans = self.dp.vlans.values()
-        tagged_vlans_with_port = [
-            vlan for vlan in vlans if port in vlan.tagged]
-        untagged_vlans_with_port = [
-            vlan for vlan in vlans if port in vlan.untagged]
-        for vlan in tagged_vlans_with_port:
+        for vlan in self.dp.get_tagged_vlans(port.number):
             ofmsgs.extend(self.port_add_vlan_tagged(
-                port, vlan, forwarding_table, mirror_act))
-        for vlan in untagged_vlans_with_port:
+                port, vlan, forwarding_inst, mirror_act))
+        native_vlan = self.dp.get_native_vlan(port.number)
+        if native_vlan is not None:
             ofmsgs.extend(self.port_add_vlan_untagged(
-                port, vlan, forwarding_table, mirror_act))
+                port, native_vlan, forwarding_inst, mirror_act))
         return ofmsgs
 
     def port_add(self, dp_id, port_num):
@@ -624,7 +717,19 @@ class Valve(object):
         A list of flow mod messages to be sent to the datapath."""
         if self.ignore_dpid(dp_id) or self.ignore_port(port_num):
             return []
+        port = self.port_up(port_num)
+        ofmsgs = self.port_add_flows(port_num)
+        if port.running():
+            # the port floods now, and may be the first up on a VLAN.
+            for vlan in self.dp.port_vlans(port_num):
+                ofmsgs.extend(self.add_vlan_flows(vlan))
+        self.update_flow_table(ofmsgs)
+        self.clear_learn_holddown()
+        return ofmsgs
 
+    def port_up(self, port_num):
+        """Record port port_num is up, configuring it with the default
+        config if it is not configured, and return it."""
         if port_num not in self.dp.ports:
             self.logger.info(
                 'Autoconfiguring port:%u based on default config', port_num)
@@ -633,7 +738,15 @@ class Valve(object):
         port = self.dp.ports[port_num]
         self.logger.info('Port added {0}'.format(port))
         port.phys_up = True
+        return port
+
+    def port_add_flows(self, port_num):
+        """Return the flows to configure port port_num (but not the
+        flows of its VLANs), if it is running."""
+        if self.ignore_port(port_num) or port_num not in self.dp.ports:
+            return []
 
+        port = self.dp.ports[port_num]
         if not port.running():
             return []
 
@@ -645,15 +758,10 @@ class Valve(object):
             ofmsgs.append(self.valve_flowdel(table, in_port_match))
 
         # if this port is used as mirror port in any acl - drop input packets
-        for acl in self.dp.acls.values():
-             for rule_conf in acl:
-                 for attrib, attrib_value in rule_conf.iteritems():
-                     if attrib == "actions":
-                         if 'mirror' in attrib_value:
-                             port_no = attrib_value['mirror']
-                             ofmsgs.append(self.valve_flowdrop(
-                                 self.dp.vlan_table,
-                                 self.valve_in_match(in_port=port_no)))
+        if port_num in self.dp.acl_mirror_ports():
+            ofmsgs.append(self.valve_flowdrop(
+                self.dp.vlan_table,
+                in_port_match))
 
         if port_num in self.dp.mirror_from_port.values():
             # this is a mirror port - drop all input packets
@@ -668,9 +776,9 @@ class Valve(object):
             mirror_port_num = self.dp.mirror_from_port[port_num]
             mirror_act = [parser.OFPActionOutput(mirror_port_num)]
 
-        acl_ofmsgs, forwarding_table = self.port_add_acl(port_num)
+        acl_ofmsgs, forwarding_inst = self.port_add_acl(port_num)
         ofmsgs.extend(acl_ofmsgs)
-        ofmsgs.extend(self.port_add_vlans(port, forwarding_table, mirror_act))
+        ofmsgs.extend(self.port_add_vlans(port, forwarding_inst, mirror_act))
         return ofmsgs
 
     def port_delete(self, dp_id, port_num):
@@ -689,6 +797,19 @@ class Valve(object):
 
         self.logger.warning('Port down: {0}'.format(port))
 
+        ofmsgs = self.delete_port_flows(port_num)
+        ofmsgs.append(parser.OFPBarrierRequest(None))
+        self.clear_learn_holddown()
+
+        # the port no longer floods.
+        for vlan in self.dp.port_vlans(port_num):
+            ofmsgs.extend(self.build_flood_rules(vlan, modify=True))
+
+        self.update_flow_table(ofmsgs)
+        return ofmsgs
+
+    def delete_port_flows(self, port_num):
+        """Delete all flows matching a port, and hosts learned on it."""
         ofmsgs = []
 
         # delete all rules matching this port in all tables.
@@ -700,15 +821,16 @@ class Valve(object):
         ofmsgs.append(self.valve_flowdel(
             self.dp.eth_dst_table,
             out_port=port_num))
-
-        ofmsgs.append(parser.OFPBarrierRequest(None))
-
-        for vlan in self.dp.vlans.values():
-            if port_num in vlan.tagged or port_num in vlan.untagged:
-                ofmsgs.extend(self.build_flood_rules(vlan), modify=True)
-
         return ofmsgs
 
+    def delete_vlan_hosts(self, vlan):
+        """Delete the hosts and routes learned on a VLAN."""
+        return [
+            self.valve_flowdel(
+                self.dp.eth_src_table, self.valve_in_match(vlan=vlan)),
+            self.valve_flowdel(
+                self.dp.eth_dst_table, self.valve_in_match(vlan=vlan))]
+
     def delete_host_from_vlan(self, eth_src, vlan):
         ofmsgs = []
         # delete any existing ofmsgs for this vlan/mac combination on the
@@ -741,37 +863,56 @@ class Valve(object):
             pkt.add_protocol(eth_pkt)
         return pkt
 
-    def add_resolved_route(self, eth_type, vlan, neighbor_cache,
-                           ip_gw, ip_dst, eth_dst, is_updated=None):
+    def route_priority(self, ip_dst):
+        """Return the priority of a route's flow: above the controller
+        IP flows, and higher for longer prefixes so the switch matches
+        the longest prefix."""
+        return self.dp.highest_priority + 1 + ip_dst.prefixlen
+
+    def add_resolved_route(self, eth_type, vlan, ip_gw, ip_dst, eth_dst,
+                           is_updated):
+        """Return the flow routing ip_dst via ip_gw, now at eth_dst.
+
+        The flow is added even if ip_gw's MAC changed, as an add replaces
+        the flow with the same match and priority, and installs it if the
+        switch no longer has it."""
+        in_match = self.valve_in_match(
+            vlan=vlan, eth_type=eth_type,
+            nw_dst=ip_dst, eth_dst=self.FAUCET_MAC)
+        if is_updated:
+            self.logger.info('Updating next hop for route %s via %s (%s)',
+                    ip_dst, ip_gw, eth_dst)
+        else:
+            self.logger.info('Adding new route %s via %s (%s)',
+                    ip_dst, ip_gw, eth_dst)
+        return self.valve_flowmod(
+            self.dp.eth_src_table,
+            in_match,
+            priority=self.route_priority(ip_dst),
+            inst=[self.apply_actions(
+                [self.set_eth_src(self.FAUCET_MAC),
+                 self.set_eth_dst(eth_dst),
+                 self.dec_ip_ttl()])] +
+                [self.goto_table(self.dp.eth_dst_table)])
+
+    def update_nexthop(self, eth_type, vlan, neighbor_cache, ip_gw, eth_dst):
+        """Return the flows of the routes via ip_gw, resolved to eth_dst.
+
+        Only the routes via ip_gw are visited, and none if ip_gw's MAC
+        did not change."""
+        prefixes = vlan.routes_via(ip_gw)
+        if not prefixes:
+            return []
         ofmsgs = []
-        if is_updated is not None:
-            in_match = self.valve_in_match(
-                vlan=vlan, eth_type=eth_type,
-                nw_dst=ip_dst, eth_dst=self.FAUCET_MAC)
-            priority = self.dp.highest_priority + 1
-            if is_updated:
-                self.logger.info('Updating next hop for route %s via %s (%s)',
-                        ip_dst, ip_gw, eth_dst)
-                ofmsgs.append(self.valve_flowdel(
-                    self.dp.eth_src_table,
-                    in_match,
-                    priority=priority))
-            else:
-                self.logger.info('Adding new route %s via %s (%s)',
-                        ip_dst, ip_gw, eth_dst)
-
-            ofmsgs.append(self.valve_flowmod(
-                self.dp.eth_src_table,
-                in_match,
-                priority=priority,
-                inst=[self.apply_actions(
-                    [self.set_eth_src(self.FAUCET_MAC),
-                     self.set_eth_dst(eth_dst),
-                     self.dec_ip_ttl()])] +
-                    [self.goto_table(self.dp.eth_dst_table)]))
+        link_neighbor = neighbor_cache.get(ip_gw)
+        if link_neighbor is None or link_neighbor.eth_src != eth_dst:
+            is_updated = link_neighbor is not None
+            for ip_dst in sorted(prefixes):
+                ofmsgs.append(self.add_resolved_route(
+                    eth_type, vlan, ip_gw, ip_dst, eth_dst, is_updated))
         now = time.time()
-        link_neighbor = LinkNeighbor(eth_dst, now)
-        neighbor_cache[ip_gw] = link_neighbor
+        neighbor_cache[ip_gw] = LinkNeighbor(eth_dst, now)
+        self.neighbor_scheduler.resolved(vlan.vid, ip_gw, now)
         return ofmsgs
 
     def control_plane_arp_handler(self, in_port, vlan, eth_src, arp_pkt):
@@ -791,20 +932,9 @@ class Valve(object):
         elif arp_pkt.opcode == arp.ARP_REPLY:
             resolved_ip_gw = ipaddr.IPv4Address(arp_pkt.src_ip)
             self.logger.info('ARP response %s for %s', eth_src, resolved_ip_gw)
-            is_updated = None
-            if resolved_ip_gw in vlan.arp_cache:
-                cached_eth_dst = vlan.arp_cache[resolved_ip_gw].eth_src
-                if cached_eth_dst != eth_src:
-                    is_updated = True
-            else:
-                is_updated = False
-
-            for ip_dst, ip_gw in vlan.ipv4_routes.iteritems():
-                if ip_gw == resolved_ip_gw:
-                    ofmsgs.extend(
-                        self.add_resolved_route(
-                            ether.ETH_TYPE_IP, vlan, vlan.arp_cache,
-                            ip_gw, ip_dst, eth_src, is_updated))
+            ofmsgs.extend(self.update_nexthop(
+                ether.ETH_TYPE_IP, vlan, vlan.arp_cache,
+                resolved_ip_gw, eth_src))
 
         return ofmsgs
 
@@ -853,19 +983,9 @@ class Valve(object):
         elif icmpv6_pkt.type_ == icmpv6.ND_NEIGHBOR_ADVERT:
             resolved_ip_gw = ipaddr.IPv6Address(icmpv6_pkt.data.dst)
             self.logger.info('ND response %s for %s', eth_src, resolved_ip_gw)
-            is_updated = None
-            if resolved_ip_gw in vlan.nd_cache:
-                cached_eth_dst = vlan.nd_cache[resolved_ip_gw].eth_src
-                if cached_eth_dst != eth_src:
-                    is_updated = True
-            else:
-                is_updated = False
-            for ip_dst, ip_gw in vlan.ipv6_routes.iteritems():
-                if ip_gw == resolved_ip_gw:
-                    flowmods.extend(
-                        self.add_resolved_route(
-                            ether.ETH_TYPE_IPV6, vlan, vlan.nd_cache,
-                            ip_gw, ip_dst, eth_src,is_updated))
+            flowmods.extend(self.update_nexthop(
+                ether.ETH_TYPE_IPV6, vlan, vlan.nd_cache,
+                resolved_ip_gw, eth_src))
         elif icmpv6_pkt.type_ == icmpv6.ICMPV6_ECHO_REQUEST:
             dst = ipv6_pkt.dst
             ipv6_reply = ipv6.ipv6(
@@ -948,9 +1068,23 @@ class Valve(object):
             idle_timeout=learn_timeout))
         return ofmsgs
 
-    def handle_control_plane(self, in_port, vlan, eth_src, eth_dst, pkt):
+    def to_control_plane(self, vlan, eth_dst, pkt_fields):
+        """Return True if a packet may be an ARP, ICMP or ICMPv6 packet
+        for FAUCET, and needs to be decoded."""
+        if eth_dst != self.FAUCET_MAC and mac_addr_is_unicast(eth_dst):
+            return False
+        ip_addresses = pkt_fields.ip_addresses()
+        if ip_addresses is None:
+            return False
+        # ARP replies are recognized by eth_dst.
+        return (eth_dst == self.FAUCET_MAC or
+                self.to_faucet_ip(vlan, *ip_addresses))
+
+    def handle_control_plane(self, in_port, vlan, eth_src, eth_dst,
+                             pkt_fields):
         flowmods = []
-        if eth_dst == self.FAUCET_MAC or not mac_addr_is_unicast(eth_dst):
+        if self.to_control_plane(vlan, eth_dst, pkt_fields):
+            pkt = pkt_fields.decode()
             arp_pkt = pkt.get_protocol(arp.arp)
             ipv4_pkt = pkt.get_protocol(ipv4.ipv4)
             ipv6_pkt = pkt.get_protocol(ipv6.ipv6)
@@ -985,6 +1119,49 @@ class Valve(object):
 
         return flowmods
 
+    def packet_in_allowed(self, in_port, now):
+        """Return True if the packet-in rate limit of a port allows a
+        packet-in."""
+        if not self.dp.packet_in_rate:
+            return True
+        limiter = self.packet_in_limiters.get(in_port)
+        if limiter is None:
+            limiter = TokenBucket(
+                self.dp.packet_in_rate, self.dp.packet_in_burst, now)
+            self.packet_in_limiters[in_port] = limiter
+        return limiter.allow(now)
+
+    def learn_held_down(self, vlan, eth_src, in_port, now):
+        """Return True if a host was learned on a port very recently, and
+        should not be learned again.
+
+        A host that moved to another port is learned at once."""
+        holddown = self.learn_holddown.get((vlan.vid, eth_src))
+        if holddown is None:
+            return False
+        learn_port, learn_time = holddown
+        return (learn_port == in_port and
+                now - learn_time < self.dp.learn_holddown)
+
+    def start_learn_holddown(self, vlan, eth_src, in_port, now):
+        """Hold down relearning a host just learned on a port."""
+        self.learn_holddown[(vlan.vid, eth_src)] = (in_port, now)
+
+    def clear_learn_holddown(self):
+        """Allow all hosts to be learned again (their flows were
+        deleted)."""
+        self.learn_holddown = {}
+
+    def get_packet_in_stats(self):
+        """Return the packet-in counters, and packet-ins dropped by the
+        rate limit per port."""
+        stats = dict(self.packet_in_stats)
+        stats['rate_limited_ports'] = dict(
+            (port_num, limiter.dropped)
+            for port_num, limiter in self.packet_in_limiters.iteritems()
+            if limiter.dropped)
+        return stats
+
     def rcv_packet(self, dp_id, in_port, vlan_vid, pkt):
         """Generate openflow msgs to update datapath upon receipt of packet.
         This involves asssociating the ethernet source address of the packet
@@ -1000,16 +1177,20 @@ class Valve(object):
             int)
         in_port -- the port number of the port that received the packet
         vlan_vid -- the vlan_vid tagged to the packet.
-        pkt -- the packet send to us (Ryu ethernet object).
+        pkt -- the fields of the packet send to us (PacketFields object).
 
         Returns
         A list of flow mod messages to be sent to the datpath."""
         flowmods = []
         if (not self.ignore_dpid(dp_id) and not self.ignore_port(in_port) and
             self.dp.running and in_port in self.dp.ports):
-            eth_pkt = pkt.get_protocol(ethernet.ethernet)
-            eth_src = eth_pkt.src
-            eth_dst = eth_pkt.dst
+            now = time.time()
+            self.packet_in_stats['received'] += 1
+            if not self.packet_in_allowed(in_port, now):
+                self.packet_in_stats['rate_limited'] += 1
+                return flowmods
+            eth_src = pkt.eth_src
+            eth_dst = pkt.eth_dst
             vlan = self.dp.vlans[vlan_vid]
             port = self.dp.ports[in_port]
 
@@ -1021,6 +1202,14 @@ class Valve(object):
                 flowmods.extend(self.handle_control_plane(
                     in_port, vlan, eth_src, eth_dst, pkt))
 
+                # the host's flows may not be installed yet.
+                if self.learn_held_down(vlan, eth_src, in_port, now):
+                    self.packet_in_stats['learn_suppressed'] += 1
+                    host_cache_entry = vlan.host_cache.get(eth_src)
+                    if host_cache_entry is not None:
+                        host_cache_entry.cache_time = now
+                    return flowmods
+
                 # ban learning new hosts if max_hosts reached on a VLAN.
                 if (vlan.max_hosts is not None and
                     len(vlan.host_cache) == vlan.max_hosts and
@@ -1037,11 +1226,17 @@ class Valve(object):
                 else:
                     flowmods.extend(self.learn_host_on_vlan_port(
                         port, vlan, eth_src))
+                    self.start_learn_holddown(vlan, eth_src, in_port, now)
                     host_cache_entry = HostCacheEntry(
                         eth_src,
                         port.permanent_learn,
-                        time.time())
+                        now)
                     vlan.host_cache[eth_src] = host_cache_entry
+                    if not host_cache_entry.permanent:
+                        self.host_expiry.push(
+                            now + self.dp.timeout,
+                            (vlan.vid, host_cache_entry))
+                    self.packet_in_stats['learned'] += 1
                     self.logger.info('learned %u hosts on vlan %u',
                         len(vlan.host_cache), vlan.vid)
         return flowmods
@@ -1053,11 +1248,104 @@ class Valve(object):
         new_dp -- A new DP object containing the updated config."""
         flowmods = []
         if self.dp.running:
-            self.dp = new_dp
-            flowmods = self.datapath_connect(
-                self.dp.dp_id, self.dp.ports.keys())
+            changes = self.dp.config_changes(new_dp)
+            if changes is None:
+                self.logger.info('DP config changed, reconfiguring datapath')
+                self.dp = new_dp
+                self.flow_table = None
+                flowmods = self.datapath_connect(
+                    self.dp.dp_id, self.dp.ports.keys())
+            else:
+                flowmods = self.apply_config_changes(new_dp, changes)
         return flowmods
 
+    def apply_config_changes(self, new_dp, changes):
+        """Switch to new_dp, reprogramming only the ports and VLANs in
+        changes (a ConfigChanges).
+
+        Port state and the hosts, ARP and ND neighbors learned on VLANs
+        that did not change are kept."""
+        old_dp = self.dp
+        self.logger.info(
+            'Reloading config, ports deleted:%s changed:%s added:%s '
+            'VLANs deleted:%s changed:%s added:%s',
+            *[sorted(items) for items in changes])
+        for port_num, port in new_dp.ports.iteritems():
+            if port_num in old_dp.ports:
+                port.phys_up = old_dp.ports[port_num].phys_up
+        for vid, vlan in new_dp.vlans.iteritems():
+            if vid in old_dp.vlans and vid not in changes.changed_vlans:
+                old_vlan = old_dp.vlans[vid]
+                vlan.host_cache = old_vlan.host_cache
+                vlan.arp_cache = old_vlan.arp_cache
+                vlan.nd_cache = old_vlan.nd_cache
+        new_dp.running = True
+        self.dp = new_dp
+
+        # forget what was learned on deleted or changed ports and VLANs.
+        self.clear_learn_holddown()
+        ofmsgs = []
+        for vid in changes.deleted_vlans | changes.changed_vlans:
+            ofmsgs.extend(self.delete_vlan_hosts(old_dp.vlans[vid]))
+        for port_num in changes.deleted_ports:
+            ofmsgs.extend(self.delete_port_flows(port_num))
+        self.flow_table.apply(ofmsgs)
+
+        # regenerate the flows of changed ports, the flood and controller
+        # flows of their VLANs and of changed VLANs, and changed shared
+        # ACLs.
+        ports = changes.changed_ports | changes.added_ports
+        vids = (changes.changed_vlans | changes.added_vlans |
+                changes.deleted_vlans)
+        for port_num in ports | changes.deleted_ports:
+            for dp in (old_dp, self.dp):
+                if port_num in dp.ports:
+                    vids.update(
+                        vlan.vid for vlan in dp.port_vlans(port_num))
+        # ports that are down, and added ports until they come up, get
+        # no flows.
+        flow_table = FlowTable()
+        for port_num in sorted(ports):
+            flow_table.apply(self.port_add_flows(port_num))
+        for vid in sorted(vids):
+            if vid in self.dp.vlans:
+                flow_table.apply(self.add_vlan_flows(self.dp.vlans[vid]))
+        acl_nums = self.changed_shared_acls(old_dp)
+        for acl_num in sorted(acl_nums):
+            if acl_num in self.dp.acl_in.values():
+                flow_table.apply(self.add_acl_flows(
+                    acl_num, metadata=acl_metadata(acl_num)))
+
+        # and replace the old flows of those ports and VLANs with them.
+        keys = set()
+        for port_num in ports | changes.deleted_ports:
+            keys.update(self.flow_table.keys_matching('in_port', port_num))
+        for vid in vids:
+            for key in self.flow_table.keys_matching(
+                    'vlan_vid', vid | ofp.OFPVID_PRESENT):
+                if key[0] in (self.dp.flood_table, self.dp.eth_src_table):
+                    keys.add(key)
+        for acl_num in acl_nums:
+            keys.update(self.flow_table.keys_matching(
+                'metadata', acl_metadata(acl_num)))
+        ofmsgs.extend(self.flow_table.diff(
+            flow_table, keys=keys | set(flow_table.flows)))
+        self.flow_table.merge(keys, flow_table)
+        self.schedule_gateways()
+        return ofmsgs
+
+    def changed_shared_acls(self, old_dp):
+        """In shared ACL mode, return the ACLs whose rules, or whether
+        any port applies them, differ between old_dp and the DP."""
+        if not self.shared_acls:
+            return set()
+        old_acl_nums = set(old_dp.acl_in.itervalues())
+        acl_nums = set(self.dp.acl_in.itervalues())
+        return set(
+            acl_num for acl_num in old_acl_nums | acl_nums
+            if (acl_num not in old_acl_nums & acl_nums or
+                old_dp.acls[acl_num] != self.dp.acls[acl_num]))
+
     def arp_for_ip_gw(self, ip_gw, controller_ip, vlan, ports):
         flowmods = []
         if ports:
@@ -1112,52 +1400,96 @@ class Valve(object):
                 flowmods.append(self.valve_packetout(port.number, pkt.data))
         return flowmods
 
-    def resolve_gateways(self):
-        # TODO: implement longest prefix match priority
+    def gateway_controller_ips(self, vlan, ip_gw):
+        return [controller_ip for controller_ip in vlan.controller_ips
+                if ip_gw in controller_ip]
+
+    def schedule_gateways(self, now=None):
+        """Schedule the resolution of the gateways of the current
+        config's routes, that are on a controller IP's subnet."""
+        if now is None:
+            now = time.time()
+        gateways = {}
+        for vlan in self.dp.vlans.itervalues():
+            for routes, neighbor_cache in (
+                    (vlan.ipv4_routes, vlan.arp_cache),
+                    (vlan.ipv6_routes, vlan.nd_cache)):
+                for ip_gw in routes.gateways():
+                    if self.gateway_controller_ips(vlan, ip_gw):
+                        gateways[(vlan.vid, ip_gw)] = ip_gw in neighbor_cache
+        self.neighbor_scheduler.reachable_time = self.dp.arp_neighbor_timeout
+        self.neighbor_scheduler.set_gateways(gateways, now)
+
+    def next_resolve_time(self):
+        """Return when resolve_gateways() next has gateways to resolve,
+        or None if there are none."""
+        if not self.dp.running:
+            return None
+        return self.neighbor_scheduler.next_due_time()
+
+    def resolve_gateways(self, now=None):
+        """Resolve the gateways that are due.
+
+        Returns
+        A list of packet outs of ARP requests and ND solicitations.
+        """
         if not self.dp.running:
             return []
+        if now is None:
+            now = time.time()
         flowmods = []
-        now = time.time()
-        for vlan in self.dp.vlans.itervalues():
-            untagged_ports = self.build_flood_ports_for_vlan(
-                vlan.untagged, None)
-            tagged_ports = self.build_flood_ports_for_vlan(
-                vlan.tagged, None)
-            for routes, neighbor_cache, neighbor_resolver in (
-                    (vlan.ipv4_routes, vlan.arp_cache, self.arp_for_ip_gw),
-                    (vlan.ipv6_routes, vlan.nd_cache, self.nd_solicit_ip_gw)):
-                for ip_gw in set(routes.values()):
-                    for controller_ip in vlan.controller_ips:
-                        if ip_gw in controller_ip:
-                            cache_age = None
-                            if ip_gw in neighbor_cache:
-                                cache_time = neighbor_cache[ip_gw].cache_time
-                                cache_age = now - cache_time
-                            if (cache_age is None or
-                                cache_age > self.dp.arp_neighbor_timeout):
-                                for ports in untagged_ports, tagged_ports:
-                                    flowmods.extend(neighbor_resolver(
-                                        ip_gw, controller_ip, vlan, ports))
+        vlan_flood_ports = {}
+        for neighbor in self.neighbor_scheduler.pop_due(now):
+            vlan = self.dp.vlans[neighbor.vid]
+            ip_gw = neighbor.ip_gw
+            if vlan.vid not in vlan_flood_ports:
+                vlan_flood_ports[vlan.vid] = (
+                    self.build_flood_ports_for_vlan(vlan.untagged, None),
+                    self.build_flood_ports_for_vlan(vlan.tagged, None))
+            if ip_gw.version == 4:
+                neighbor_resolver = self.arp_for_ip_gw
+            else:
+                neighbor_resolver = self.nd_solicit_ip_gw
+            for controller_ip in self.gateway_controller_ips(vlan, ip_gw):
+                for ports in vlan_flood_ports[vlan.vid]:
+                    flowmods.extend(neighbor_resolver(
+                        ip_gw, controller_ip, vlan, ports))
         return flowmods
 
-    def host_expire(self):
+    def host_expire(self, now=None):
+        """Expire the hosts not seen for the DP's timeout.
+
+        Returns
+        A list of flow mod messages deleting the expired hosts' flows."""
         if not self.dp.running:
-            return
-        now = time.time()
-        for vlan in self.dp.vlans.itervalues():
-            expired_hosts = []
-            for eth_src, host_cache_entry in vlan.host_cache.iteritems():
-                if not host_cache_entry.permanent:
-                    host_cache_entry_age = now - host_cache_entry.cache_time
-                    if host_cache_entry_age > self.dp.timeout:
-                        expired_hosts.append(eth_src)
-            if expired_hosts:
-                for eth_src in expired_hosts:
-                    del vlan.host_cache[eth_src]
-                    self.logger.info('expiring host %s from vlan %u',
-                        eth_src, vlan.vid)
-                self.logger.info('%u recently active hosts on vlan %u',
-                        len(vlan.host_cache), vlan.vid)
+            return []
+        if now is None:
+            now = time.time()
+        for learn_key, (_, learn_time) in self.learn_holddown.items():
+            if now - learn_time >= self.dp.learn_holddown:
+                del self.learn_holddown[learn_key]
+        ofmsgs = []
+        expired_vlans = set()
+        for vid, host_cache_entry in self.host_expiry.pop_expired(now):
+            vlan = self.dp.vlans.get(vid)
+            eth_src = host_cache_entry.eth_src
+            # the host was relearned, or forgotten on a reload.
+            if (vlan is None or
+                    vlan.host_cache.get(eth_src) is not host_cache_entry):
+                continue
+            # the host was seen again since it was queued.
+            expire_time = host_cache_entry.cache_time + self.dp.timeout
+            if expire_time > now:
+                self.host_expiry.push(expire_time, (vid, host_cache_entry))
+                continue
+            del vlan.host_cache[eth_src]
+            self.logger.info('expiring host %s from vlan %u', eth_src, vid)
+            ofmsgs.extend(self.delete_host_from_vlan(eth_src, vlan))
+            expired_vlans.add(vlan)
+        for vlan in expired_vlans:
+            self.logger.info('%u recently active hosts on vlan %u',
+                    len(vlan.host_cache), vlan.vid)
+        return ofmsgs
 
 
 class ArubaValve(Valve):
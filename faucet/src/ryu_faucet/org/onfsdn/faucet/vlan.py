@@ -15,6 +15,9 @@
 
 import ipaddr
 
+from hostcache import HostCache, arp_cache, nd_cache
+from routetable import RouteTable
+
 
 class VLAN(object):
 
@@ -28,6 +31,9 @@ class VLAN(object):
         self.vid = vid
         self.tagged = []
         self.untagged = []
+        # numbers of the ports in tagged and untagged, for O(1) lookups.
+        self.tagged_port_nums = set()
+        self.untagged_port_nums = set()
         self.name = conf.setdefault('name', str(vid))
         self.description = conf.setdefault('description', self.name)
         self.controller_ips = conf.setdefault('controller_ips', [])
@@ -36,22 +42,19 @@ class VLAN(object):
                 ipaddr.IPNetwork(ip) for ip in self.controller_ips]
         self.unicast_flood = conf.setdefault('unicast_flood', True)
         self.routes = conf.setdefault('routes', {})
-        self.ipv4_routes = {}
-        self.ipv6_routes = {}
+        self.ipv4_routes = RouteTable(4)
+        self.ipv6_routes = RouteTable(6)
         if self.routes:
             self.routes = [route['route'] for route in self.routes]
             for route in self.routes:
                 ip_gw = ipaddr.IPAddress(route['ip_gw'])
                 ip_dst = ipaddr.IPNetwork(route['ip_dst'])
                 assert(ip_gw.version == ip_dst.version)
-                if ip_gw.version == 4:
-                    self.ipv4_routes[ip_dst] = ip_gw
-                else:
-                    self.ipv6_routes[ip_dst] = ip_gw
-        self.arp_cache = {}
-        self.nd_cache = {}
+                self.add_route(ip_dst, ip_gw)
+        self.arp_cache = arp_cache()
+        self.nd_cache = nd_cache()
         self.max_hosts = conf.setdefault('max_hosts', None)
-        self.host_cache = {}
+        self.host_cache = HostCache()
 
     def __str__(self):
         port_list = [str(x) for x in self.get_ports()]
@@ -61,20 +64,43 @@ class VLAN(object):
     def get_ports(self):
         return self.tagged+self.untagged
 
+    def add_tagged(self, port):
+        if port.number not in self.tagged_port_nums:
+            self.tagged.append(port)
+            self.tagged_port_nums.add(port.number)
+
+    def add_untagged(self, port):
+        if port.number not in self.untagged_port_nums:
+            self.untagged.append(port)
+            self.untagged_port_nums.add(port.number)
+
+    def remove_port(self, port_number):
+        self.tagged = [p for p in self.tagged if p.number != port_number]
+        self.untagged = [p for p in self.untagged if p.number != port_number]
+        self.tagged_port_nums.discard(port_number)
+        self.untagged_port_nums.discard(port_number)
+
+    def route_table(self, version):
+        if version == 4:
+            return self.ipv4_routes
+        return self.ipv6_routes
+
+    def add_route(self, ip_dst, ip_gw):
+        self.route_table(ip_dst.version)[ip_dst] = ip_gw
+
+    def del_route(self, ip_dst):
+        del self.route_table(ip_dst.version)[ip_dst]
+
+    def routes_via(self, ip_gw):
+        """Return the prefixes routed via a gateway."""
+        return self.route_table(ip_gw.version).prefixes_via(ip_gw)
+
     def contains_port(self, port_number):
-        for port in self.get_ports():
-            if port.number == port_number:
-                return True
-        return False
+        return (port_number in self.tagged_port_nums or
+                port_number in self.untagged_port_nums)
 
     def port_is_tagged(self, port_number):
-        for port in self.tagged:
-            if port.number == port_number:
-                return True
-        return False
+        return port_number in self.tagged_port_nums
 
     def port_is_untagged(self, port_number):
-        for port in self.untagged:
-            if port.number == port_number:
-                return True
-        return False
+        return port_number in self.untagged_port_nums
@@ -0,0 +1,348 @@
+#!/usr/bin/python
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks of valve hot paths.
+
+    python benchmark_valve.py [benchmark ...]
+
+Runs all benchmarks if none are named.
+"""
+
+import sys, os
+testdir = os.path.dirname(__file__)
+srcdir = '../src/ryu_faucet/org/onfsdn/faucet'
+sys.path.insert(0, os.path.abspath(os.path.join(testdir, srcdir)))
+
+import ipaddr
+import logging
+import random
+import socket
+import threading
+import time
+
+from ryu.lib.packet import ethernet, packet, vlan
+
+from hostcache import HostCache, HostCacheEntry
+from ofbatch import send_msgs
+from packet_fields import parse_packet_in
+from routetable import RouteTable
+from valve import Valve
+
+from test_ofbatch import FakeDatapath
+from test_valve import DP_ID, build_dp, udp_pkt
+
+logging.getLogger('benchmark').addHandler(logging.NullHandler())
+logging.getLogger('benchmark').propagate = False
+
+
+def timed(func, repeat):
+    """Return the mean seconds a call to func takes."""
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+def acl_rules(rule_count):
+    return [
+        {'rule': {
+            'dl_type': 0x800,
+            'nw_dst': '10.%u.%u.0/24' % (i / 256, i % 256),
+            'nw_proto': 6,
+            'tp_dst': 80 + i % 2,
+            'actions': {'allow': i % 2}}}
+        for i in range(rule_count)]
+
+
+def benchmark_acl(rule_count=2000, ports=10):
+    """Time compiling an ACL and installing it on a port."""
+    dp = build_dp()
+    rules = acl_rules(rule_count)
+    print('compile %u rule ACL: %.3f s' % (
+        rule_count, timed(lambda: dp.add_acl(1, rules), 1)))
+    for port_num in dp.ports:
+        dp.acl_in[port_num] = 1
+    valve = Valve(dp, 'benchmark')
+    port_nums = iter(range(1, ports + 1))
+    print('%u rule ACL per port setup: %.3f s' % (
+        rule_count,
+        timed(lambda: valve.port_add_acl(next(port_nums)), ports)))
+
+
+def benchmark_shared_acl(rule_count=1000):
+    """Compare flowmods and time to program a DP applying one ACL on
+    all ports, per port and shared."""
+    dp = build_dp()
+    dp.add_acl(1, acl_rules(rule_count))
+    for port_num in dp.ports:
+        dp.acl_in[port_num] = 1
+    for shared_acls in (False, True):
+        valve = Valve(dp, 'benchmark', shared_acls=shared_acls)
+        start = time.time()
+        ofmsgs = valve.datapath_connect(dp.dp_id, [])
+        print('%u rule ACL on %u ports, shared %s: %u flowmods, %.3f s' % (
+            rule_count, len(dp.ports), shared_acls, len(ofmsgs),
+            time.time() - start))
+
+
+def ryu_parse_packet_in(data):
+    """Decode a packet-in with Ryu, as before the fast path."""
+    pkt = packet.Packet(data)
+    pkt.get_protocols(ethernet.ethernet)[0]
+    return pkt.get_protocols(vlan.vlan)[0].vid
+
+
+def benchmark_packet_in(count=20000):
+    """Compare packet-ins parsed per second by Ryu and the fast path,
+    and handled per second by the valve."""
+    data = udp_pkt(
+        'ff:ff:ff:ff:ff:ff', '0e:00:00:00:00:02', 100,
+        '10.0.0.1', '10.0.0.255')
+    for name, parse in (
+            ('ryu', ryu_parse_packet_in), ('fast path', parse_packet_in)):
+        print('%s parse: %.0f packet-ins/s' % (
+            name, 1 / timed(lambda: parse(data), count)))
+    dp = build_dp()
+    dp.packet_in_rate = 0
+    valve = Valve(dp, 'benchmark')
+    valve.datapath_connect(DP_ID, [])
+    new_hosts = iter([
+        udp_pkt('ff:ff:ff:ff:ff:ff', '0e:00:00:00:%02x:%02x' % divmod(i, 256),
+                100, '10.0.0.1', '10.0.0.255')
+        for i in range(count / 10)])
+
+    def rcv_packet(data):
+        pkt = parse_packet_in(data)
+        valve.rcv_packet(DP_ID, 1, pkt.vid, pkt)
+
+    print('rcv_packet, new hosts: %.0f packet-ins/s' % (1 / timed(
+        lambda: rcv_packet(next(new_hosts)), count / 10)))
+    print('rcv_packet, duplicates: %.0f packet-ins/s' % (1 / timed(
+        lambda: rcv_packet(data), count)))
+
+
+class SocketDatapath(FakeDatapath):
+    """Writes to a socket, like Ryu's datapath send loop."""
+
+    def __init__(self):
+        super(SocketDatapath, self).__init__()
+        self.socket, peer = socket.socketpair()
+        self.reader = threading.Thread(target=self.read, args=(peer,))
+        self.reader.start()
+
+    @staticmethod
+    def read(peer):
+        while peer.recv(65536):
+            pass
+
+    def send(self, buf):
+        self.writes.append(len(buf))
+        self.socket.sendall(buf)
+        return True
+
+    def close(self):
+        self.socket.close()
+        self.reader.join()
+
+
+def benchmark_connect_send(rule_count=200):
+    """Compare sending the flows of a datapath connecting one message
+    per write and in one write."""
+    dp = build_dp()
+    dp.add_acl(1, acl_rules(rule_count))
+    for port_num in dp.ports:
+        dp.acl_in[port_num] = 1
+
+    def send_each(datapath, ofmsgs):
+        for ofmsg in ofmsgs:
+            ofmsg.datapath = datapath
+            datapath.set_xid(ofmsg)
+            ofmsg.serialize()
+            datapath.send(ofmsg.buf)
+
+    for name, send in (('per message', send_each), ('batched', send_msgs)):
+        ofmsgs = Valve(dp, 'benchmark').datapath_connect(DP_ID, [])
+        datapath = SocketDatapath()
+        start = time.time()
+        send(datapath, ofmsgs)
+        datapath.close()
+        print('send %u messages %s: %u writes, %.3f s' % (
+            len(ofmsgs), name, len(datapath.writes), time.time() - start))
+
+
+def benchmark_port_storm(rounds=5):
+    """Time all ports of a datapath going down and up, and sending the
+    resulting messages."""
+    dp = build_dp(controller_ips=['10.0.0.254/24', 'fc00::1/64'])
+    valve = Valve(dp, 'benchmark')
+    datapath = FakeDatapath()
+    send_msgs(datapath, valve.datapath_connect(DP_ID, dp.ports.keys()))
+
+    def port_storm():
+        for port_num in dp.ports:
+            send_msgs(datapath, valve.port_delete(DP_ID, port_num))
+            send_msgs(datapath, valve.port_add(DP_ID, port_num))
+
+    print('%u ports down and up: %.3f s' % (
+        len(dp.ports), timed(port_storm, rounds)))
+
+
+def benchmark_host_expire(hosts=20000):
+    """Time an expiry tick with many learned hosts, none or all due."""
+    dp = build_dp()
+    dp.packet_in_rate = 0
+    dp.max_hosts = None
+    valve = Valve(dp, 'benchmark')
+    valve.datapath_connect(DP_ID, [])
+    for i in range(hosts):
+        pkt = parse_packet_in(udp_pkt(
+            'ff:ff:ff:ff:ff:ff', '0e:00:00:%02x:%02x:%02x' % (
+                i >> 16, (i >> 8) & 0xff, i & 0xff),
+            100, '10.0.0.1', '10.0.0.255'))
+        valve.rcv_packet(DP_ID, 1, pkt.vid, pkt)
+    now = time.time()
+    print('%u hosts, expiry tick with none due: %.6f s' % (
+        hosts, timed(lambda: valve.host_expire(now), 100)))
+    start = time.time()
+    ofmsgs = valve.host_expire(now + dp.timeout + 1)
+    print('%u hosts, expiry tick with all due: %u flowmods, %.3f s' % (
+        hosts, len(ofmsgs), time.time() - start))
+
+
+def object_size(obj, seen=None):
+    """Return the bytes used by obj and the objects it refers to."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.iteritems():
+            size += object_size(key, seen) + object_size(value, seen)
+    if hasattr(obj, '__dict__'):
+        size += object_size(obj.__dict__, seen)
+    for slot in getattr(type(obj), '__slots__', ()):
+        size += object_size(getattr(obj, slot, None), seen)
+    return size
+
+
+class DictHostCacheEntry(object):
+    """A host cache entry, as before the compact caches."""
+
+    def __init__(self, eth_src, permanent, now):
+        self.eth_src = eth_src
+        self.permanent = permanent
+        self.cache_time = now
+
+
+def benchmark_host_cache(hosts=100000):
+    """Compare the memory used by a dict of hosts and a HostCache."""
+    macs = ['0e:00:00:%02x:%02x:%02x' % (i >> 16, (i >> 8) & 0xff, i & 0xff)
+            for i in range(hosts)]
+    now = time.time()
+    dict_cache = {}
+    host_cache = HostCache()
+    for i, mac in enumerate(macs):
+        dict_cache[mac] = DictHostCacheEntry(mac, False, now + i)
+        host_cache[mac] = HostCacheEntry(mac, False, now + i)
+    for name, size in (
+            ('dict', object_size(dict_cache)),
+            ('HostCache', object_size(host_cache.entries))):
+        print('%u hosts in a %s: %.1f MB, %u bytes per host' % (
+            hosts, name, size / 1e6, size / hosts))
+    print('HostCache lookup: %.0f/s' % (1 / timed(
+        lambda: host_cache[macs[0]], hosts)))
+
+
+def benchmark_route_table(prefixes=100000, lookups=10000):
+    """Time building a route table, and longest prefix match lookups
+    in it compared with checking every route."""
+    rand = random.Random(1)
+    ip_gws = [ipaddr.IPAddress('10.0.0.%u' % i) for i in range(1, 101)]
+    ip_dsts = set()
+    while len(ip_dsts) < prefixes:
+        prefixlen = rand.randint(8, 32)
+        network = rand.getrandbits(32) & (
+            ((1 << prefixlen) - 1) << (32 - prefixlen))
+        ip_dsts.add(ipaddr.IPNetwork(
+            '%s/%u' % (ipaddr.IPAddress(network), prefixlen)))
+    routes = RouteTable(4)
+    start = time.time()
+    for i, ip_dst in enumerate(ip_dsts):
+        routes[ip_dst] = ip_gws[i % len(ip_gws)]
+    print('%u prefix route table built: %.3f s' % (
+        len(routes), time.time() - start))
+    addresses = iter([
+        ipaddr.IPAddress(rand.getrandbits(32)) for _ in range(lookups)])
+    print('%u prefix LPM lookup: %.0f/s' % (len(routes), 1 / timed(
+        lambda: routes.lookup(next(addresses)), lookups)))
+    address = ipaddr.IPAddress(rand.getrandbits(32))
+
+    def linear_lookup():
+        return max([ip_dst for ip_dst in routes.routes if address in ip_dst],
+                   key=lambda ip_dst: ip_dst.prefixlen)
+
+    print('%u prefix lookup checking every route: %.0f/s' % (
+        len(routes), 1 / timed(linear_lookup, 3)))
+    print('%u prefix lookup of the routes via a gateway: %.0f/s' % (
+        len(routes), 1 / timed(lambda: routes.prefixes_via(ip_gws[0]), 1000)))
+
+
+def benchmark_resolve_gateways(gateways=1000):
+    """Time resolving gateways with none due, and count the requests
+    sent to gateways that never reply."""
+    dp = build_dp(controller_ips=['10.0.0.254/16'])
+    vlan_200 = dp.vlans[200]
+    for i in range(gateways):
+        vlan_200.add_route(
+            ipaddr.IPNetwork('10.%u.%u.0/24' % (100 + i / 256, i % 256)),
+            ipaddr.IPAddress('10.0.%u.%u' % (1 + i / 250, 1 + i % 250)))
+    valve = Valve(dp, 'benchmark')
+    valve.datapath_connect(DP_ID, dp.ports.keys())
+    now = time.time()
+    start = time.time()
+    requests = len(valve.resolve_gateways(now))
+    sweep_requests = requests
+    print('%u gateways due: %u requests, %.3f s' % (
+        gateways, requests, time.time() - start))
+    print('%u gateways, none due: %.6f s' % (
+        gateways, timed(lambda: valve.resolve_gateways(now + 1), 100)))
+    for tick in range(2, 600, 2):
+        requests += len(valve.resolve_gateways(now + tick))
+    print('%u unresolved gateways for 10 minutes: %u requests, '
+          'a sweep every 2 s would send %u' % (
+              gateways, requests, sweep_requests * 300))
+
+
+BENCHMARKS = {
+    'acl': benchmark_acl,
+    'host_cache': benchmark_host_cache,
+    'host_expire': benchmark_host_expire,
+    'port_storm': benchmark_port_storm,
+    'resolve_gateways': benchmark_resolve_gateways,
+    'route_table': benchmark_route_table,
+    'connect_send': benchmark_connect_send,
+    'packet_in': benchmark_packet_in,
+    'shared_acl': benchmark_shared_acl,
+}
+
+
+def main():
+    for name in sys.argv[1:] or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
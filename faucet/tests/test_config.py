@@ -72,6 +72,21 @@ class DistConfigTestCase(unittest.TestCase):
                 self.assertNotIn(port.number, untaggedports)
                 untaggedports.add(port.number)
 
+    def test_port_vlan_indexes(self):
+        self.assertEqual(self.dp.get_native_vlan(1), None)
+        self.assertEqual(self.dp.get_native_vlan(3).vid, 40)
+        self.assertEqual(
+            sorted(vlan.vid for vlan in self.dp.get_tagged_vlans(1)), [40, 41])
+        self.assertEqual(
+            sorted(vlan.vid for vlan in self.dp.port_vlans(3)), [40, 41])
+        self.assertTrue(self.dp.vlans[41].port_is_tagged(3))
+        self.assertTrue(self.dp.vlans[40].port_is_untagged(3))
+        self.assertFalse(self.dp.vlans[41].contains_port(2))
+        self.dp.delete_port(3)
+        self.assertEqual(self.dp.port_vlans(3), [])
+        self.assertFalse(self.dp.vlans[40].contains_port(3))
+        self.assertNotIn(3, [port.number for port in self.dp.vlans[41].tagged])
+
 if __name__ == "__main__":
     unittest.main()
 
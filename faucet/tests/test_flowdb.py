@@ -0,0 +1,316 @@
+#!/usr/bin/python
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys, os
+testdir = os.path.dirname(__file__)
+srcdir = '../src/ryu_faucet/org/onfsdn/faucet'
+sys.path.insert(0, os.path.abspath(os.path.join(testdir, srcdir)))
+
+import json
+import time
+import unittest
+
+from ryu.ofproto import ether
+from ryu.ofproto import ofproto_v1_3 as ofp
+from ryu.ofproto import ofproto_v1_3_parser as parser
+
+from dp import DP
+from flowdb import (
+    FlowDBWriter, dp_key, flow_decode, flow_doc_id, flow_encode)
+from migrate_flows import migrate
+from nsodbc import DatabaseCouch
+from test_nsodbc import LocalCouch, VIEWS
+
+DP_ID = 0xcafef00d
+barrier = parser.OFPBarrierRequest(None)
+
+
+def flowmod(table_id, priority=1, command=ofp.OFPFC_ADD,
+            out_port=ofp.OFPP_ANY, inst=None, **match):
+    if inst is None:
+        inst = []
+    return parser.OFPFlowMod(
+        datapath=None, table_id=table_id, priority=priority,
+        command=command, out_port=out_port,
+        match=parser.OFPMatch(**match), instructions=inst)
+
+
+def output(port):
+    return [parser.OFPInstructionActions(
+        ofp.OFPIT_APPLY_ACTIONS, [parser.OFPActionOutput(port)])]
+
+
+class FlowDBWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.switch_couch = LocalCouch(VIEWS)
+        self.flow_couch = LocalCouch(VIEWS)
+        self.switch_database = DatabaseCouch(self.switch_couch)
+        self.flow_database = DatabaseCouch(self.flow_couch)
+        self.switch_database.insert_update_doc(
+            {'_id': str(hex(DP_ID)), 'data': {}}, 'data')
+
+    def stored_flows(self):
+        return [doc for doc_id, doc in sorted(self.flow_couch.docs.items())
+                if not doc_id.startswith('_design/')]
+
+    def writer(self, **kwargs):
+        writer = FlowDBWriter(
+            self.switch_database, self.flow_database, **kwargs)
+        writer.create_views()
+        return writer
+
+    def test_tags(self):
+        dp = DP(DP_ID, 'test')
+        dp.add_port(1, {'native_vlan': 100, 'acl_in': 1})
+        writer = self.writer()
+        writer.set_dp(dp)
+        writer.add_flows(DP_ID, [
+            flowmod(dp.acl_table, in_port=1, inst=output(2)),
+            flowmod(dp.eth_dst_table, inst=output(2),
+                    vlan_vid=100 | ofp.OFPVID_PRESENT,
+                    eth_dst='0e:00:00:00:00:01'),
+            flowmod(dp.eth_dst_table, inst=output(3),
+                    vlan_vid=200 | ofp.OFPVID_PRESENT,
+                    eth_dst='0e:00:00:00:00:02'),
+            flowmod(dp.flood_table, inst=output(ofp.OFPP_CONTROLLER),
+                    vlan_vid=100 | ofp.OFPVID_PRESENT),
+            flowmod(dp.acl_table, 2, metadata=(2, 0xffffffff))])
+        writer.flush()
+        flows = dict(
+            ((flow['table_id'], flow['priority']), flow)
+            for flow in self.stored_flows())
+        self.assertEqual(
+            flows[(dp.acl_table, 1)]['tags'],
+            ['table:acl', 'in_port:1', 'out_port:2', 'acl:1'])
+        self.assertEqual(
+            flows[(dp.acl_table, 2)]['tags'], ['table:acl', 'acl:2'])
+        self.assertEqual(
+            flows[(dp.flood_table, 1)]['tags'], ['table:flood', 'vlan:100'])
+        flow_ids = writer.get_flow_ids(['table:eth_dst', 'vlan:100'])
+        self.assertEqual(len(flow_ids), 1)
+        self.assertEqual(
+            self.flow_couch.docs[flow_ids[0]]['match']['eth_dst'],
+            '0e:00:00:00:00:01')
+
+    def test_add_flows_does_not_write(self):
+        writer = self.writer()
+        self.flow_couch.requests = 0
+        writer.add_flows(DP_ID, [flowmod(0, in_port=1)])
+        self.assertEqual(self.flow_couch.requests, 0)
+        self.assertEqual(writer.stats['queued'], 1)
+
+    def test_flush_batches(self):
+        writer = self.writer(batch_size=50)
+        writer.add_flows(DP_ID, [flowmod(0, in_port=i) for i in range(120)])
+        self.flow_couch.requests = 0
+        self.switch_couch.requests = 0
+        writer.flush()
+        self.assertEqual(self.flow_couch.requests, 3)
+        self.assertEqual(self.switch_couch.requests, 0)
+        self.assertEqual(len(self.stored_flows()), 120)
+        self.assertEqual(writer.stats['written'], 120)
+        self.assertEqual(writer.stats['batches'], 3)
+
+    def test_delete_flows(self):
+        writer = self.writer()
+        writer.add_flows(DP_ID, [flowmod(0, in_port=i) for i in range(20)])
+        writer.add_flows(DP_ID + 1, [flowmod(0, in_port=1)])
+        writer.flush()
+        self.flow_couch.requests = 0
+        writer.delete_flows(DP_ID)
+        self.assertEqual(self.flow_couch.requests, 2)
+        self.assertEqual(
+            [doc['dp_id'] for doc in self.stored_flows()],
+            [str(hex(DP_ID + 1))])
+
+    def test_upsert_is_idempotent(self):
+        writer = self.writer()
+        for _ in range(3):
+            writer.add_flows(DP_ID, [
+                flowmod(1, command=ofp.OFPFC_DELETE, vlan_vid=4196,
+                        eth_src='0e:00:00:00:00:02'),
+                flowmod(1, 100, vlan_vid=4196, eth_src='0e:00:00:00:00:02',
+                        in_port=2)])
+            writer.flush()
+        writer.add_flows(DP_ID, [
+            flowmod(1, 100, vlan_vid=4196, eth_src='0e:00:00:00:00:02',
+                    in_port=2, inst=output(3))])
+        writer.flush()
+        flows = self.stored_flows()
+        self.assertEqual(len(flows), 1)
+        self.assertEqual(flows[0]['out_ports'], [3])
+
+    def test_deletes(self):
+        writer = self.writer()
+        writer.add_flows(DP_ID, [
+            flowmod(0, 10, in_port=1),
+            flowmod(0, 11, in_port=1, vlan_vid=4196),
+            flowmod(0, 10, in_port=2),
+            flowmod(2, 10, eth_dst='0e:00:00:00:00:02', inst=output(1)),
+            flowmod(2, 10, eth_dst='0e:00:00:00:00:03', inst=output(2)),
+            barrier])
+        writer.flush()
+        self.assertEqual(len(self.stored_flows()), 5)
+        writer.add_flows(DP_ID, [
+            flowmod(0, 10, command=ofp.OFPFC_DELETE_STRICT, in_port=2),
+            flowmod(0, command=ofp.OFPFC_DELETE, in_port=1),
+            flowmod(2, command=ofp.OFPFC_DELETE, out_port=2)])
+        writer.flush()
+        self.assertEqual(
+            [flow['match'] for flow in self.stored_flows()],
+            [{'eth_dst': '0e:00:00:00:00:02'}])
+
+    def test_switch_record(self):
+        writer = self.writer()
+        self.switch_couch.requests = 0
+        writer.switch_connect(DP_ID)
+        self.assertEqual(self.switch_couch.requests, 2)
+        self.switch_couch.requests = 0
+        writer.switch_connect(DP_ID)
+        self.assertEqual(self.switch_couch.requests, 1)
+        writer.add_flows(DP_ID, [flowmod(0, in_port=1)])
+        writer.flush()
+        self.assertEqual(self.switch_couch.requests, 1)
+        writer.switch_disconnect(DP_ID)
+        self.assertEqual(self.switch_couch.requests, 2)
+        self.assertEqual(self.switch_couch.docs, {})
+
+    def test_overflow_drops(self):
+        writer = self.writer(queue_size=10, put_timeout=0)
+        writer.add_flows(DP_ID, [flowmod(0, in_port=i) for i in range(15)])
+        self.assertEqual(writer.stats['queued'], 10)
+        self.assertEqual(writer.stats['overflows'], 5)
+        self.assertEqual(writer.stats['dropped'], 5)
+
+    def test_overflow_waits_once(self):
+        writer = self.writer(queue_size=10, put_timeout=0.05)
+        start = time.time()
+        writer.add_flows(DP_ID, [flowmod(0, in_port=i) for i in range(100)])
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(writer.stats['queued'], 10)
+        self.assertEqual(writer.stats['dropped'], 90)
+
+    def test_flush_writes_taken_batch(self):
+        writer = self.writer(flush_interval=0)
+        writer.add_flows(DP_ID, [flowmod(0, in_port=i) for i in range(5)])
+        # the writer thread took a batch, and has not written it yet.
+        self.assertEqual(len(writer._get_batch()), 5)
+        writer.add_flows(DP_ID, [flowmod(0, in_port=5)])
+        writer.flush()
+        self.assertEqual(len(self.stored_flows()), 6)
+        self.assertEqual(writer.pending, [])
+
+    def test_flush_write_error(self):
+        writer = self.writer()
+        writer.add_flows(DP_ID, [flowmod(0, in_port=1)])
+        insert_update_docs = self.flow_database.insert_update_docs
+
+        def unavailable(docs):
+            raise IOError('database unavailable')
+
+        self.flow_database.insert_update_docs = unavailable
+        writer.flush()
+        self.assertEqual(writer.stats['write_errors'], 1)
+        self.assertEqual(len(writer.pending), 1)
+        self.flow_database.insert_update_docs = insert_update_docs
+        writer.flush()
+        self.assertEqual(len(self.stored_flows()), 1)
+        self.assertEqual(writer.pending, [])
+
+
+class FlowEncodingTestCase(unittest.TestCase):
+
+    FLOWS = [
+        flowmod(0, in_port=1, vlan_vid=(100 | ofp.OFPVID_PRESENT),
+                inst=[parser.OFPInstructionGotoTable(1)]),
+        flowmod(3, priority=9000, eth_dst='0e:00:00:00:00:01',
+                vlan_vid=100 | ofp.OFPVID_PRESENT,
+                inst=[parser.OFPInstructionActions(
+                    ofp.OFPIT_APPLY_ACTIONS, [
+                        parser.OFPActionPopVlan(),
+                        parser.OFPActionOutput(2)])]),
+        flowmod(2, priority=9001, eth_type=0x0800,
+                ipv4_dst=('10.0.0.0', '255.0.0.0'),
+                inst=[parser.OFPInstructionActions(
+                    ofp.OFPIT_APPLY_ACTIONS, [
+                        parser.OFPActionSetField(eth_dst='0e:00:00:00:00:02'),
+                        parser.OFPActionPushVlan(ether.ETH_TYPE_8021Q),
+                        parser.OFPActionSetField(vlan_vid=0x1064),
+                        parser.OFPActionDecNwTtl(),
+                        parser.OFPActionOutput(
+                            ofp.OFPP_CONTROLLER, max_len=128)]),
+                    parser.OFPInstructionWriteMetadata(1, 0xff),
+                    parser.OFPInstructionGotoTable(3)]),
+        flowmod(4, command=ofp.OFPFC_DELETE, out_port=3),
+    ]
+
+    def test_round_trip(self):
+        for flow_msg in self.FLOWS:
+            flow_msg.cookie = 1524372928
+            flow_msg.idle_timeout = 300
+            flow = flow_encode(flow_msg)
+            self.assertEqual(
+                flow_decode(flow).to_jsondict(), flow_msg.to_jsondict())
+            self.assertNotIn('buffer_id', flow)
+            self.assertEqual(flow['cookie'], 1524372928)
+
+    def test_compact(self):
+        flow_msg = self.FLOWS[2]
+        self.assertEqual(
+            flow_encode(flow_msg)['inst'][0],
+            ['apply', ['set', 'eth_dst', '0e:00:00:00:00:02'],
+             ['push_vlan', ether.ETH_TYPE_8021Q], ['set', 'vlan_vid', 0x1064],
+             ['dec_ttl'], ['out', ofp.OFPP_CONTROLLER, 128]])
+        self.assertLess(
+            len(json.dumps(flow_encode(flow_msg))),
+            len(json.dumps(flow_msg.to_jsondict())) / 2)
+
+    def test_migrate(self):
+        couch = LocalCouch(VIEWS)
+        database = DatabaseCouch(couch)
+        switch_database = DatabaseCouch(LocalCouch(VIEWS))
+        flow_ids = database.insert_update_docs(
+            [{'data': flow_msg.to_jsondict(), 'tags': []}
+             for flow_msg in self.FLOWS * 5] +
+            [{'data': barrier.to_jsondict(), 'tags': []}])
+        # a flow no switch lists.
+        database.insert_update_docs(
+            [{'data': self.FLOWS[0].to_jsondict(), 'tags': []}])
+        switch_database.insert_update_docs(
+            [{'_id': dp_key(DP_ID), 'data': {'flows': flow_ids}}])
+        stats = migrate(database, switch_database, batch_size=4, dry_run=True)
+        self.assertEqual(stats['migrated'], 15)
+        self.assertEqual(len(
+            [doc for doc in couch.docs.values() if 'data' in doc]), 22)
+        stats = migrate(database, switch_database, batch_size=4)
+        self.assertEqual(stats['docs'], 22)
+        self.assertEqual(stats['migrated'], 15)
+        # the deletes, the barrier and the unlisted flow.
+        self.assertEqual(stats['skipped'], 7)
+        self.assertLess(stats['bytes_after'], stats['bytes_before'] / 2)
+        # the old documents were replaced, one per flow.
+        docs = [doc for doc in couch.docs.values() if 'inst' in doc]
+        self.assertEqual(len(docs), 3)
+        self.assertEqual(len(couch.docs), 3 + 7)
+        for doc in docs:
+            self.assertEqual(doc['_id'], flow_doc_id(
+                DP_ID, doc['table_id'], doc['priority'], doc['match']))
+            self.assertEqual(doc['dp_id'], dp_key(DP_ID))
+            self.assertIn('table:%u' % doc['table_id'], doc['tags'])
+        self.assertEqual(
+            migrate(database, switch_database)['migrated'], 0)
+
+if __name__ == "__main__":
+    unittest.main()
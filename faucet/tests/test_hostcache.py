@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys, os
+testdir = os.path.dirname(__file__)
+srcdir = '../src/ryu_faucet/org/onfsdn/faucet'
+sys.path.insert(0, os.path.abspath(os.path.join(testdir, srcdir)))
+
+import copy
+import ipaddr
+import unittest
+
+from hostcache import (
+    HostCache, HostCacheEntry, IntKeyedCache, LinkNeighbor, arp_cache,
+    int_to_mac, mac_to_int, nd_cache)
+
+
+class HostCacheTestCase(unittest.TestCase):
+
+    def test_mac_int(self):
+        for mac in ('00:00:00:00:00:00', '0e:00:00:00:00:01',
+                    'ff:ff:ff:ff:ff:ff'):
+            self.assertEqual(int_to_mac(mac_to_int(mac)), mac)
+        self.assertEqual(mac_to_int('0e:00:00:00:01:02'), 0x0e0000000102)
+
+    def test_host_cache(self):
+        host_cache = HostCache()
+        entry = HostCacheEntry('0e:00:00:00:00:01', False, 1.0)
+        host_cache['0e:00:00:00:00:01'] = entry
+        host_cache['0e:00:00:00:00:02'] = HostCacheEntry(
+            '0e:00:00:00:00:02', True, 2.0)
+        self.assertIn('0e:00:00:00:00:01', host_cache)
+        self.assertNotIn('0e:00:00:00:00:03', host_cache)
+        self.assertIs(host_cache['0e:00:00:00:00:01'], entry)
+        self.assertIs(host_cache.get('0e:00:00:00:00:03'), None)
+        self.assertEqual(entry.eth_src, '0e:00:00:00:00:01')
+        self.assertEqual(
+            sorted(host_cache), ['0e:00:00:00:00:01', '0e:00:00:00:00:02'])
+        self.assertEqual(
+            sorted(host_cache.iteritems())[0], ('0e:00:00:00:00:01', entry))
+        del host_cache['0e:00:00:00:00:02']
+        self.assertEqual(host_cache, {'0e:00:00:00:00:01': entry})
+        self.assertRaises(KeyError, host_cache.__getitem__, '0e:00:00:00:00:02')
+        self.assertRaises(AttributeError, setattr, entry, 'other', 1)
+
+    def test_neighbor_caches(self):
+        cache = arp_cache()
+        neighbor = LinkNeighbor('0e:00:00:00:00:01', 1.0)
+        cache[ipaddr.IPv4Address('10.0.0.1')] = neighbor
+        self.assertIs(cache['10.0.0.1'], neighbor)
+        self.assertEqual(list(cache), [ipaddr.IPv4Address('10.0.0.1')])
+        self.assertEqual(cache[ipaddr.IPv4Address('10.0.0.1')].eth_src,
+                         '0e:00:00:00:00:01')
+        cache = nd_cache()
+        cache[ipaddr.IPv6Address('fc00::1')] = neighbor
+        self.assertIn(ipaddr.IPv6Address('fc00::1'), cache)
+        self.assertEqual(list(copy.deepcopy(cache)),
+                         [ipaddr.IPv6Address('fc00::1')])
+
+    def test_neighbor_cache_version(self):
+        cache = nd_cache()
+        neighbor = LinkNeighbor('0e:00:00:00:00:01', 1.0)
+        cache[ipaddr.IPv6Address('::a00:1')] = neighbor
+        # the same int as an IPv4 address.
+        ipv4_address = ipaddr.IPv4Address('10.0.0.1')
+        self.assertRaises(ValueError, cache.get, ipv4_address)
+        self.assertRaises(
+            ValueError, cache.__setitem__, ipv4_address, neighbor)
+        self.assertRaises(
+            ValueError, arp_cache().__contains__, ipaddr.IPv6Address('::1'))
+
+    def test_abstract_cache(self):
+        self.assertRaises(TypeError, IntKeyedCache)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys, os
+testdir = os.path.dirname(__file__)
+srcdir = '../src/ryu_faucet/org/onfsdn/faucet'
+sys.path.insert(0, os.path.abspath(os.path.join(testdir, srcdir)))
+
+import ipaddr
+import unittest
+
+from neighbor import (
+    INCOMPLETE, PROBE, REACHABLE, STALE, NeighborScheduler)
+
+GW1 = (100, ipaddr.IPAddress('10.0.0.1'))
+GW2 = (100, ipaddr.IPAddress('10.0.0.2'))
+
+
+class NeighborSchedulerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = NeighborScheduler(
+            300, retry_interval=2, max_retry_interval=16, max_probes=2)
+        self.scheduler.set_gateways({GW1: False, GW2: False}, 0)
+
+    def due(self, now):
+        return sorted(
+            (neighbor.vid, neighbor.ip_gw)
+            for neighbor in self.scheduler.pop_due(now))
+
+    def state(self, key):
+        return self.scheduler.neighbors[key].state
+
+    def test_backoff(self):
+        due_times = []
+        for now in range(0, 100):
+            if self.due(now):
+                due_times.append(now)
+        # retried after 2, 4, 8, then every 16 seconds.
+        self.assertEqual(due_times, [0, 2, 6, 14, 30, 46, 62, 78, 94])
+        self.assertEqual(self.state(GW1), INCOMPLETE)
+        self.assertEqual(self.scheduler.next_due_time(), 110)
+
+    def test_resolved_and_probed(self):
+        self.scheduler.set_gateways({GW1: False}, 0)
+        self.assertEqual(self.due(0), [GW1])
+        self.scheduler.resolved(GW1[0], GW1[1], 1)
+        self.assertEqual(self.state(GW1), REACHABLE)
+        self.assertEqual(self.due(2), [])
+        self.assertEqual(self.due(300), [])
+        self.assertEqual(self.due(301), [GW1])
+        self.assertEqual(self.state(GW1), PROBE)
+        self.assertEqual(self.due(303), [GW1])
+        self.assertEqual(self.state(GW1), PROBE)
+        # no reply to max_probes probes.
+        self.assertEqual(self.due(307), [GW1])
+        self.assertEqual(self.state(GW1), STALE)
+        self.scheduler.resolved(GW1[0], GW1[1], 308)
+        self.assertEqual(self.state(GW1), REACHABLE)
+        self.assertEqual(self.due(315), [])
+
+    def test_set_gateways(self):
+        self.assertEqual(self.due(0), [GW1, GW2])
+        self.scheduler.resolved(GW1[0], GW1[1], 1)
+        gw3 = (200, ipaddr.IPAddress('fc00::1'))
+        self.scheduler.set_gateways({GW1: True, gw3: False}, 5)
+        self.assertEqual(sorted(self.scheduler.neighbors), [GW1, gw3])
+        self.assertEqual(self.due(5), [gw3])
+        # GW1's neighbor cache was reset.
+        self.scheduler.set_gateways({GW1: False, gw3: False}, 6)
+        self.assertEqual(self.due(6), [GW1])
+        self.assertEqual(self.state(GW1), INCOMPLETE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,550 @@
+#!/usr/bin/python
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys, os
+testdir = os.path.dirname(__file__)
+srcdir = '../src/ryu_faucet/org/onfsdn/faucet'
+sys.path.insert(0, os.path.abspath(os.path.join(testdir, srcdir)))
+
+import copy
+import unittest
+import uuid
+from collections import namedtuple
+
+import couchdb
+
+from nsodbc import DatabaseCouch, CouchConnectionPool, couch_session
+from nsodbc import CachedDatabase
+from nsodbc import nsodbc_factory, todict
+
+Row = namedtuple('Row', 'id key value doc')
+
+
+class ViewResults(list):
+
+    @property
+    def rows(self):
+        return self
+
+# couchdb_views.js
+VIEWS = {
+    '_design/switches/_view/switch': lambda doc: [(doc['_id'], doc)],
+    '_design/flows/_view/flow': lambda doc: [(doc['_id'], doc)],
+    '_design/flows/_view/dp': lambda doc: [
+        ([doc['dp_id'], doc['table_id']],
+         {'rev': doc['_rev'], 'match': doc['match'],
+          'out_ports': doc['out_ports']})] if 'dp_id' in doc else [],
+    '_design/tags/_view/tags': lambda doc: [
+        (tag, doc) for tag in doc.get('tags', [])],
+    '_design/tags/_view/ids': lambda doc: [
+        (tag, None) for tag in doc.get('tags', [])],
+}
+
+
+def collate(key):
+    """Sort key for view keys, following CouchDB view collation."""
+    if key is None:
+        return (0,)
+    if isinstance(key, bool):
+        return (1, key)
+    if isinstance(key, (int, long, float)):
+        return (2, key)
+    if isinstance(key, basestring):
+        return (3, key)
+    if isinstance(key, (list, tuple)):
+        return (4, [collate(elem) for elem in key])
+    return (5,)
+
+
+class LocalCouch(object):
+    """A local stand-in for a couchdb.Database, with the same revision
+    and conflict semantics for the calls nsodbc makes."""
+
+    def __init__(self, views=None):
+        self.docs = {}
+        self.views = views or {}
+        self.requests = 0
+        self.seq = 0
+        self.change_log = {}
+
+    def _write(self, doc):
+        doc_id = doc.setdefault('_id', uuid.uuid4().hex)
+        stored = self.docs.get(doc_id)
+        if stored is not None and stored['_rev'] != doc.get('_rev'):
+            return (False, doc_id, couchdb.http.ResourceConflict('conflict'))
+        self.seq += 1
+        self.change_log[doc_id] = self.seq
+        if doc.get('_deleted'):
+            del self.docs[doc_id]
+            return (True, doc_id, doc['_rev'])
+        rev = 1 if stored is None else int(stored['_rev']) + 1
+        doc['_rev'] = str(rev)
+        self.docs[doc_id] = copy.deepcopy(doc)
+        return (True, doc_id, doc['_rev'])
+
+    def save(self, doc):
+        self.requests += 1
+        success, doc_id, rev = self._write(doc)
+        if not success:
+            raise rev
+        return doc_id, rev
+
+    def update(self, docs):
+        self.requests += 1
+        return [self._write(doc) for doc in docs]
+
+    def get(self, doc_id):
+        self.requests += 1
+        doc = self.docs.get(doc_id)
+        return copy.deepcopy(doc) if doc is not None else None
+
+    def delete(self, doc):
+        self.requests += 1
+        self._write(dict(doc, _deleted=True))
+
+    def changes(self, since=0, include_docs=False, **options):
+        self.requests += 1
+        if since == 'now':
+            return {'results': [], 'last_seq': self.seq}
+        results = []
+        for doc_id, seq in sorted(
+                self.change_log.items(), key=lambda change: change[1]):
+            if seq > since:
+                result = {'seq': seq, 'id': doc_id}
+                if include_docs:
+                    result['doc'] = copy.deepcopy(self.docs.get(doc_id))
+                results.append(result)
+        return {'results': results, 'last_seq': self.seq}
+
+    def view(self, name, keys=None, key=None, startkey=None, endkey=None,
+             include_docs=False, startkey_docid=None, limit=None):
+        self.requests += 1
+        if key is not None:
+            keys = [key]
+        rows = ViewResults()
+        if name == '_all_docs':
+            for key in keys:
+                doc = copy.deepcopy(self.docs.get(key))
+                value = None
+                if doc is not None:
+                    value = {'rev': doc['_rev']}
+                rows.append(Row(key, key, value, doc))
+            return rows
+        map_fun = self.views[name]
+        for doc_id in sorted(self.docs):
+            if doc_id.startswith('_design/'):
+                continue
+            doc = copy.deepcopy(self.docs[doc_id])
+            for row_key, value in map_fun(doc):
+                if keys is not None and row_key not in keys:
+                    continue
+                if (startkey is not None and
+                        collate(row_key) < collate(startkey)):
+                    continue
+                if endkey is not None and collate(row_key) > collate(endkey):
+                    continue
+                if (startkey_docid is not None and row_key == startkey and
+                        doc_id < startkey_docid):
+                    continue
+                rows.append(Row(
+                    doc_id, row_key, value, doc if include_docs else None))
+        if keys is not None:
+            rows.sort(key=lambda row: keys.index(row.key))
+        else:
+            rows.sort(key=lambda row: collate(row.key))
+        return ViewResults(rows[:limit])
+
+
+class DatabaseCouchBulkTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.couch = LocalCouch(VIEWS)
+        self.database = DatabaseCouch(self.couch)
+
+    def test_bulk_insert_single_request(self):
+        docs = [{'data': {'n': i}, 'tags': []} for i in range(300)]
+        doc_ids = self.database.insert_update_docs(docs)
+        self.assertEqual(self.couch.requests, 1)
+        self.assertEqual(len(doc_ids), 300)
+        self.assertEqual(len(set(doc_ids)), 300)
+        for i, doc_id in enumerate(doc_ids):
+            self.assertEqual(self.couch.docs[doc_id]['data'], {'n': i})
+
+    def test_bulk_update_conflict(self):
+        self.database.insert_update_doc({'_id': 'sw', 'data': {'flows': []}})
+        self.couch.requests = 0
+        doc_ids = self.database.insert_update_docs(
+            [{'_id': 'sw', 'data': {'flows': ['a']}}, {'_id': 'other'}],
+            'data')
+        self.assertEqual(doc_ids, ['sw', 'other'])
+        self.assertEqual(self.couch.docs['sw']['data'], {'flows': ['a']})
+        self.assertIn('other', self.couch.docs)
+        self.assertEqual(self.couch.requests, 3)
+
+    def test_bulk_replace_conflict(self):
+        self.database.insert_update_doc({'_id': 'flow', 'data': 1, 'x': 1})
+        self.database.insert_update_docs([{'_id': 'flow', 'data': 2}])
+        self.assertEqual(self.couch.docs['flow']['data'], 2)
+        self.assertNotIn('x', self.couch.docs['flow'])
+
+    def test_bulk_delete(self):
+        doc_ids = self.database.insert_update_docs([{}, {}, {}])
+        self.couch.requests = 0
+        self.database.delete_docs(
+            [{'_id': doc_id, '_rev': '1'} for doc_id in doc_ids[:2]])
+        self.assertEqual(self.couch.requests, 1)
+        self.assertEqual(self.couch.docs.keys(), doc_ids[2:])
+        self.couch.requests = 0
+        self.database.delete_docs([{'_id': doc_ids[2]}, {'_id': 'missing'}])
+        self.assertEqual(self.couch.requests, 2)
+        self.assertEqual(self.couch.docs, {})
+
+    def test_create_view(self):
+        view_url = self.database.create_view('flows', 'dp', 'function(doc){}')
+        self.assertEqual(view_url, '_design/flows/_view/dp')
+        self.database.create_view('flows', 'other', 'function(doc){}')
+        design = self.couch.docs['_design/flows']
+        self.assertEqual(sorted(design['views'].keys()), ['dp', 'other'])
+        self.couch.requests = 0
+        self.database.create_view('flows', 'dp', 'function(doc){}')
+        self.assertEqual(self.couch.requests, 1)
+
+    def test_empty_batch(self):
+        self.assertEqual(self.database.insert_update_docs([]), [])
+        self.assertEqual(self.couch.requests, 0)
+
+
+class CachedDatabaseTestCase(unittest.TestCase):
+
+    DP_VIEW = '_design/flows/_view/dp'
+    TAG_VIEW = '_design/tags/_view/tags'
+
+    def setUp(self):
+        self.couch = LocalCouch(VIEWS)
+        # writes by other applications, not through the cache.
+        self.other = DatabaseCouch(self.couch)
+        self.other.insert_update_docs([
+            self.flow('0x1', 1, ['vlan:100']),
+            self.flow('0x1', 2, ['vlan:200']),
+            self.flow('0x2', 1, ['vlan:100'])])
+        self.database = CachedDatabase(DatabaseCouch(self.couch), size=3)
+
+    @staticmethod
+    def flow(dp_id, n, tags):
+        return {'_id': '%s-%u' % (dp_id, n), 'dp_id': dp_id, 'table_id': 0,
+                'match': {'in_port': n}, 'out_ports': [], 'tags': tags}
+
+    def dp_flows(self, dp_id):
+        return self.database.get_docs(
+            self.DP_VIEW, startkey=[dp_id], endkey=[dp_id, {}])
+
+    def test_hit(self):
+        self.assertEqual(len(self.dp_flows('0x1')), 2)
+        self.couch.requests = 0
+        self.assertEqual(len(self.dp_flows('0x1')), 2)
+        self.assertEqual(self.couch.requests, 0)
+        self.assertEqual(self.database.stats['hits'], 1)
+
+    def test_own_writes(self):
+        self.dp_flows('0x1')
+        self.dp_flows('0x2')
+        self.database.insert_update_docs([self.flow('0x1', 3, [])])
+        self.assertEqual(len(self.dp_flows('0x1')), 3)
+        self.database.delete_docs([{'_id': '0x1-1'}])
+        self.assertEqual(len(self.dp_flows('0x1')), 2)
+        self.couch.requests = 0
+        self.assertEqual(len(self.dp_flows('0x2')), 1)
+        self.assertEqual(self.couch.requests, 0)
+
+    def test_changes_feed(self):
+        self.assertEqual(len(self.dp_flows('0x1')), 2)
+        self.assertEqual(
+            len(self.database.get_docs(self.TAG_VIEW, 'vlan:100')), 2)
+        self.assertEqual(
+            len(self.database.get_docs(self.TAG_VIEW, 'vlan:200')), 1)
+        self.other.insert_update_docs([
+            self.flow('0x1', 2, ['vlan:100']),
+            self.flow('0x1', 4, [])])
+        self.assertEqual(self.database.poll_changes(), 2)
+        self.assertEqual(len(self.dp_flows('0x1')), 3)
+        self.assertEqual(
+            len(self.database.get_docs(self.TAG_VIEW, 'vlan:100')), 3)
+        self.assertEqual(
+            len(self.database.get_docs(self.TAG_VIEW, 'vlan:200')), 0)
+        self.assertEqual(self.database.poll_changes(), 0)
+
+    def test_changed_during_fetch(self):
+        get_docs = self.database.database.get_docs
+
+        def fetch_then_change(view_url, **options):
+            rows = get_docs(view_url, **options)
+            # the changes thread runs while the fetch waits for the reply.
+            self.other.insert_update_docs([self.flow('0x1', 3, [])])
+            self.database.poll_changes()
+            return rows
+
+        self.database.database.get_docs = fetch_then_change
+        self.assertEqual(len(self.dp_flows('0x1')), 2)
+        self.database.database.get_docs = get_docs
+        self.assertEqual(self.database.entries, {})
+        self.assertEqual(len(self.dp_flows('0x1')), 3)
+
+    def test_lru_eviction(self):
+        for dp_id in ('0x1', '0x2', '0x3', '0x4'):
+            self.dp_flows(dp_id)
+        self.assertEqual(self.database.stats['evictions'], 1)
+        self.assertEqual(len(self.database.entries), 3)
+        self.dp_flows('0x1')
+        self.assertEqual(self.database.stats['misses'], 5)
+
+    def test_sqlite_changes(self):
+        conn = nsodbc_factory().connect('driver=sqlite;server=:memory:')
+        other = conn.create('flows_bak')
+        database = CachedDatabase(other)
+        other.insert_update_docs([self.flow('0x1', 1, [])])
+        self.assertEqual(
+            len(database.get_docs(
+                self.DP_VIEW, startkey=['0x1'], endkey=['0x1', {}])), 1)
+        other.delete_docs([{'_id': '0x1-1'}])
+        self.assertEqual(database.poll_changes(), 1)
+        self.assertEqual(
+            len(database.get_docs(
+                self.DP_VIEW, startkey=['0x1'], endkey=['0x1', {}])), 0)
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+
+    URL = 'http://localhost:5984/flows_bak'
+
+    class Conn(object):
+
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    def test_todict(self):
+        conn_dict = todict(
+            ('driver=couchdb;server=db1;uid=u;pwd=p;pool_size=4;retries=1',),
+            {'timeout': 5})
+        self.assertEqual(conn_dict['server'], 'db1')
+        self.assertEqual(conn_dict['pool_size'], '4')
+        self.assertEqual(conn_dict['retries'], '1')
+        self.assertEqual(conn_dict['timeout'], 5)
+
+    def test_shared_session(self):
+        nsodbc = nsodbc_factory()
+        conn_string = 'driver=couchdb;server=db2;uid=u;pwd=p;pool_size=4'
+        conn1 = nsodbc.connect(conn_string)
+        conn2 = nsodbc.connect(conn_string)
+        self.assertIs(conn1.conn.resource.session,
+                      conn2.conn.resource.session)
+        self.assertEqual(conn1.conn.resource.url, 'http://db2:5984/')
+        self.assertEqual(
+            conn1.conn.resource.session.connection_pool.size, 4)
+        self.assertIs(conn1.pool_stats(), conn2.pool_stats())
+        self.assertIsNot(
+            conn1.conn.resource.session, couch_session('http://db3:5984/'))
+
+    def test_pool_bound_and_stats(self):
+        pool = CouchConnectionPool(timeout=1, size=2)
+        conns = [self.Conn() for _ in range(3)]
+        for conn in conns:
+            pool.release(self.URL, conn)
+        self.assertTrue(conns[2].closed)
+        self.assertIs(pool.get(self.URL), conns[1])
+        self.assertEqual(pool.stats['hits'], 1)
+        for _ in range(2):
+            pool.acquire_slot()
+        self.assertFalse(pool.slots.acquire(blocking=False))
+        pool.release_slot()
+        pool.acquire_slot()
+        self.assertEqual(pool.stats['waits'], 0)
+
+
+class DatabaseSqliteTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = nsodbc_factory().connect('driver=sqlite;server=:memory:')
+        self.database = self.conn.create('flows_bak')
+
+    def flow(self, dp_id, table_id, n, tags=None):
+        return {'_id': '%s-%u-%u' % (dp_id, table_id, n),
+                'dp_id': dp_id, 'table_id': table_id,
+                'match': {'in_port': n}, 'out_ports': [],
+                'data': {}, 'tags': tags or []}
+
+    def test_insert_update_delete(self):
+        doc_id = self.database.insert_update_doc({'_id': 'sw', 'data': 1})
+        self.database.insert_update_doc({'_id': 'sw', 'data': 2}, 'data')
+        rows = self.database.get_docs(
+            '_design/switches/_view/switch', key='sw')
+        self.assertEqual(rows[0].value['data'], 2)
+        self.database.delete_doc(doc_id)
+        self.assertEqual(
+            self.database.get_docs('_design/switches/_view/switch', 'sw'),
+            [])
+
+    def test_flows_by_dp(self):
+        view_url = self.database.create_view('flows', 'dp', 'function(doc){}')
+        self.database.insert_update_docs(
+            [self.flow('0x1', table_id, n)
+             for table_id in range(3) for n in range(2)] +
+            [self.flow('0x2', 0, 0)])
+        rows = self.database.get_docs(view_url, key=['0x1', 1])
+        self.assertEqual([row.id for row in rows], ['0x1-1-0', '0x1-1-1'])
+        rows = self.database.get_docs(
+            view_url, startkey=['0x1'], endkey=['0x1', {}])
+        self.assertEqual(len(rows), 6)
+        self.database.delete_docs(
+            [{'_id': row.id, '_rev': row.value['rev']} for row in rows])
+        rows = self.database.get_docs(
+            view_url, startkey=['0x1', 0], endkey=['0x2', 0])
+        self.assertEqual([row.key for row in rows], [['0x2', 0]])
+        self.assertRaises(
+            ValueError, self.database.create_view, 'flows', 'x', '')
+
+    def test_tags(self):
+        self.database.insert_update_docs([
+            self.flow('0x1', 0, 1, tags=['vlan:100']),
+            self.flow('0x1', 0, 2, tags=['vlan:100', 'port:2'])])
+        rows = self.database.get_docs('_design/tags/_view/tags', 'vlan:100')
+        self.assertEqual(len(rows), 2)
+        self.database.insert_update_docs(
+            [self.flow('0x1', 0, 2, tags=['port:2'])])
+        rows = self.database.get_docs('_design/tags/_view/tags', 'vlan:100')
+        self.assertEqual([row.id for row in rows], ['0x1-0-1'])
+
+
+class DatabaseQueriesTestCase(unittest.TestCase):
+    """Multi-key, range and paginated queries, on couchdb and sqlite."""
+
+    VIEW = '_design/tags/_view/ids'
+
+    def databases(self):
+        conn = nsodbc_factory().connect('driver=sqlite;server=:memory:')
+        return [DatabaseCouch(LocalCouch(VIEWS)), conn.create('flows_bak')]
+
+    @staticmethod
+    def flows():
+        flows = []
+        for n in range(10):
+            tags = ['table:eth_dst', 'vlan:%u' % (100 + n % 2)]
+            if n < 3:
+                tags = ['table:flood', tags[1]]
+            flows.append({'_id': 'flow-%02u' % n, 'tags': tags})
+        return flows
+
+    def test_ids_only(self):
+        for database in self.databases():
+            database.insert_update_docs(self.flows())
+            rows = database.get_docs(self.VIEW, 'vlan:100')
+            self.assertEqual([row.value for row in rows], [None] * 5)
+            self.assertEqual(
+                database.get_doc_ids(self.VIEW, 'vlan:101'),
+                ['flow-01', 'flow-03', 'flow-05', 'flow-07', 'flow-09'])
+            rows = database.get_docs(
+                self.VIEW, 'table:flood', include_docs=True)
+            self.assertEqual(rows[0].doc['tags'], ['table:flood', 'vlan:100'])
+
+    def test_multi_key_and_range(self):
+        for database in self.databases():
+            database.insert_update_docs(self.flows())
+            rows = database.get_docs_by_keys(
+                self.VIEW, ['table:flood', 'vlan:101'])
+            self.assertEqual(
+                [row.key for row in rows], ['table:flood'] * 3 +
+                ['vlan:101'] * 5)
+            rows = database.get_docs_range(
+                self.VIEW, 'vlan:', u'vlan:\ufff0')
+            self.assertEqual(len(rows), 10)
+            self.assertEqual(
+                database.get_doc_ids_all(
+                    self.VIEW, ['table:eth_dst', 'vlan:100']),
+                ['flow-04', 'flow-06', 'flow-08'])
+
+    def test_pages(self):
+        for database in self.databases():
+            database.insert_update_docs(self.flows())
+            doc_ids = []
+            page = None
+            pages = 0
+            while True:
+                rows, page = database.get_docs_page(
+                    self.VIEW, 3, page, key='table:eth_dst')
+                doc_ids.extend(row.id for row in rows)
+                pages += 1
+                if page is None:
+                    break
+            self.assertEqual(pages, 3)
+            self.assertEqual(
+                doc_ids, ['flow-%02u' % n for n in range(3, 10)])
+
+    def test_by_id_keys_and_pages(self):
+        view_url = '_design/flows/_view/flow'
+        for database in self.databases():
+            database.insert_update_docs(self.flows())
+            rows = database.get_docs_by_keys(
+                view_url, ['flow-05', 'flow-99', 'flow-01'])
+            self.assertEqual([row.id for row in rows], ['flow-05', 'flow-01'])
+            self.assertEqual(
+                rows[0].value['tags'], ['table:eth_dst', 'vlan:101'])
+            doc_ids = []
+            page = None
+            while True:
+                rows, page = database.get_docs_page(
+                    view_url, 4, page, startkey='flow-02')
+                doc_ids.extend(row.id for row in rows)
+                if page is None:
+                    break
+            self.assertEqual(
+                doc_ids, ['flow-%02u' % n for n in range(2, 10)])
+
+    def test_flows_by_dp_pages(self):
+        view_url = '_design/flows/_view/dp'
+        for database in self.databases():
+            database.insert_update_docs([
+                {'_id': 'flow-%02u' % n, 'dp_id': '0x1', 'table_id': n % 2,
+                 'match': {}, 'out_ports': []} for n in range(7)])
+            doc_ids = []
+            page = None
+            while True:
+                rows, page = database.get_docs_page(
+                    view_url, 2, page, startkey=['0x1'], endkey=['0x1', {}])
+                doc_ids.extend(row.id for row in rows)
+                if page is None:
+                    break
+            self.assertEqual(
+                doc_ids, ['flow-00', 'flow-02', 'flow-04', 'flow-06',
+                          'flow-01', 'flow-03', 'flow-05'])
+
+    def test_cached_queries(self):
+        couch = LocalCouch(VIEWS)
+        cache = CachedDatabase(DatabaseCouch(couch))
+        cache.insert_update_docs(self.flows())
+        keys = ['table:eth_dst', 'vlan:100']
+        self.assertEqual(len(cache.get_doc_ids_all(self.VIEW, keys)), 3)
+        self.assertEqual(len(cache.get_doc_ids_all(self.VIEW, keys)), 3)
+        self.assertEqual(cache.stats['hits'], 1)
+        # only queries on the changed flow's tags are invalidated.
+        cache.get_doc_ids(self.VIEW, 'table:flood')
+        cache.insert_update_docs(
+            [{'_id': 'flow-10', 'tags': ['vlan:100', 'table:eth_dst']}])
+        self.assertEqual(len(cache.get_doc_ids_all(self.VIEW, keys)), 4)
+        cache.get_doc_ids(self.VIEW, 'table:flood')
+        self.assertEqual(cache.stats['hits'], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys, os
+testdir = os.path.dirname(__file__)
+srcdir = '../src/ryu_faucet/org/onfsdn/faucet'
+sys.path.insert(0, os.path.abspath(os.path.join(testdir, srcdir)))
+
+import struct
+import unittest
+
+from ryu.ofproto import ofproto_v1_3 as ofp
+from ryu.ofproto import ofproto_v1_3_parser as parser
+
+from ofbatch import SERIALIZED_FLOWMODS, coalesce_barriers, send_msgs
+from util import LRUCache
+
+OFP_HEADER = struct.Struct('!BBHI')
+
+
+class FakeDatapath(object):
+    """Records the writes to a datapath."""
+
+    ofproto = ofp
+    ofproto_parser = parser
+
+    def __init__(self):
+        self.xid = 0
+        self.writes = []
+
+    def set_xid(self, msg):
+        self.xid += 1
+        msg.set_xid(self.xid)
+        return self.xid
+
+    def send(self, buf):
+        self.writes.append(buf)
+        return True
+
+    def sent_msgs(self):
+        """Return the (type, xid) of the messages written."""
+        msgs = []
+        for buf in self.writes:
+            offset = 0
+            while offset < len(buf):
+                _, msg_type, msg_len, xid = OFP_HEADER.unpack_from(
+                    buffer(buf), offset)
+                msgs.append((msg_type, xid))
+                offset += msg_len
+        return msgs
+
+
+def flowmod(port):
+    return parser.OFPFlowMod(
+        datapath=None, table_id=0, match=parser.OFPMatch(in_port=port),
+        instructions=[])
+
+
+def barrier():
+    return parser.OFPBarrierRequest(None)
+
+
+class OFBatchTestCase(unittest.TestCase):
+
+    def test_coalesce_barriers(self):
+        ofmsgs = [barrier(), flowmod(1), barrier(), barrier(),
+                  flowmod(2), barrier()]
+        self.assertEqual(
+            [type(ofmsg) for ofmsg in coalesce_barriers(ofmsgs)],
+            [parser.OFPFlowMod, parser.OFPBarrierRequest,
+             parser.OFPFlowMod, parser.OFPBarrierRequest])
+
+    def test_one_write(self):
+        datapath = FakeDatapath()
+        send_msgs(datapath, [flowmod(i) for i in range(100)] + [barrier()])
+        self.assertEqual(len(datapath.writes), 1)
+        self.assertEqual(
+            datapath.sent_msgs(),
+            [(ofp.OFPT_FLOW_MOD, i) for i in range(1, 101)] +
+            [(ofp.OFPT_BARRIER_REQUEST, 101)])
+        self.assertEqual(send_msgs(datapath, []), [])
+        self.assertEqual(len(datapath.writes), 1)
+
+    def test_bundle(self):
+        datapath = FakeDatapath()
+        ofmsgs = send_msgs(
+            datapath, [flowmod(1), barrier(), flowmod(2)], bundle_id=7)
+        self.assertEqual(len(datapath.writes), 1)
+        self.assertEqual(
+            [ofmsg.type for ofmsg in ofmsgs if hasattr(ofmsg, 'type')],
+            [ofp.ONF_BCT_OPEN_REQUEST, ofp.ONF_BCT_CLOSE_REQUEST,
+             ofp.ONF_BCT_COMMIT_REQUEST])
+        self.assertEqual(
+            [ofmsg.message.match['in_port'] for ofmsg in ofmsgs
+             if isinstance(ofmsg, parser.ONFBundleAddMsg)], [1, 2])
+        self.assertEqual(
+            datapath.sent_msgs(),
+            [(ofp.OFPT_EXPERIMENTER, xid) for xid in range(1, 6)])
+
+    def test_serialized_cache(self):
+        match = parser.OFPMatch(in_port=1, eth_dst='0e:00:00:00:00:01')
+        inst = [parser.OFPInstructionGotoTable(3)]
+        datapath = FakeDatapath()
+        bufs = []
+        for _ in range(2):
+            flow_msg = parser.OFPFlowMod(
+                datapath=None, table_id=0, match=match, instructions=inst)
+            send_msgs(datapath, [flow_msg])
+            expected_msg = parser.OFPFlowMod(
+                datapath=datapath, table_id=0, match=match, instructions=inst)
+            expected_msg.set_xid(flow_msg.xid)
+            expected_msg.serialize()
+            self.assertEqual(datapath.writes[-1], expected_msg.buf)
+            bufs.append(datapath.writes[-1])
+        # only the xid differs.
+        self.assertNotEqual(bufs[0], bufs[1])
+        self.assertEqual(bufs[0][8:], bufs[1][8:])
+        self.assertEqual(SERIALIZED_FLOWMODS.hits > 0, True)
+
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.put(1, 'a')
+        cache.put(2, 'b')
+        self.assertEqual(cache.get(1), 'a')
+        cache.put(3, 'c')
+        self.assertEqual(cache.get(2), None)
+        self.assertEqual(sorted(cache.items), [1, 3])
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys, os
+testdir = os.path.dirname(__file__)
+srcdir = '../src/ryu_faucet/org/onfsdn/faucet'
+sys.path.insert(0, os.path.abspath(os.path.join(testdir, srcdir)))
+
+import copy
+import ipaddr
+import random
+import unittest
+
+from routetable import RouteTable
+
+
+def linear_lookup(routes, ip_address):
+    """Return the longest prefix routing ip_address, by checking all."""
+    matches = [ip_dst for ip_dst in routes if ip_address in ip_dst]
+    if not matches:
+        return None
+    return max(matches, key=lambda ip_dst: ip_dst.prefixlen)
+
+
+class RouteTableTestCase(unittest.TestCase):
+
+    def test_lookup(self):
+        routes = RouteTable(4)
+        routes[ipaddr.IPNetwork('10.0.0.0/8')] = ipaddr.IPAddress('10.0.0.1')
+        routes[ipaddr.IPNetwork('10.1.0.0/16')] = ipaddr.IPAddress('10.0.0.2')
+        routes[ipaddr.IPNetwork('10.1.2.0/24')] = ipaddr.IPAddress('10.0.0.1')
+        for address, ip_dst in (
+                ('10.1.2.3', '10.1.2.0/24'),
+                ('10.1.3.3', '10.1.0.0/16'),
+                ('10.2.0.1', '10.0.0.0/8')):
+            self.assertEqual(
+                routes.lookup(ipaddr.IPAddress(address)),
+                ipaddr.IPNetwork(ip_dst))
+        self.assertEqual(routes.lookup(ipaddr.IPAddress('192.168.0.1')), None)
+        routes[ipaddr.IPNetwork('0.0.0.0/0')] = ipaddr.IPAddress('10.0.0.3')
+        self.assertEqual(
+            routes.lookup(ipaddr.IPAddress('192.168.0.1')),
+            ipaddr.IPNetwork('0.0.0.0/0'))
+
+    def test_delete(self):
+        routes = RouteTable(6)
+        prefixes = [ipaddr.IPNetwork(ip_dst) for ip_dst in (
+            'fc00::/7', 'fc00:1::/32', 'fc00:1:2::/48', 'fc00:1:3::/48')]
+        for ip_dst in prefixes:
+            routes[ip_dst] = ipaddr.IPAddress('fc00::1')
+        del routes[prefixes[1]]
+        self.assertEqual(
+            routes.lookup(ipaddr.IPAddress('fc00:1:4::1')), prefixes[0])
+        self.assertEqual(
+            routes.lookup(ipaddr.IPAddress('fc00:1:3::1')), prefixes[3])
+        for ip_dst in prefixes[2:]:
+            del routes[ip_dst]
+        self.assertEqual(routes, {prefixes[0]: ipaddr.IPAddress('fc00::1')})
+        self.assertEqual(routes.root.children.count(None), 1)
+        del routes[prefixes[0]]
+        self.assertEqual(routes.root.children, [None, None])
+        self.assertRaises(KeyError, routes.__delitem__, prefixes[0])
+
+    def test_gateway_index(self):
+        routes = RouteTable(4)
+        gw1 = ipaddr.IPAddress('10.0.0.1')
+        gw2 = ipaddr.IPAddress('10.0.0.2')
+        routes[ipaddr.IPNetwork('10.1.0.0/16')] = gw1
+        routes[ipaddr.IPNetwork('10.2.0.0/16')] = gw1
+        routes[ipaddr.IPNetwork('10.2.0.0/16')] = gw2
+        self.assertEqual(routes.prefixes_via(gw1),
+                         set([ipaddr.IPNetwork('10.1.0.0/16')]))
+        self.assertEqual(routes.prefixes_via(gw2),
+                         set([ipaddr.IPNetwork('10.2.0.0/16')]))
+        del routes[ipaddr.IPNetwork('10.1.0.0/16')]
+        self.assertEqual(routes.gateways(), [gw2])
+        self.assertEqual(routes.prefixes_via(gw1), set())
+
+    def test_random_routes(self):
+        rand = random.Random(1)
+        routes = RouteTable(4)
+        gw = ipaddr.IPAddress('10.0.0.1')
+        for _ in range(500):
+            ip_dst = ipaddr.IPNetwork('%s/%u' % (
+                ipaddr.IPAddress(rand.getrandbits(32)), rand.randint(0, 32)))
+            routes[ipaddr.IPNetwork(
+                '%s/%u' % (ip_dst.network, ip_dst.prefixlen))] = gw
+        for ip_dst in rand.sample(list(routes), 200):
+            del routes[ip_dst]
+        routes_copy = copy.deepcopy(routes)
+        for _ in range(1000):
+            address = ipaddr.IPAddress(rand.getrandbits(32))
+            self.assertEqual(
+                routes_copy.lookup(address), linear_lookup(routes, address))
+        for ip_dst in routes:
+            self.assertEqual(
+                routes.lookup(ip_dst.network),
+                linear_lookup(routes, ip_dst.network))
+
+
+if __name__ == "__main__":
+    unittest.main()
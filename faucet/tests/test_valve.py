@@ -0,0 +1,713 @@
+#!/usr/bin/python
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys, os
+testdir = os.path.dirname(__file__)
+srcdir = '../src/ryu_faucet/org/onfsdn/faucet'
+sys.path.insert(0, os.path.abspath(os.path.join(testdir, srcdir)))
+
+import copy
+import ipaddr
+import logging
+import unittest
+
+from ryu.lib.packet import arp, ethernet, icmp, icmpv6, ipv4, ipv6, packet
+from ryu.lib.packet import udp, vlan
+from ryu.ofproto import ether
+from ryu.ofproto import inet
+from ryu.ofproto import ofproto_v1_3 as ofp
+from ryu.ofproto import ofproto_v1_3_parser as parser
+
+from acl import acl_metadata
+from dp import DP
+from flowtable import FlowTable
+from packet_fields import parse_packet_in
+from valve import Valve, valve_factory
+
+DP_ID = 0xcafef00d
+
+logging.getLogger('test').addHandler(logging.NullHandler())
+logging.getLogger('test').propagate = False
+
+
+def build_dp(port_vlans=None, controller_ips=None):
+    """Return a 48 port DP, ports 1-24 on VLAN 100 and 25-48 on VLAN
+    200 unless port_vlans says otherwise."""
+    dp = DP(DP_ID, 'test')
+    dp.add_vlan(100)
+    dp.add_vlan(200, {'controller_ips': controller_ips or ['10.0.0.254/24']})
+    for port_num in range(1, 49):
+        vid = 100 if port_num <= 24 else 200
+        if port_vlans is not None:
+            vid = port_vlans.get(port_num, vid)
+        dp.add_port(port_num, {'native_vlan': vid})
+    return dp
+
+
+def build_pkt(eth_dst, eth_src, eth_type, *protocols):
+    pkt = packet.Packet()
+    pkt.add_protocol(ethernet.ethernet(eth_dst, eth_src, eth_type))
+    for protocol in protocols:
+        pkt.add_protocol(protocol)
+    pkt.serialize()
+    return pkt.data
+
+
+def udp_pkt(eth_dst, eth_src, vid, src_ip, dst_ip):
+    return build_pkt(
+        eth_dst, eth_src, ether.ETH_TYPE_8021Q,
+        vlan.vlan(vid=vid, ethertype=ether.ETH_TYPE_IP),
+        ipv4.ipv4(src=src_ip, dst=dst_ip, proto=inet.IPPROTO_UDP),
+        udp.udp(1024, 53))
+
+
+def arp_pkt(eth_dst, eth_src, vid, src_ip, dst_ip):
+    return build_pkt(
+        eth_dst, eth_src, ether.ETH_TYPE_8021Q,
+        vlan.vlan(vid=vid, ethertype=ether.ETH_TYPE_ARP),
+        arp.arp(src_mac=eth_src, src_ip=src_ip, dst_ip=dst_ip))
+
+
+def packet_outs(ofmsgs):
+    return [ofmsg for ofmsg in ofmsgs
+            if isinstance(ofmsg, parser.OFPPacketOut)]
+
+
+def commands(ofmsgs):
+    return [ofmsg.command for ofmsg in ofmsgs
+            if isinstance(ofmsg, parser.OFPFlowMod)]
+
+
+class FlowTableTestCase(unittest.TestCase):
+
+    def flowmod(self, table_id, priority=1, command=ofp.OFPFC_ADD,
+                out_port=0, port=1, **match):
+        return parser.OFPFlowMod(
+            datapath=None, table_id=table_id, priority=priority,
+            command=command, out_port=out_port,
+            match=parser.OFPMatch(**match),
+            instructions=[parser.OFPInstructionActions(
+                ofp.OFPIT_APPLY_ACTIONS, [parser.OFPActionOutput(port)])])
+
+    def test_apply(self):
+        flow_table = FlowTable([
+            self.flowmod(0, in_port=1),
+            self.flowmod(0, in_port=2),
+            self.flowmod(1, in_port=1, port=2),
+            self.flowmod(0, priority=2, in_port=1),
+            self.flowmod(0, in_port=2, port=3),
+        ])
+        self.assertEqual(len(flow_table), 4)
+        flow_table.apply([self.flowmod(
+            ofp.OFPTT_ALL, command=ofp.OFPFC_DELETE, out_port=ofp.OFPP_ANY,
+            in_port=1)])
+        self.assertEqual(len(flow_table), 1)
+        flow_table.apply([self.flowmod(
+            0, command=ofp.OFPFC_DELETE, out_port=3)])
+        self.assertEqual(len(flow_table), 0)
+
+    def test_diff(self):
+        current = FlowTable([
+            self.flowmod(0, in_port=1),
+            self.flowmod(0, in_port=2),
+            self.flowmod(0, in_port=3)])
+        intended = FlowTable([
+            self.flowmod(0, in_port=1),
+            self.flowmod(0, in_port=2, port=5),
+            self.flowmod(0, in_port=4)])
+        ofmsgs = current.diff(intended)
+        self.assertEqual(
+            commands(ofmsgs),
+            [ofp.OFPFC_ADD, ofp.OFPFC_MODIFY_STRICT,
+             ofp.OFPFC_DELETE_STRICT])
+        current.apply(ofmsgs)
+        self.assertEqual(current.diff(intended), [])
+        self.assertEqual(len(current.diff(intended, readd=True)), 3)
+
+
+class ACLTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dp = build_dp()
+        self.dp.add_acl(1, [
+            {'rule': {'dl_type': 0x800, 'nw_dst': '10.0.0.0/8',
+                      'in_port': 7, 'actions': {'allow': 0}}},
+            {'rule': {'dl_type': 0x800, 'actions': {'allow': 1}}},
+            {'rule': {'actions': {'allow': 1, 'mirror': 47}}}])
+        self.dp.acl_in[5] = 1
+        self.dp.acl_in[6] = 1
+        self.valve = Valve(self.dp, 'test')
+
+    def test_compiled_once(self):
+        acl_rules = self.dp.acl_rules[1]
+        self.assertEqual(
+            [acl_rule.priority for acl_rule in acl_rules],
+            [self.dp.highest_priority - i for i in range(3)])
+        self.assertEqual(
+            acl_rules[0].match_fields,
+            {'eth_type': 0x800, 'ipv4_dst': ('10.0.0.0', '255.0.0.0')})
+        port5_ofmsgs, forwarding_inst = self.valve.port_add_acl(5)
+        self.assertEqual(
+            [inst.table_id for inst in forwarding_inst], [self.dp.acl_table])
+        port6_ofmsgs, _ = self.valve.port_add_acl(6)
+        for port5_ofmsg, port6_ofmsg, acl_rule in zip(
+                port5_ofmsgs, port6_ofmsgs, acl_rules):
+            self.assertEqual(port5_ofmsg.match['in_port'], 5)
+            self.assertEqual(port6_ofmsg.match['in_port'], 6)
+            for ofmsg in (port5_ofmsg, port6_ofmsg):
+                self.assertEqual(
+                    [id(inst) for inst in ofmsg.instructions],
+                    [id(inst) for inst in acl_rule.instructions])
+
+    def test_no_acl(self):
+        ofmsgs, forwarding_inst = self.valve.port_add_acl(1)
+        self.assertEqual(ofmsgs, [])
+        self.assertEqual(
+            [inst.table_id for inst in forwarding_inst],
+            [self.dp.eth_src_table])
+
+    def test_shared(self):
+        for port_num in range(7, 25):
+            self.dp.acl_in[port_num] = 1
+        valve = Valve(self.dp, 'test', shared_acls=True)
+        valve.datapath_connect(DP_ID, [])
+        acl_flows = [
+            flow for flow in valve.flow_table.flows.itervalues()
+            if flow.table_id == self.dp.acl_table and flow.priority > 0]
+        self.assertEqual(len(acl_flows), 3)
+        for flow in acl_flows:
+            self.assertEqual(flow.match['metadata'], acl_metadata(1))
+        ofmsgs, forwarding_inst = valve.port_add_acl(5)
+        self.assertEqual(ofmsgs, [])
+        self.assertEqual(
+            forwarding_inst[0].metadata, acl_metadata(1)[0])
+        self.assertEqual(forwarding_inst[1].table_id, self.dp.acl_table)
+
+    def test_valve_factory(self):
+        self.dp.hardware = 'Open vSwitch'
+        self.assertTrue(valve_factory(self.dp).shared_acls)
+        self.dp.hardware = 'ZodiacFX'
+        self.assertFalse(valve_factory(self.dp).shared_acls)
+
+
+class PacketFieldsTestCase(unittest.TestCase):
+
+    def test_l2(self):
+        pkt = parse_packet_in(udp_pkt(
+            'ff:ff:ff:ff:ff:ff', '0e:00:00:00:00:02', 100,
+            '10.0.0.1', '10.0.0.255'))
+        self.assertEqual(
+            (pkt.eth_dst, pkt.eth_src, pkt.vid, pkt.eth_type),
+            ('ff:ff:ff:ff:ff:ff', '0e:00:00:00:00:02', 100,
+             ether.ETH_TYPE_IP))
+        # UDP is not for the control plane.
+        self.assertEqual(pkt.ip_addresses(), None)
+        self.assertEqual(
+            pkt.decode().get_protocol(udp.udp).dst_port, 53)
+
+    def test_untagged(self):
+        self.assertEqual(parse_packet_in(build_pkt(
+            'ff:ff:ff:ff:ff:ff', '0e:00:00:00:00:02', ether.ETH_TYPE_ARP,
+            arp.arp(src_ip='10.0.0.1', dst_ip='10.0.0.2'))), None)
+        self.assertEqual(parse_packet_in('\xff' * 10), None)
+
+    def test_ip_addresses(self):
+        pkt = parse_packet_in(arp_pkt(
+            'ff:ff:ff:ff:ff:ff', '0e:00:00:00:00:02', 100,
+            '10.0.0.1', '10.0.0.254'))
+        self.assertEqual(
+            [str(ip) for ip in pkt.ip_addresses()],
+            ['10.0.0.1', '10.0.0.254'])
+        pkt = parse_packet_in(build_pkt(
+            '0e:00:00:00:00:01', '0e:00:00:00:00:02', ether.ETH_TYPE_8021Q,
+            vlan.vlan(vid=100, ethertype=ether.ETH_TYPE_IP),
+            ipv4.ipv4(src='10.0.0.1', dst='10.0.0.254',
+                      proto=inet.IPPROTO_ICMP),
+            icmp.icmp(data=icmp.echo())))
+        self.assertEqual(
+            [str(ip) for ip in pkt.ip_addresses()],
+            ['10.0.0.1', '10.0.0.254'])
+        pkt = parse_packet_in(build_pkt(
+            '0e:00:00:00:00:01', '0e:00:00:00:00:02', ether.ETH_TYPE_8021Q,
+            vlan.vlan(vid=100, ethertype=ether.ETH_TYPE_IPV6),
+            ipv6.ipv6(src='fc00::1', dst='fc00::fe',
+                      nxt=inet.IPPROTO_ICMPV6),
+            icmpv6.icmpv6(
+                type_=icmpv6.ICMPV6_ECHO_REQUEST, data=icmpv6.echo())))
+        self.assertEqual(
+            [str(ip) for ip in pkt.ip_addresses()], ['fc00::1', 'fc00::fe'])
+
+
+class ValveControlPlaneTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.valve = Valve(build_dp(), 'test')
+        self.valve.datapath_connect(DP_ID, range(1, 49))
+
+    def rcv_packet(self, data, in_port=25):
+        pkt = parse_packet_in(data)
+        return self.valve.rcv_packet(DP_ID, in_port, pkt.vid, pkt)
+
+    def test_learn(self):
+        ofmsgs = self.rcv_packet(udp_pkt(
+            'ff:ff:ff:ff:ff:ff', '0e:00:00:00:00:02', 200,
+            '10.0.0.1', '10.0.0.255'))
+        self.assertEqual(packet_outs(ofmsgs), [])
+        self.assertIn('0e:00:00:00:00:02', self.valve.dp.vlans[200].host_cache)
+
+    def test_arp_request(self):
+        ofmsgs = self.rcv_packet(arp_pkt(
+            'ff:ff:ff:ff:ff:ff', '0e:00:00:00:00:02', 200,
+            '10.0.0.1', '10.0.0.254'))
+        reply = packet.Packet(packet_outs(ofmsgs)[0].data)
+        self.assertEqual(reply.get_protocol(arp.arp).opcode, arp.ARP_REPLY)
+        # not for FAUCET.
+        ofmsgs = self.rcv_packet(arp_pkt(
+            'ff:ff:ff:ff:ff:ff', '0e:00:00:00:00:02', 200,
+            '10.0.1.1', '10.0.1.2'))
+        self.assertEqual(packet_outs(ofmsgs), [])
+
+    def arp_reply(self, eth_src, src_ip):
+        return self.rcv_packet(build_pkt(
+            self.valve.FAUCET_MAC, eth_src, ether.ETH_TYPE_8021Q,
+            vlan.vlan(vid=200, ethertype=ether.ETH_TYPE_ARP),
+            arp.arp(opcode=arp.ARP_REPLY, src_mac=eth_src, src_ip=src_ip,
+                    dst_mac=self.valve.FAUCET_MAC, dst_ip='10.0.0.254')))
+
+    @staticmethod
+    def route_flows(ofmsgs):
+        return dict(
+            (ofmsg.match['ipv4_dst'], (ofmsg.command, ofmsg.priority))
+            for ofmsg in ofmsgs
+            if isinstance(ofmsg, parser.OFPFlowMod) and
+            'ipv4_dst' in ofmsg.match)
+
+    def test_arp_reply_routes(self):
+        vlan_200 = self.valve.dp.vlans[200]
+        ip_gw = ipaddr.IPAddress('10.0.0.1')
+        for ip_dst in ('10.1.0.0/16', '10.1.2.0/24'):
+            vlan_200.add_route(ipaddr.IPNetwork(ip_dst), ip_gw)
+        vlan_200.add_route(
+            ipaddr.IPNetwork('10.2.0.0/16'), ipaddr.IPAddress('10.0.0.2'))
+        ofmsgs = self.arp_reply('0e:00:00:00:00:01', '10.0.0.1')
+        # only the gateway's routes, longer prefixes at higher priorities.
+        highest_priority = self.valve.dp.highest_priority
+        self.assertEqual(self.route_flows(ofmsgs), {
+            ('10.1.0.0', '255.255.0.0'):
+                (ofp.OFPFC_ADD, highest_priority + 17),
+            ('10.1.2.0', '255.255.255.0'):
+                (ofp.OFPFC_ADD, highest_priority + 25)})
+        self.assertEqual(
+            vlan_200.arp_cache[ip_gw].eth_src, '0e:00:00:00:00:01')
+        self.assertEqual(
+            self.route_flows(self.arp_reply('0e:00:00:00:00:01', '10.0.0.1')),
+            {})
+        # the gateway's MAC changed: its routes' flows are replaced.
+        self.assertEqual(
+            self.route_flows(self.arp_reply('0e:00:00:00:00:03', '10.0.0.1')),
+            {('10.1.0.0', '255.255.0.0'):
+                (ofp.OFPFC_ADD, highest_priority + 17),
+             ('10.1.2.0', '255.255.255.0'):
+                (ofp.OFPFC_ADD, highest_priority + 25)})
+        vlan_200.del_route(ipaddr.IPNetwork('10.1.2.0/24'))
+        self.assertEqual(
+            vlan_200.routes_via(ip_gw),
+            set([ipaddr.IPNetwork('10.1.0.0/16')]))
+
+    def test_resolve_gateways(self):
+        vlan_200 = self.valve.dp.vlans[200]
+        vlan_200.add_route(
+            ipaddr.IPNetwork('10.1.0.0/16'), ipaddr.IPAddress('10.0.0.1'))
+        # not on a controller IP's subnet.
+        vlan_200.add_route(
+            ipaddr.IPNetwork('10.2.0.0/16'), ipaddr.IPAddress('10.9.0.1'))
+        self.valve.schedule_gateways(now=100)
+        self.assertEqual(self.valve.next_resolve_time(), 100)
+        requests = [
+            packet.Packet(packet_out.data).get_protocol(arp.arp)
+            for packet_out in packet_outs(self.valve.resolve_gateways(100))]
+        self.assertNotEqual(requests, [])
+        self.assertEqual(
+            set((request.opcode, request.dst_ip) for request in requests),
+            set([(arp.ARP_REQUEST, '10.0.0.1')]))
+        # retried only when due.
+        self.assertEqual(self.valve.next_resolve_time(), 102)
+        self.assertEqual(self.valve.resolve_gateways(101), [])
+        self.assertNotEqual(self.valve.resolve_gateways(102), [])
+        self.arp_reply('0e:00:00:00:00:01', '10.0.0.1')
+        self.assertEqual(self.valve.resolve_gateways(110), [])
+        self.assertTrue(self.valve.next_resolve_time() > 110)
+
+    def test_icmp_echo(self):
+        ofmsgs = self.rcv_packet(build_pkt(
+            self.valve.FAUCET_MAC, '0e:00:00:00:00:02', ether.ETH_TYPE_8021Q,
+            vlan.vlan(vid=200, ethertype=ether.ETH_TYPE_IP),
+            ipv4.ipv4(src='10.0.0.1', dst='10.0.0.254',
+                      proto=inet.IPPROTO_ICMP),
+            icmp.icmp(data=icmp.echo(data='ping'))))
+        reply = packet.Packet(packet_outs(ofmsgs)[0].data)
+        self.assertEqual(
+            reply.get_protocol(icmp.icmp).type, icmp.ICMP_ECHO_REPLY)
+
+
+class ValvePacketInLimitTestCase(unittest.TestCase):
+
+    def setUp(self):
+        dp = build_dp()
+        dp.packet_in_rate = 10
+        dp.packet_in_burst = 5
+        self.valve = Valve(dp, 'test')
+        self.valve.datapath_connect(DP_ID, range(1, 49))
+
+    def rcv_packet(self, in_port=1, eth_src='0e:00:00:00:00:02'):
+        pkt = parse_packet_in(udp_pkt(
+            'ff:ff:ff:ff:ff:ff', eth_src, 100, '10.0.0.1', '10.0.0.255'))
+        return self.valve.rcv_packet(DP_ID, in_port, pkt.vid, pkt)
+
+    def test_learn_holddown(self):
+        self.assertNotEqual(self.rcv_packet(), [])
+        self.assertEqual(self.rcv_packet(), [])
+        # the host moved.
+        self.assertNotEqual(self.rcv_packet(in_port=2), [])
+        self.valve.port_delete(DP_ID, 2)
+        self.valve.port_add(DP_ID, 2)
+        self.assertNotEqual(self.rcv_packet(in_port=2), [])
+        stats = self.valve.get_packet_in_stats()
+        self.assertEqual(stats['learned'], 3)
+        self.assertEqual(stats['learn_suppressed'], 1)
+
+    def test_learn_holddown_move_back(self):
+        self.assertNotEqual(self.rcv_packet(in_port=1), [])
+        self.assertNotEqual(self.rcv_packet(in_port=2), [])
+        # the host moved back, and is relearned on its first port.
+        self.assertNotEqual(self.rcv_packet(in_port=1), [])
+        self.assertEqual(self.rcv_packet(in_port=1), [])
+        host_cache = self.valve.dp.vlans[100].host_cache
+        self.assertEqual(len(host_cache), 1)
+        stats = self.valve.get_packet_in_stats()
+        self.assertEqual(stats['learned'], 3)
+        self.assertEqual(stats['learn_suppressed'], 1)
+
+    def test_max_hosts_no_holddown(self):
+        vlan = self.valve.dp.vlans[100]
+        vlan.max_hosts = 1
+        self.rcv_packet(eth_src='0e:00:00:00:00:01')
+        self.rcv_packet(eth_src='0e:00:00:00:00:02')
+        self.assertEqual(sorted(vlan.host_cache), ['0e:00:00:00:00:01'])
+        # the refused host is learned as soon as it may be.
+        vlan.max_hosts = None
+        self.assertNotEqual(self.rcv_packet(eth_src='0e:00:00:00:00:02'), [])
+        self.assertEqual(len(vlan.host_cache), 2)
+        stats = self.valve.get_packet_in_stats()
+        self.assertEqual(stats['learned'], 2)
+        self.assertEqual(stats['learn_suppressed'], 0)
+
+    def test_rate_limit(self):
+        for i in range(20):
+            self.rcv_packet(eth_src='0e:00:00:00:01:%02x' % i)
+        self.rcv_packet(in_port=2)
+        stats = self.valve.get_packet_in_stats()
+        self.assertEqual(stats['received'], 21)
+        self.assertEqual(stats['learned'], 6)
+        self.assertEqual(stats['rate_limited'], 15)
+        self.assertEqual(stats['rate_limited_ports'], {1: 15})
+        self.assertEqual(len(self.valve.dp.vlans[100].host_cache), 6)
+
+
+class ValveHostExpireTestCase(unittest.TestCase):
+
+    def setUp(self):
+        dp = build_dp()
+        dp.timeout = 300
+        dp.learn_holddown = 0
+        self.valve = Valve(dp, 'test')
+        self.valve.datapath_connect(DP_ID, range(1, 49))
+        self.host_cache = dp.vlans[100].host_cache
+
+    def learn(self, eth_src, in_port=1):
+        pkt = parse_packet_in(udp_pkt(
+            'ff:ff:ff:ff:ff:ff', eth_src, 100, '10.0.0.1', '10.0.0.255'))
+        self.valve.rcv_packet(DP_ID, in_port, pkt.vid, pkt)
+        return self.host_cache[eth_src]
+
+    def test_expire(self):
+        for i in range(3):
+            self.learn('0e:00:00:00:00:%02x' % i)
+        now = self.host_cache['0e:00:00:00:00:00'].cache_time
+        self.assertEqual(self.valve.host_expire(now + 1), [])
+        self.host_cache['0e:00:00:00:00:01'].cache_time = now + 100
+        ofmsgs = self.valve.host_expire(now + 301)
+        self.assertEqual(sorted(self.host_cache), ['0e:00:00:00:00:01'])
+        self.assertEqual(
+            [(ofmsg.table_id, ofmsg.match.get('eth_src'),
+              ofmsg.match.get('eth_dst')) for ofmsg in ofmsgs
+             if isinstance(ofmsg, parser.OFPFlowMod)],
+            [(self.valve.dp.eth_src_table, '0e:00:00:00:00:00', None),
+             (self.valve.dp.eth_dst_table, None, '0e:00:00:00:00:00'),
+             (self.valve.dp.eth_src_table, '0e:00:00:00:00:02', None),
+             (self.valve.dp.eth_dst_table, None, '0e:00:00:00:00:02')])
+        self.assertEqual(
+            set(commands(ofmsgs)), set([ofp.OFPFC_DELETE]))
+        # the refreshed host was queued again, for when it expires.
+        self.assertEqual(len(self.valve.host_expiry), 1)
+        self.assertEqual(self.valve.host_expire(now + 399), [])
+        self.assertNotEqual(self.valve.host_expire(now + 401), [])
+        self.assertEqual(self.host_cache, {})
+        self.assertEqual(len(self.valve.host_expiry), 0)
+
+    def test_relearned_and_permanent(self):
+        old_entry = self.learn('0e:00:00:00:00:01')
+        now = old_entry.cache_time
+        # the host moved, and was learned again.
+        new_entry = self.learn('0e:00:00:00:00:01', in_port=2)
+        self.assertIsNot(old_entry, new_entry)
+        self.valve.dp.ports[3].permanent_learn = True
+        self.learn('0e:00:00:00:00:03', in_port=3)
+        self.assertEqual(len(self.valve.host_expiry), 2)
+        self.assertEqual(len(self.valve.host_expire(now + 301 + 60)), 3)
+        self.assertEqual(sorted(self.host_cache), ['0e:00:00:00:00:03'])
+
+
+class ValveCacheTestCase(unittest.TestCase):
+
+    def test_shared_matches(self):
+        vlan = build_dp().vlans[100]
+        self.assertIs(
+            Valve.valve_in_match(in_port=1, vlan=vlan),
+            Valve.valve_in_match(vlan=vlan, in_port=1))
+        self.assertIsNot(
+            Valve.valve_in_match(in_port=1, vlan=vlan),
+            Valve.valve_in_match(in_port=2, vlan=vlan))
+        self.assertEqual(
+            Valve.valve_in_match(
+                nw_src=ipaddr.IPNetwork('10.0.1.0/24'))['ipv4_src'],
+            ('10.0.1.0', '255.255.255.0'))
+        self.assertIs(Valve.goto_table(3), Valve.goto_table(3))
+
+
+class ValveFlowCountTestCase(unittest.TestCase):
+
+    def build_valve(self, port_count, vlan_count):
+        """Return a valve with port_count ports, spread over vlan_count
+        VLANs with a controller IP each."""
+        dp = DP(DP_ID, 'test')
+        for i in range(vlan_count):
+            dp.add_vlan(100 + i, {'controller_ips': ['10.0.%u.254/24' % i]})
+        for port_num in range(1, port_count + 1):
+            dp.add_port(port_num, {'native_vlan': 100 + port_num % vlan_count})
+        return Valve(dp, 'test')
+
+    def test_connect_flows(self):
+        for port_count, vlan_count in ((48, 8), (96, 8), (96, 16)):
+            valve = self.build_valve(port_count, vlan_count)
+            ofmsgs = valve.add_ports_and_vlans(range(1, port_count + 1))
+            # per port: a delete per table and its VLAN flow. Per VLAN: 5
+            # flood rules and 2 controller IP flows.
+            self.assertEqual(
+                len(ofmsgs),
+                port_count * (len(valve.all_valve_tables()) + 1) +
+                vlan_count * 7)
+
+    def test_port_add(self):
+        valve = self.build_valve(48, 8)
+        valve.datapath_connect(DP_ID, [])
+        ofmsgs = valve.port_add(DP_ID, 1)
+        self.assertEqual(len(ofmsgs), len(valve.all_valve_tables()) + 1 + 7)
+        ofmsgs = valve.port_delete(DP_ID, 1)
+        self.assertEqual(
+            commands(ofmsgs)[-5:], [ofp.OFPFC_MODIFY_STRICT] * 5)
+
+
+class ValveReloadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.valve = Valve(build_dp(), 'test')
+        self.connect_ofmsgs = self.valve.datapath_connect(DP_ID, [])
+
+    def test_first_connect(self):
+        connect_commands = commands(self.connect_ofmsgs)
+        # everything is deleted, then the config added.
+        self.assertEqual(
+            connect_commands[:5], [ofp.OFPFC_DELETE] * 5)
+        self.assertEqual(
+            connect_commands[5:],
+            [ofp.OFPFC_ADD] * len(self.valve.flow_table))
+
+    def test_reload_unchanged(self):
+        self.assertEqual(self.valve.reload_config(build_dp()), [])
+
+    def test_reload_port_vlan(self):
+        ofmsgs = self.valve.reload_config(build_dp(port_vlans={48: 100}))
+        # hosts learned on both VLANs are deleted, their flood rules and
+        # port 48's VLAN flow modified and VLAN 200's controller IP flows
+        # added again.
+        self.assertEqual(
+            commands(ofmsgs),
+            [ofp.OFPFC_DELETE] * 4 + [ofp.OFPFC_MODIFY_STRICT] * 10 +
+            [ofp.OFPFC_ADD] * 2 + [ofp.OFPFC_MODIFY_STRICT])
+
+    def test_reload_controller_ips(self):
+        ofmsgs = self.valve.reload_config(
+            build_dp(controller_ips=['10.0.1.254/24']))
+        self.assertEqual(
+            commands(ofmsgs), [ofp.OFPFC_DELETE] * 2 + [ofp.OFPFC_ADD] * 2)
+
+    def test_reconnect(self):
+        self.valve.datapath_disconnect(DP_ID)
+        ofmsgs = self.valve.datapath_connect(DP_ID, [])
+        self.assertNotIn(ofp.OFPFC_DELETE, commands(ofmsgs))
+        self.assertEqual(len(ofmsgs), len(self.valve.flow_table))
+
+    def test_port_events(self):
+        self.valve.port_delete(DP_ID, 10)
+        # the port stays down.
+        self.assertEqual(self.valve.reload_config(build_dp()), [])
+        self.assertEqual(
+            commands(self.valve.port_add(DP_ID, 10))[:5],
+            [ofp.OFPFC_DELETE] * 5)
+        self.assertEqual(self.valve.reload_config(build_dp()), [])
+
+
+class ValveConfigChangesTestCase(unittest.TestCase):
+
+    SHARED_ACLS = False
+
+    def setUp(self):
+        self.valve = Valve(build_dp(), 'test', shared_acls=self.SHARED_ACLS)
+        self.valve.datapath_connect(DP_ID, [])
+
+    def assert_reloads(self, new_dp):
+        """Check a reload to new_dp programs the same flows as connecting
+        with new_dp, once the ports it adds come up."""
+        old_port_nums = set(self.valve.dp.ports)
+        self.valve.reload_config(new_dp)
+        for port_num in sorted(set(new_dp.ports) - old_port_nums):
+            self.valve.port_add(DP_ID, port_num)
+        valve = Valve(
+            copy.deepcopy(new_dp), 'test', shared_acls=self.SHARED_ACLS)
+        valve.datapath_connect(DP_ID, [])
+        self.assertEqual(self.valve.flow_table.diff(valve.flow_table), [])
+
+    def test_config_changes(self):
+        new_dp = build_dp(port_vlans={1: 300, 48: 100})
+        new_dp.add_port(49, {'native_vlan': 100})
+        new_dp.delete_port(2)
+        changes = self.valve.dp.config_changes(new_dp)
+        self.assertEqual(changes.deleted_ports, set([2]))
+        self.assertEqual(changes.changed_ports, set([1, 48]))
+        self.assertEqual(changes.added_ports, set([49]))
+        self.assertEqual(changes.added_vlans, set([300]))
+        self.assertEqual(changes.changed_vlans, set([100, 200]))
+        new_dp = build_dp()
+        new_dp.timeout = 60
+        self.assertEqual(self.valve.dp.config_changes(new_dp), None)
+
+    def test_learned_state_kept(self):
+        old_vlans = self.valve.dp.vlans
+        old_vlans[100].host_cache['0e:00:00:00:00:02'] = 'host'
+        old_vlans[200].arp_cache['10.0.0.1'] = 'neighbor'
+        self.valve.reload_config(build_dp(port_vlans={48: 300}))
+        vlans = self.valve.dp.vlans
+        self.assertEqual(vlans[100].host_cache, {'0e:00:00:00:00:02': 'host'})
+        self.assertEqual(vlans[200].arp_cache, {})
+
+    def test_port_changes(self):
+        self.assert_reloads(build_dp(port_vlans={1: 200, 48: 300}))
+        self.assert_reloads(build_dp())
+
+    def test_down_port_stays_down(self):
+        self.valve.port_delete(DP_ID, 10)
+        new_dp = build_dp(port_vlans={10: 200})
+        new_dp.add_port(49, {'native_vlan': 100})
+        ofmsgs = self.valve.reload_config(new_dp)
+        for port_num in (10, 49):
+            self.assertFalse(new_dp.ports[port_num].phys_up)
+            self.assertEqual(
+                [ofmsg for ofmsg in ofmsgs
+                 if isinstance(ofmsg, parser.OFPFlowMod) and
+                 ofmsg.command == ofp.OFPFC_ADD and
+                 ofmsg.match.get('in_port') == port_num], [])
+            self.assertEqual(
+                self.valve.flow_table.keys_matching('in_port', port_num),
+                set())
+        self.assertNotEqual(
+            self.valve.flow_table.keys_matching('in_port', 11), set())
+        ofmsgs = self.valve.port_add(DP_ID, 10)
+        self.assertIn(
+            (ofp.OFPFC_ADD, 10),
+            [(ofmsg.command, ofmsg.match.get('in_port')) for ofmsg in ofmsgs
+             if isinstance(ofmsg, parser.OFPFlowMod)])
+
+    def test_ports_added_and_deleted(self):
+        new_dp = build_dp()
+        new_dp.delete_port(48)
+        new_dp.add_port(49, {'tagged_vlans': [100, 200]})
+        self.assert_reloads(new_dp)
+
+    def test_acl_changes(self):
+        new_dp = build_dp()
+        new_dp.add_acl(1, [
+            {'rule': {'dl_type': 0x800, 'actions': {'allow': 0}}},
+            {'rule': {'actions': {'allow': 1, 'mirror': 47}}}])
+        new_dp.acl_in[5] = 1
+        self.assert_reloads(new_dp)
+        new_dp = copy.deepcopy(new_dp)
+        new_dp.add_acl(1, [
+            {'rule': {'dl_type': 0x800, 'actions': {'allow': 1}}},
+            {'rule': {'actions': {'allow': 1, 'mirror': 47}}}])
+        self.assert_reloads(new_dp)
+
+    def test_acl_ports_changes(self):
+        new_dp = build_dp()
+        new_dp.add_acl(1, [{'rule': {'actions': {'allow': 1}}}])
+        new_dp.add_acl(2, [{'rule': {'actions': {'allow': 0}}}])
+        new_dp.acl_in[5] = 1
+        new_dp.acl_in[6] = 1
+        self.assert_reloads(new_dp)
+        new_dp = copy.deepcopy(new_dp)
+        new_dp.acl_in[5] = 2
+        self.assert_reloads(new_dp)
+        new_dp = copy.deepcopy(new_dp)
+        del new_dp.acl_in[6]
+        self.assert_reloads(new_dp)
+
+    def test_vlan_changes(self):
+        self.assert_reloads(build_dp(controller_ips=['fc00::1/64']))
+        new_dp = build_dp()
+        new_dp.add_vlan(300, {'controller_ips': ['10.0.3.254/24']})
+        new_dp.add_port(49, {'tagged_vlans': [300]})
+        new_dp.vlans[100].unicast_flood = False
+        self.assert_reloads(new_dp)
+
+
+class SharedACLConfigChangesTestCase(ValveConfigChangesTestCase):
+
+    SHARED_ACLS = True
+
+    def test_acl_moved_to_same_rules(self):
+        new_dp = build_dp()
+        new_dp.add_acl(1, [{'rule': {'actions': {'allow': 1}}}])
+        new_dp.add_acl(2, [{'rule': {'actions': {'allow': 1}}}])
+        new_dp.acl_in[5] = 1
+        self.assert_reloads(new_dp)
+        # the port's flows write the metadata of its new ACL.
+        new_dp = copy.deepcopy(new_dp)
+        new_dp.acl_in[5] = 2
+        self.assertEqual(
+            self.valve.dp.config_changes(new_dp).changed_ports, set([5]))
+        self.assert_reloads(new_dp)
+
+
+if __name__ == "__main__":
+    unittest.main()